@@ -80,6 +80,14 @@ export GXMWAPB="${GXBASE}/data/mwa_pb"  # The calibrate program requires the FEE
                                         # If this folder does not exist, it is created. 
 export GXMWALOOKUP="${GXBASE}/data/pb"  # The path to the folder containing the MWA PB lookup HDF5's used by lookup_beam.py and lookup_jones.py. 
                                         # If this folder does not exist, it is created. 
+export GXBEAMCACHE="${GXBASE}/data/beam_cache"  # The path to the folder of primary beams cached on alt/az grids, used by get_mwa_pb_lobes.py and
+                                                # beam_value_at_radec.py with --beam-cache. Beams are added as new pointings and frequencies are seen.
+
+# Mosaicing
+export GXCOADD='swarp'      # How mosaic.tmpl co-adds snapshots, e.g. 'swarp'. 'swarp' resamples each snapshot to disk and co-adds the
+                            # resampled images. 'python' uses mosaic_coadd.py, which reprojects and co-adds in a single tiled pass
+                            # without writing resampled images. Its weighted sums are kept in <mosaic>_coadd_state, so a later
+                            # run only processes the snapshots that were added, removed or re-processed since.
 # Details for obs_manta
 export GXCOPYA=             # Account to submit obs_manta.sh job under, if time accounting is being performed by SLURM.
                             # Leave this empty if the job is to be submitted as the user and there is no time accounting.
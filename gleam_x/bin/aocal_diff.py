@@ -14,56 +14,35 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import AnchoredText
 
-from astropy.io import fits
 from calplots import aocal
+from gleam_x.utils import jones
+from gleam_x.utils.metafits import load_metafits
 
 def get_tile_info(metafits):
-    hdus = fits.open(metafits)
-    inputs = hdus[1].data
-    tiles = inputs[inputs['pol'] == 'X']
-    tiles = tiles[np.argsort(tiles['Tile'])]
-    Names = tiles["TileName"]
-    North = tiles["North"]
-    East = tiles["East"]
+    Names, North, East = load_metafits(metafits, tiles=True).tile_positions(pol='X')
     return Names, North, East
 
 def diff_multi(ao_start, ao_end, refant):
-    diffs = []
-    ant_iter = np.arange(ao_start.n_ant)
-
     # dividing both start and end by reference antenna 
-    ao_start = ao_start/ao_start[:, refant, :, :][:, np.newaxis, :, :]
-    ao_end = ao_end/ao_end[:, refant, :, :][:, np.newaxis, :, :]
-
-    for a, antenna in enumerate(ant_iter): 
-        temp = []
-        for pol in 0,3:
-            temp.append(np.angle(ao_end[0, antenna, :, pol] / ao_start[0, antenna, :, pol], deg=True))
-        diffs.append(temp)
+    ao_start = jones.divide_refant(ao_start, refant)
+    ao_end = jones.divide_refant(ao_end, refant)
 
-    return diffs 
+    # Only XX and YY, shape (antenna, pol, channel)
+    return jones.phase_diff(ao_start[0], ao_end[0])
 
 def diff(ao, refant, ao_last=None):
-    diffs = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
+    non_nan_intervals = jones.valid_intervals(ao, refant)
     t_start = non_nan_intervals.min()
     t_end = non_nan_intervals.max()
     
     # Divide through by refant
-    ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains, then convert to angles
-           temp.append(np.angle(ao[t_end, antenna, :, pol] / ao[t_start, antenna, :, pol], deg=True))
-        diffs.append(temp)
-    return diffs
+    ao = jones.divide_refant(ao, refant)
+
+    # Difference the complex gains of XX and YY, then convert to angles
+    return jones.phase_diff(ao[t_start], ao[t_end])
 
 def phi_rms(ao, metafits, refant):
-    phi_rmss = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
+    non_nan_intervals = jones.valid_intervals(ao, refant)
     t_start = non_nan_intervals.min()
     t_end = non_nan_intervals.max()
     # Calculate middle interval
@@ -72,25 +51,11 @@ def phi_rms(ao, metafits, refant):
 
     # Divide through by refant
     # (Probably unnecessary)
-    ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains
-            # Divide all gains by t_mid value so central phase is zero (solves wrapping problem)
-           temp_gains = ao[:, antenna, :, pol] / ao[t_mid, antenna, :, pol]
-            
-            # then convert to angles
-           temp_angles = np.angle(ao[:, antenna, :, pol], deg=True)
-            
-            # Then find RMS -- over time axis only
-           phi_rmss.append(np.std(temp_angles, axis=0))
-        #    print(np.std(ao[:, antenna, :, pol], axis=0))
-           print(temp_angles.shape)
-           print(np.std(temp_angles, axis=0).shape)
-    return phi_rmss
+    ao = jones.divide_refant(ao, refant)
+
+    # RMS of the XX and YY phases over the time axis only, one row per antenna and pol
+    rmss = jones.phase_rms(ao)
+    return rmss.reshape(-1, rmss.shape[-1])
 
 def histo_diffs(diffs, obsid):
     fig = plt.figure()
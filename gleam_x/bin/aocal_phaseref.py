@@ -7,6 +7,8 @@ from calplots.aocal import fromfile
 import numpy as np
 from pyrap import tables
 
+from gleam_x.utils import jones
+
 parser = OptionParser(
     usage="usage: %prog inbinfile outbinfile refant"
     + """
@@ -76,20 +78,15 @@ if (opts.xy != 0.0 or opts.dxy != 0.0) and opts.preserve_xterms:
     parser.error("XY phase cannot be set if preserving xterms")
 
 ao = fromfile(infilename)
+# flagged solutions of the input, carried forward unless --no_preserve_mask
+initial_mask = np.isnan(ao)
 
-ref_phasor = (ao[0, refant, ...] / np.abs(ao[0, refant, ...]))[
-    np.newaxis, np.newaxis, ...
-]
 if opts.incremental:
     logging.warn("incremental solution untested!")
-    ao = ao / (ao * ref_phasor)
-else:
-    ao = ao / ref_phasor
+ao = jones.phase_reference(ao, refant, incremental=opts.incremental)
 
 if not opts.preserve_xterms:
-    zshape = (1, ao.n_ant, ao.n_chan)
-    ao[..., 1] = np.zeros(zshape, dtype=np.complex128)
-    ao[..., 2] = np.zeros(zshape, dtype=np.complex128)
+    jones.zero_crossterms(ao)
 if opts.xy != 0.0 or opts.dxy != 0.0:
     assert opts.ms is not None, "A measurment set has not be specified"
 
@@ -105,16 +102,11 @@ if opts.xy != 0.0 or opts.dxy != 0.0:
         len(freqs) == ao.n_chan
     ), f"Number of frequency solutions in the calibration file does not match the number of channels in {opts.ms}"
 
-    xy_phasor0 = complex(np.cos(np.radians(opts.xy)), np.sin(np.radians(opts.xy)))
-    xy_phasor1 = np.zeros((1, 1, ao.n_chan), dtype=np.complex128)
-    xy_phasor1.real += np.cos(np.radians(opts.dxy * freqs)).reshape(1, 1, ao.n_chan)
-    xy_phasor1.imag += np.sin(np.radians(opts.dxy * freqs)).reshape(1, 1, ao.n_chan)
-    ao[..., 3] = ao[..., 3] * xy_phasor0 * xy_phasor1
+    jones.apply_xy_phase(ao, xy=opts.xy, dxy=opts.dxy, freqs=freqs)
 
 
 if not opts.no_preserve_mask:
     print("Carrying forward NaN mask")
-    initial_ao = fromfile(infilename)
-    ao[np.isnan(initial_ao)] = np.nan
+    ao[initial_mask] = np.nan
 
 ao.tofile(outfilename)
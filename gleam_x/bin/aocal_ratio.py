@@ -2,7 +2,8 @@
 import os, logging
 from argparse import ArgumentParser
 from calplots.aocal import fromfile
-import numpy as np
+
+from gleam_x.utils import jones
 
 
 def aocal_ratio(sol_numerator, sol_denominator, outpath):
@@ -18,10 +19,7 @@ def aocal_ratio(sol_numerator, sol_denominator, outpath):
     ao_num = fromfile(sol_numerator)
     ao_den = fromfile(sol_denominator)
 
-    ao_ratio = ao_num / ao_den
-
-    mask = np.isfinite(ao_ratio)
-    ao_ratio[~mask] = np.nan
+    ao_ratio = jones.ratio(ao_num, ao_den)
 
     ao_ratio.tofile(outpath)
 
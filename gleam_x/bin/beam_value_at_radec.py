@@ -6,12 +6,12 @@ import sys
 import os, logging
 import numpy as np
 from math import pi
-from astropy.io import fits
 from astropy.wcs import WCS
-from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
 import astropy.units as u
 from mwa_pb_lookup.lookup_beam import beam_lookup_1d
+from gleam_x.utils.metafits import load_metafits
+from gleam_x.utils.beam_cache import BeamCache
 
 import argparse
 
@@ -26,14 +26,18 @@ MWA = EarthLocation.from_geodetic(
 )
 
 ######################################################################
-def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True):
+def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True, beam_cache=None):
 
     logger.info("Computing for %s" % t)
 
     pol = pol.upper()
     assert pol in ("I", "XX", "YY"), "pol %s is not supported" % pol
 
-    rX, rY = beam_lookup_1d(ra, dec, gridnum, t, freq)
+    if beam_cache is not None:
+        # interpolate from a cached alt/az grid of the full embedded element beam
+        rX, rY = beam_cache.beam_value(ra, dec, t, delays, freq, gridnum=gridnum)
+    else:
+        rX, rY = beam_lookup_1d(ra, dec, gridnum, t, freq)
 
     if pol == "I":
         return np.squeeze(rX), np.squeeze(rY)
@@ -49,29 +53,25 @@ def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True):
 def parse_metafits(metafits):
     # Delays needed for beam model calculation
     try:
-        f = fits.open(metafits)
+        obs = load_metafits(metafits)
     except Exception as e:
         logger.error("Unable to open FITS file %s: %s" % (metafits, e))
         sys.exit(1)
-    if not "DELAYS" in f[0].header.keys():
-        logger.error("Cannot find DELAYS in %s" % options.metafits)
+    if obs.delays is None:
+        logger.error("Cannot find DELAYS in %s" % metafits)
         sys.exit(1)
-    delstr = f[0].header["DELAYS"].split(",")
-    delays = [int(e) for e in delstr]
+    delays = obs.delays
 
     # get the date so we can convert to Az,El
-    start_time = f[0].header["DATE-OBS"]
-    duration = f[0].header["EXPOSURE"] * u.s
-    t = Time(start_time, format="isot", scale="utc") + 0.5 * duration
+    t = obs.mid_time
 
     # Just use the central frequency
     # Nice update would be to use the whole bandwidth and calculate spectral term
-    try:
-        freq = f[0].header["FREQCENT"] * 1000000.0
-    except:
+    freq = obs.freq
+    if freq is None:
         logger.error("Unable to read frequency FREQCENT from %s" % metafits)
 
-    gridnum = f[0].header["GRIDNUM"]
+    gridnum = obs.gridnum
 
     return t, delays, freq, gridnum
 
@@ -84,11 +84,23 @@ if __name__ == "__main__":
     group1.add_argument(
         "--metafits", type=str, help="The metafits file for your observation"
     )
+    parser.add_argument(
+        "--beam-cache",
+        type=str,
+        default=None,
+        nargs="?",
+        const="",
+        help="Interpolate the beam from alt/az grids cached in this directory rather than the lookup tables. Without a directory GXBEAMCACHE is used",
+    )
     options = parser.parse_args()
 
     t, delays, freq, gridnum = parse_metafits(options.metafits)
 
-    val = beam_value(options.ra, options.dec, t, delays, freq, gridnum)
+    beam_cache = None
+    if options.beam_cache is not None:
+        beam_cache = BeamCache(directory=options.beam_cache or None)
+
+    val = beam_value(options.ra, options.dec, t, delays, freq, gridnum, beam_cache=beam_cache)
     print(val[0], val[1])
 
 # Leaving this code here for later; might be useful when returning different pols
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 from gleam_x.bin.beam_value_at_radec import beam_value, parse_metafits
+from gleam_x.utils.metafits import load_metafits
 
-from astropy.io import fits
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 
@@ -11,10 +11,10 @@ import numpy as np
 
 def calc_peak_beam(metafits, gridsize = 8, cellsize = 1):
     t, delays, freq, gridnum = parse_metafits(metafits)
-    hdu = fits.open(metafits)
+    obs = load_metafits(metafits)
     
-    ra = hdu[0].header["RA"]
-    dec = hdu[0].header["DEC"]
+    ra = obs.ra
+    dec = obs.dec
     ras = np.arange(ra - (gridsize/2), ra + (gridsize/2), cellsize)
     decs = np.arange(dec - (gridsize/2), dec + (gridsize/2), cellsize)
     val = 0
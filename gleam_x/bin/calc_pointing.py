@@ -5,16 +5,16 @@ __date__ = "10/09/2019"
 
 import sys
 from argparse import ArgumentParser 
-from astropy.io import fits
 from astropy.coordinates import EarthLocation, SkyCoord
 from astropy import units as u
+from gleam_x.utils.metafits import load_metafits
 
 def calc_optimal_ra_dec(metafits):
-    hdu = fits.open(metafits)
-    alt = hdu[0].header["ALTITUDE"]
+    obs = load_metafits(metafits)
+    alt = obs.altitude
     if alt < 55. :
-        az = hdu[0].header["AZIMUTH"]
-        date = hdu[0].header["DATE-OBS"]
+        az = obs.azimuth
+        date = obs.date_obs
         mwa = EarthLocation.of_site("Murchison Widefield Array")
         
         # Empirical testing shows that if the altitude is < 55 degrees, the pointing is actually 8 degrees above where you think it is
@@ -22,7 +22,7 @@ def calc_optimal_ra_dec(metafits):
         newaltaz = SkyCoord(az, alt, frame="altaz", unit=(u.deg, u.deg), obstime=date, location=mwa)
         newradec = newaltaz.transform_to("fk5")
     else:
-        newradec = SkyCoord(hdu[0].header["RA"], hdu[0].header["Dec"], unit = (u.deg, u.deg))
+        newradec = SkyCoord(obs.ra, obs.dec, unit = (u.deg, u.deg))
     return newradec
 
 if __name__ == '__main__':
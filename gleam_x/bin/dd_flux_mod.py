@@ -14,6 +14,8 @@ from astropy.io import fits
 from astropy import wcs
 from argparse import ArgumentParser
 
+from gleam_x.utils.correction_screen import apply_screen, DEFAULT_DECIMATE
+
 parser = ArgumentParser(
     description="Apply direction dependent de-blurring flux correction"
 )
@@ -38,9 +40,16 @@ parser.add_argument(
 parser.add_argument(
     "-s",
     "--stride",
-    default=10000,
+    default=4000000,
+    type=int,
+    help="The number of pixels to process at a time. Whole rows of the mosaic are processed together.",
+)
+parser.add_argument(
+    "-d",
+    "--decimate",
+    default=DEFAULT_DECIMATE,
     type=int,
-    help="The number of pixels to process at a time",
+    help="Spacing in pixels of the grid on which the mosaic WCS is evaluated exactly. Sky positions are interpolated between grid points. Values below 2 evaluate every pixel exactly.",
 )
 
 args = parser.parse_args()
@@ -52,19 +61,6 @@ input_root = input_mosaic.replace(".fits", "")
 mosaic = fits.open(input_mosaic)
 w = wcs.WCS(mosaic[0].header)
 
-# create an array but don't set the values (they are random)
-indexes = np.empty((mosaic[0].data.shape[0] * mosaic[0].data.shape[1], 2), dtype=int)
-# since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-# we do this only once and then recycle it
-idx = np.array([(j, 0) for j in range(mosaic[0].data.shape[1])])
-j = mosaic[0].data.shape[1]
-for i in range(mosaic[0].data.shape[0]):
-    idx[:, 1] = i
-    indexes[i * j : (i + 1) * j] = idx
-
-# put ALL the pixels into our vectorized functions and minimise our overheads
-
 # Read in the PSF
 psf = fits.open(args.psf)
 # Specifically, the blur factor
@@ -72,7 +68,34 @@ blur = psf[0].data[3]
 
 w_psf = wcs.WCS(psf[0].header, naxis=2)
 
+
+def blur_lookup(ra, dec):
+    """Blur factor of the PSF map pixel containing each position"""
+    k, l = w_psf.wcs_world2pix(ra, dec, 1)
+
+    k_int = np.floor(k).astype(int)
+    k_mask = (k_int >= 0) & (k_int <= 360)
+    k_int[~k_mask] = 0
+
+    l_int = np.floor(l).astype(int)
+    l_mask = (l_int >= 0) & (l_int <= 180)
+    l_int[~l_mask] = 0
+
+    return blur[l_int, k_int]
+
+
 if args.old_method:
+    # create an array but don't set the values (they are random)
+    indexes = np.empty((mosaic[0].data.shape[0] * mosaic[0].data.shape[1], 2), dtype=int)
+    # since I know exactly what the index array needs to look like I can construct
+    # it faster than list comprehension would allow
+    # we do this only once and then recycle it
+    idx = np.array([(j, 0) for j in range(mosaic[0].data.shape[1])])
+    j = mosaic[0].data.shape[1]
+    for i in range(mosaic[0].data.shape[0]):
+        idx[:, 1] = i
+        indexes[i * j : (i + 1) * j] = idx
+
     # Apply the blur correction
     ra, dec = w.wcs_pix2world(indexes, 1).transpose()
     k, l = w_psf.wcs_world2pix(ra, dec, 1)
@@ -82,30 +105,18 @@ if args.old_method:
     l_int = [x if (x >= 0) and (x <= 180) else 0 for x in l_int]
     blur_tmp = blur[l_int, k_int]
     blur_corr = blur_tmp.reshape(mosaic[0].data.shape[0], mosaic[0].data.shape[1])
-else:
-    stride = args.stride
-    count = 0
-    blur_tmp = np.zeros(len(indexes))
-
-    while count * stride < len(indexes):
-        s = slice(count * stride, (count + 1) * stride)
-        ra, dec = w.wcs_pix2world(indexes[s], 1).transpose()
-        k, l = w_psf.wcs_world2pix(ra, dec, 1)
 
-        # Testing this suggests it is 100x+ faster.
-        k_int = np.floor(k).astype(int)
-        k_mask = (k_int >= 0) & (k_int <= 360)
-        k_int[~k_mask] = 0
-
-        l_int = np.floor(l).astype(int)
-        l_mask = (l_int >= 0) & (l_int <= 180)
-        l_int[~l_mask] = 0
-
-        blur_tmp[s] = blur[l_int, k_int]
-
-        count += 1
-
-    blur_corr = blur_tmp.reshape(mosaic[0].data.shape)
+    mosaic[0].data *= blur_corr
+else:
+    # The mosaic is corrected in place a block of rows at a time, evaluating
+    # the mosaic WCS on a decimated grid
+    apply_screen(
+        mosaic[0].data,
+        blur_lookup,
+        w.celestial,
+        decimate=args.decimate,
+        origin=1,
+        tile_pixels=args.stride,
+    )
 
-mosaic[0].data *= blur_corr
 mosaic.writeto(args.output, overwrite=True)
@@ -8,11 +8,10 @@ from ast import parse
 from gzip import READ
 from http.client import NON_AUTHORITATIVE_INFORMATION
 import os
+from multiprocessing import Pool
 from argparse import ArgumentParser
-from astropy.coordinates import SkyCoord, search_around_sky
 from astropy.io import fits
 from matplotlib import pyplot as plt
-import astropy.units as u
 import numpy as np
 import logging 
 from matplotlib import rcParams
@@ -21,6 +20,8 @@ import matplotlib.pyplot as plt
 import numpy.ma as ma
 from astropy.table import Table, Column
 
+from gleam_x.utils.catalogue_index import open_index
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(module)s:%(levelname)s:%(lineno)d %(message)s")
 logger.setLevel(logging.INFO)
@@ -41,6 +42,15 @@ plt.rcParams["ytick.direction"] = 'in'
 plt.rcParams["xtick.major.pad"] = 5.
 plt.rcParams["figure.figsize"] = [10., 4.5]
 
+# Per-obsid quality metrics, and the modification times of the rms image, component
+# catalogue and io check catalogue they were derived from
+METRIC_COLUMNS = ["rms", "int_over_peak", "std_intoverpeak", "shape", "std_shape"]
+COUNT_COLUMNS = ["num_srcs_precut", "num_srcs_postcut"]
+MTIME_COLUMNS = ["rms_mtime", "cat_mtime", "io_mtime"]
+
+# Index of the reference catalogue, opened in each worker by init_reference
+_ref_index = None
+
 def read_obsids(filename):
 
     try: 
@@ -72,7 +82,299 @@ def remove_missing(obsids_chan, extra = ""):
     return obsids_chan, missing_mask 
 
 
-def cut_high_rms(obsids, rms_thresh, extra = [""], ):
+def obsid_files(project, obsid, extra=""):
+    """Paths to the rms image, component catalogue and io check catalogue of an obsid"""
+    prefix = f"{project}/{obsid:10.0f}/{obsid:10.0f}"
+    return (
+        f"{prefix}_deep-MFS-image-pb_warp_rms{extra}.fits",
+        f"{prefix}_deep-MFS-image-pb_warp_comp{extra}.fits",
+        f"{prefix}_iocheck_comp{extra}.csv",
+    )
+
+
+def file_mtime(path):
+    """Modification time of a file, or -1 if it does not exist"""
+    return float(os.path.getmtime(path)) if os.path.exists(path) else -1.
+
+
+def init_reference(refcat):
+    """Open the index of the reference catalogue once per worker process"""
+    global _ref_index
+    _ref_index = None if refcat is None else open_index(refcat)
+
+
+def central_rms(rmsfile):
+    """RMS in mJy at the central pixel of an rms image"""
+    hdu = fits.open(rmsfile)
+    data = hdu[0].data
+    rms = 1.e3*float(data[int(data.shape[0]/2), int(data.shape[1]/2)])
+    hdu.close()
+    return rms
+
+
+def _as_float(value):
+    return float(ma.filled(value, np.nan))
+
+
+def io_sources(catfile, savefile):
+    """Int/peak and shape of the bright, isolated and unresolved sources of an obsid. The
+    selected sources are saved in the io check catalogue, which is reused while it is
+    newer than the component catalogue.
+
+    Args:
+        catfile (str): Component catalogue of the obsid
+        savefile (str): io check catalogue of the obsid
+
+    Returns:
+        tuple[numpy.ma.MaskedArray, numpy.ma.MaskedArray]: int/peak and shape of each crossmatched
+        source, masked for those that failed the cuts. None if there is no catalogue.
+    """
+    if os.path.exists(savefile) and file_mtime(savefile) >= file_mtime(catfile):
+        cat_xm = Table.read(savefile, format="csv")
+        int_over_peak_obs = ma.array(cat_xm["int_flux"]/cat_xm["peak_flux"])
+        shape_obs = ma.array((cat_xm["a"]*cat_xm["b"])/(cat_xm["psf_a"]*cat_xm["psf_b"]))
+        srcs = ma.array(cat_xm["io_srcs"])
+        bad_srcs_mask = ma.masked_values(srcs, 0.).mask
+        int_over_peak_obs[bad_srcs_mask] = ma.masked
+        shape_obs[bad_srcs_mask] = ma.masked
+        return int_over_peak_obs, shape_obs
+
+    if not os.path.exists(catfile):
+        return None
+
+    try: 
+        hdu=fits.open(catfile)
+        temp_cat = hdu[1].data
+    except:
+        hdu_temp = Table.read(catfile, format="votable")
+        hdu_temp.write(catfile, format="fits", overwrite=True)
+        hdu = fits.open(catfile)
+        temp_cat = hdu[1].data
+    save_cat = Table.read(catfile, format="fits")
+    uuid_save = save_cat["uuid"]
+
+    try:
+        idx1 = crossmatch_cats(temp_cat, _ref_index)
+        cat_xm = temp_cat[idx1]
+    finally:
+        hdu.close()
+
+    int_over_peak_obs = ma.array(cat_xm["int_flux"]/cat_xm["peak_flux"])
+    err_int_rms_obs = ma.array(cat_xm["err_int_flux"]/cat_xm["local_rms"])
+    shape_obs = ma.array((cat_xm["a"]*cat_xm["b"])/(cat_xm["psf_a"]*cat_xm["psf_b"]))
+    background_obs = ma.array(cat_xm["background"])
+    rms_obs = ma.array(cat_xm["local_rms"])
+
+    intoverpeak_mask = ma.masked_greater(int_over_peak_obs,2).mask
+    err_int_rms_mask = ma.masked_greater(err_int_rms_obs,2).mask
+    background_cut = ma.masked_greater(background_obs,np.nanmean(background_obs.data)+np.nanstd(background_obs.data)).mask
+    rms_cut = ma.masked_greater(rms_obs,np.nanmean(rms_obs.data)+np.nanstd(rms_obs.data)).mask
+    bad_srcs_mask = intoverpeak_mask | err_int_rms_mask | background_cut | rms_cut
+
+    int_over_peak_obs[bad_srcs_mask] = ma.masked
+    shape_obs[bad_srcs_mask] = ma.masked
+
+    good_uuids = np.asarray(cat_xm["uuid"])[~np.asarray(ma.getmaskarray(int_over_peak_obs))]
+    srcs = np.isin(np.asarray(uuid_save), good_uuids).astype(float)
+    if "io_srcs" in save_cat.colnames:
+        save_cat.replace_column("io_srcs", srcs)
+    else:
+        save_cat.add_column(Column(name="io_srcs", data=srcs))
+    save_cat.write(savefile,format="csv",overwrite=True)
+
+    return int_over_peak_obs, shape_obs
+
+
+def obsid_metrics(obsid, project, extra="", plot=False, color="C6", io_check=True):
+    """Extract the quality metrics of a single obsid. Run in a worker process, with the
+    reference catalogue set up by ``init_reference``.
+
+    Args:
+        obsid (float): Obsid to assess
+        project (str): Project directory containing the obsid folders
+
+    Keyword Args:
+        extra (str): Suffix of the image and catalogue names (default: '')
+        plot (bool): Plot int/peak against shape for the obsid (default: False)
+        color (str): Colour of the plotted points (default: 'C6')
+        io_check (bool): Crossmatch the catalogue for the io metrics. Otherwise only the central
+        rms is read and the status is 'rms_only' (default: True)
+
+    Returns:
+        dict: The metrics of the obsid, the status of the io check, and the modification
+        times of the files they were derived from
+    """
+    rmsfile, catfile, savefile = obsid_files(project, obsid, extra)
+
+    metrics = {"obsid": int(obsid), "extra": extra, "status": "ok"}
+    metrics.update({col: np.nan for col in METRIC_COLUMNS})
+    metrics.update({col: -1 for col in COUNT_COLUMNS})
+
+    if os.path.exists(rmsfile):
+        metrics["rms"] = central_rms(rmsfile)
+
+    if not io_check:
+        metrics["status"] = "rms_only"
+        metrics.update(zip(MTIME_COLUMNS, map(file_mtime, (rmsfile, catfile, savefile))))
+        return metrics
+
+    try:
+        sources = io_sources(catfile, savefile)
+    except Exception:
+        logger.warning(f"Flagging {obsid:10.0f} for too few srcs")
+        metrics["status"] = "few_xm"
+        sources = False
+
+    if sources is None:
+        logger.warning(f"Found missing obsid while checking src quality, make sure ran check for missing earlier") 
+        metrics["status"] = "missing"
+    elif sources is not False:
+        int_over_peak_obs, shape_obs = sources
+        metrics["num_srcs_precut"] = len(int_over_peak_obs.data)
+        try: 
+            metrics["int_over_peak"] = _as_float(np.nanmean(int_over_peak_obs.compressed()))
+            metrics["std_intoverpeak"] = _as_float(np.nanstd(int_over_peak_obs.compressed()))
+            metrics["shape"] = _as_float(np.nanmean(shape_obs))
+            metrics["std_shape"] = _as_float(np.nanstd(shape_obs.compressed()))
+        except: 
+            logger.warning(f"Couldn't calculate mean or std of sources in obsid: {obsid:10.0f}, flagging!")
+            metrics["status"] = "no_stats"
+        else:
+            if plot:
+                plt_io_obsid(int_over_peak_obs.compressed(), shape_obs.compressed(), f"{obsid:10.0f}", color=color, project=project)
+
+            metrics["num_srcs_postcut"] = len(int_over_peak_obs.compressed())
+            if metrics["num_srcs_postcut"]<100:
+                logger.warning(f"Only {metrics['num_srcs_postcut']} srcs in field: flagging {obsid:10.0f}")
+                metrics["status"] = "few_srcs"
+
+    metrics.update(zip(MTIME_COLUMNS, map(file_mtime, (rmsfile, catfile, savefile))))
+
+    return metrics
+
+
+def is_current(record, project):
+    """Whether cached metrics were derived from the current versions of the obsid's files"""
+    paths = obsid_files(project, record["obsid"], record["extra"])
+    return all(
+        np.isclose(record[col], file_mtime(path), rtol=0, atol=1e-3)
+        for col, path in zip(MTIME_COLUMNS, paths)
+    )
+
+
+def read_metrics_cache(cache, ref_mtime):
+    """Read the per-obsid metrics saved by an earlier run
+
+    Args:
+        cache (str): FITS table of cached metrics
+        ref_mtime (float): Modification time of the reference catalogue. Cached metrics made against
+        a different version of the reference catalogue are discarded.
+
+    Returns:
+        dict: Metrics of each obsid, keyed by (obsid, extra)
+    """
+    if not os.path.exists(cache):
+        return {}
+
+    try:
+        tab = Table.read(cache)
+    except (OSError, ValueError):
+        logger.warning(f"Could not read metrics cache {cache}, recomputing all obsids")
+        return {}
+
+    if not np.isclose(tab.meta.get("REFMTIME", -2.), ref_mtime, rtol=0, atol=1e-3):
+        logger.debug(f"Reference catalogue has changed since {cache} was made, recomputing all obsids")
+        return {}
+
+    # Empty strings are read back as masked
+    for col in ("extra", "status"):
+        if hasattr(tab[col], "filled"):
+            tab[col] = tab[col].filled("")
+
+    records = {}
+    for row in tab:
+        record = {col: row[col] for col in tab.colnames}
+        record["obsid"] = int(record["obsid"])
+        record["extra"] = str(record["extra"]).strip()
+        record["status"] = str(record["status"]).strip()
+        records[(record["obsid"], record["extra"])] = record
+
+    return records
+
+
+def write_metrics_cache(cache, records, ref_mtime):
+    """Save per-obsid metrics, as produced by ``obsid_metrics``, to a FITS table"""
+    columns = ["obsid", "extra", "status"] + METRIC_COLUMNS + COUNT_COLUMNS + MTIME_COLUMNS
+    rows = [records[key] for key in sorted(records)]
+    tab = Table(rows=[[r[col] for col in columns] for r in rows], names=columns)
+    tab.meta["REFMTIME"] = ref_mtime
+    tab.write(cache, overwrite=True)
+
+
+def collect_metrics(obsids, refcat, project, extra=[""], colors=None, io_check=True, cache=None, ref_mtime=-1., cores=1, plot=False, refresh=False):
+    """Metrics of every unflagged obsid. Obsids whose files have not changed since the
+    metrics cache was written are taken from the cache, and the rest are extracted
+    across a pool of processes, so re-running with different thresholds only
+    re-applies the cuts.
+
+    Args:
+        obsids (list[numpy.ma.MaskedArray]): Obsids of each channel
+        refcat (str): Reference catalogue with RAJ2000 and DEJ2000 columns, or None
+        project (str): Project directory containing the obsid folders
+
+    Keyword Args:
+        extra (list[str]): Suffix of the image and catalogue names for each channel (default: [''])
+        colors (list): Colour of the plotted points of each channel. 'C6' for every channel if None (default: None)
+        io_check (bool): Extract the io metrics, otherwise only the central rms (default: True)
+        cache (str): FITS table used to cache the metrics. If None nothing is cached (default: None)
+        ref_mtime (float): Modification time of the reference catalogue (default: -1)
+        cores (int): Number of processes to use (default: 1)
+        plot (bool): Plot int/peak against shape for each obsid. Cached metrics are not used when plotting (default: False)
+        refresh (bool): Extract the metrics of every obsid, ignoring the cache (default: False)
+
+    Returns:
+        dict: Metrics of each obsid, keyed by (obsid, extra)
+    """
+    cached = read_metrics_cache(cache, ref_mtime) if cache is not None else {}
+
+    metrics = {}
+    jobs = []
+    for i in range(len(obsids)):
+        for obsid in ma.compressed(obsids[i]):
+            key = (int(obsid), extra[i])
+            record = cached.get(key)
+            usable = record is not None and not (io_check and record["status"] == "rms_only")
+            if not (plot or refresh) and usable and is_current(record, project):
+                metrics[key] = record
+            else:
+                color = "C6" if colors is None else colors[i]
+                jobs.append((obsid, project, extra[i], plot, color, io_check))
+
+    logger.debug(f"Metrics cached for {len(metrics)} obsids, extracting for {len(jobs)}")
+
+    # The index is built once here, so the workers only need to memory-map it
+    if io_check and refcat is not None and len(jobs) > 0:
+        open_index(refcat)
+    initargs = (refcat if io_check else None,)
+
+    if cores > 1 and len(jobs) > 1:
+        with Pool(min(cores, len(jobs)), initializer=init_reference, initargs=initargs) as pool:
+            results = pool.starmap(obsid_metrics, jobs, chunksize=1)
+    else:
+        init_reference(*initargs)
+        results = [obsid_metrics(*job) for job in jobs]
+
+    for record in results:
+        metrics[(record["obsid"], record["extra"])] = record
+
+    if cache is not None and len(results) > 0:
+        cached.update(metrics)
+        write_metrics_cache(cache, cached, ref_mtime)
+
+    return metrics
+
+
+def cut_high_rms(obsids, rms_thresh, metrics, extra = [""], ):
 
     # TODO: currently hardcoding limit for bad std(rms) per channel!!! FIX!
     # TODO: Hard limit is ok, but doens't work for high dec (particularly +20, need to find new average)
@@ -88,11 +390,9 @@ def cut_high_rms(obsids, rms_thresh, extra = [""], ):
         obs = obsids[i]
         for j in range(len(obs)):
             if obs[j] is not ma.masked: 
-                rmsfile = f"{args.project}/{obsids[i][j]:10.0f}/{obsids[i][j]:10.0f}_deep-MFS-image-pb_warp_rms{extra[i]}.fits"
-                if os.path.exists(rmsfile):
-                    hdu = fits.open(rmsfile)
-                    rms_chan[j] = 1.e3*hdu[0].data[int(hdu[0].data.shape[0]/2), int(hdu[0].data.shape[1]/2)] 
-                    hdu.close()
+                record = metrics.get((int(obs[j]), extra[i]))
+                if record is not None and np.isfinite(record["rms"]):
+                    rms_chan[j] = record["rms"]
                 else:
                     logger.warning(f"Found missing obsid while checking RMS, make sure ran check for missing earlier: {obsids[i][j]:10.0f}")
 
@@ -116,22 +416,13 @@ def cut_high_rms(obsids, rms_thresh, extra = [""], ):
 
 def crossmatch_cats(
     input_cat,
-    ref_cat,
+    ref_index,
     sep=1,
 ):
-
-
-    ref_cat_skycoords = SkyCoord(ref_cat.RAJ2000,ref_cat.DEJ2000, frame='fk5',unit=u.deg)
-    input_cat_skycoords = SkyCoord(input_cat.ra, input_cat.dec, frame='fk5', unit=u.deg)
-    try: 
-        idx1,idx2,sep2d,dist3d=search_around_sky(input_cat_skycoords,ref_cat_skycoords,sep*u.arcmin)
-    except: 
-        logger.debug(f"Catalogue has missing or NaN ra/dec. Cutting.")
-        clean_mask = (~np.isnan(input_cat.ra) & ~np.isnan(input_cat.dec))
-        input_cat_clean = input_cat[clean_mask]
-        input_cat_skycoords = SkyCoord(input_cat_clean.ra, input_cat_clean.dec, frame='fk5', unit=u.deg)
-        idx1,idx2,sep2d,dist3d=search_around_sky(input_cat_skycoords,ref_cat_skycoords,sep*u.arcmin)
-    
+    """Sources of a catalogue with a reference source within sep arcminutes, keeping one
+    source per reference source. Positions that are NaN are never matched.
+    """
+    idx1, idx2, sep2d = ref_index.search_around(input_cat.ra, input_cat.dec, sep*60.)
     
     iso_nvss_sumss = idx1[np.unique(idx2,return_index=True)[1]]
     idx1_iso = np.unique(iso_nvss_sumss)
@@ -148,156 +439,36 @@ def crossmatch_cats(
         return idx1_iso
 
 
-def check_io(obsids, missing_mask, xm_cat, extra = [""]):
+def check_io(obsids, missing_mask, metrics, extra = [""]):
     int_over_peak = []
     std_intoverpeak = []
     shape = []
     std_shape = []
     for i in range(len(obsids)):
         extra_chan = extra[i]
-        # logger.debug(f"The extension for comparison: {extra_chan}")
-        # logger.debug(f"Checking IO for channel: {chan[i]}")
         obs = ma.array(obsids[i].data, mask=missing_mask[i])
         int_over_peak_chan = ma.array([np.nan]*len(obsids[i].data), mask=missing_mask[i])
         std_intoverpeak_chan = ma.array([np.nan]*len(obsids[i].data), mask=missing_mask[i])
         shape_chan = ma.array([np.nan]*len(obsids[i].data), mask=missing_mask[i])
         std_shape_chan = ma.array([np.nan]*len(obsids[i].data), mask=missing_mask[i])
         for j in range(len(obs)):
-            if obs[j] is not ma.masked: 
-                catfile = f"{args.project}/{obs[j]:10.0f}/{obs[j]:10.0f}_deep-MFS-image-pb_warp_comp{extra_chan}.fits"
-                # catfile = f"{args.project}/{obs[j]:10.0f}/{obs[j]:10.0f}_deep-MFS-image-pb_warp_comp{extra_chan}.fits"
-                # logger.debug(f"{catfile}")
-                savefile = f"{args.project}/{obs[j]:10.0f}/{obs[j]:10.0f}_iocheck_comp{extra_chan}.csv"
-                try: 
-                    cat_xm = Table.read(savefile, format="csv")
-                    int_over_peak_obs = ma.array(cat_xm["int_flux"]/cat_xm["peak_flux"])
-                    shape_obs = ma.array((cat_xm["a"]*cat_xm["b"])/(cat_xm["psf_a"]*cat_xm["psf_b"]))
-                    srcs = ma.array(cat_xm["io_srcs"])
-                    bad_srcs_mask = ma.masked_values(srcs, 0.).mask
-                    int_over_peak_obs[bad_srcs_mask] = ma.masked
-                    shape_obs[bad_srcs_mask] = ma.masked
-                    num_srcs_precut = len(int_over_peak_obs.data)
-                except FileNotFoundError:
-                    if os.path.exists(catfile):
-                        try: 
-                            hdu=fits.open(catfile)
-                            temp_cat = hdu[1].data
-                        except:
-                            hdu_temp = Table.read(catfile, format="votable")
-                            hdu_temp.write(catfile, format="fits", overwrite=True)
-                            hdu = fits.open(catfile)
-                            temp_cat = hdu[1].data
-                        save_cat = Table.read(catfile, format="fits")
-                        uuid_save = save_cat["uuid"]
-                        hdu.close()
-                        
-                    else:
-                        logger.warning(f"Found missing obsid while checking src quality, make sure ran check for missing earlier") 
-                        obs[j] = ma.masked
-                        int_over_peak_chan[j] = ma.masked
-                        std_intoverpeak_chan[j] = ma.masked
-                        shape_chan[j] = ma.masked
-                        std_shape_chan[j] = ma.masked
-                        continue
-
-                    try:
-                        idx1 = crossmatch_cats(temp_cat, xm_cat)
-                        cat_xm = temp_cat[idx1]
-                    except Exception: 
-                        logger.warning(f"Flagging {obs[j]:10.0f} for too few srcs")
-                        int_over_peak_chan[j] = ma.masked
-                        std_intoverpeak_chan[j] = ma.masked
-                        shape_chan[j] = ma.masked
-                        std_shape_chan[j] = ma.masked
-                        obs[j] = ma.masked
-                        continue 
-                    except: 
-                        logger.warning(f"Couldnt do xm!!! Flagging {obs[j]:10.0f}")
-                        int_over_peak_chan[j] = ma.masked
-                        std_intoverpeak_chan[j] = ma.masked
-                        shape_chan[j] = ma.masked
-                        std_shape_chan[j] = ma.masked
-                        obs[j] = ma.masked
-                        continue 
-
-                    int_over_peak_obs = ma.array(cat_xm["int_flux"]/cat_xm["peak_flux"])
-                    err_int_rms_obs = ma.array(cat_xm["err_int_flux"]/cat_xm["local_rms"])
-                    snr_obs = ma.array(cat_xm["int_flux"]/cat_xm["local_rms"])
-                    shape_obs = ma.array((cat_xm["a"]*cat_xm["b"])/(cat_xm["psf_a"]*cat_xm["psf_b"]))
-                    uuid_xm = ma.array(cat_xm["uuid"])
-                    num_srcs_precut = len(int_over_peak_obs)
-                    background_obs = ma.array(cat_xm["background"])
-                    rms_obs = ma.array(cat_xm["local_rms"])
-
-                    snr_mask = ma.masked_less(snr_obs,50).mask
-                    intoverpeak_mask = ma.masked_greater(int_over_peak_obs,2).mask
-                    err_int_rms_mask = ma.masked_greater(err_int_rms_obs,2).mask
-                    background_cut = ma.masked_greater(background_obs,np.nanmean(background_obs.data)+np.nanstd(background_obs.data)).mask
-                    rms_cut = ma.masked_greater(rms_obs,np.nanmean(rms_obs.data)+np.nanstd(rms_obs.data)).mask
-                    int_over_peak_obs[intoverpeak_mask] = ma.masked
-                    uuid_xm[intoverpeak_mask] = ma.masked
-                    shape_obs[intoverpeak_mask] = ma.masked
-
-                    shape_obs[err_int_rms_mask] = ma.masked
-                    int_over_peak_obs[err_int_rms_mask] = ma.masked
-                    uuid_xm[err_int_rms_mask] = ma.masked
-
-                    shape_obs[background_cut] = ma.masked
-                    int_over_peak_obs[background_cut] = ma.masked
-                    uuid_xm[background_cut] = ma.masked
-
-                    shape_obs[rms_cut] = ma.masked
-                    int_over_peak_obs[rms_cut] = ma.masked
-                    uuid_xm[rms_cut] = ma.masked
-                    srcs = np.zeros(len(save_cat))
-                    # srcs[idx1] = 1
-                    good_uuids = uuid_xm.compressed()
-                    for i in range(len(good_uuids)):
-                        if good_uuids[i] in uuid_save:
-                            index = np.where(uuid_save == good_uuids[i])
-                            srcs[index] = 1                
-                    try:
-                        io_srcs = Column(name="io_srcs", data=srcs)
-                        save_cat.add_column(io_srcs)
-                        save_cat.write(savefile,format="csv",overwrite=True)
-                    except: 
-                        # logger.debug(f"Already have cat, overwriting")
-                        save_cat.replace_column("io_srcs", srcs)
-                        save_cat.write(savefile,format="csv",overwrite=True)
-
-
-
-                try: 
-                    int_over_peak_chan[j] = np.nanmean(int_over_peak_obs.compressed())
-                    std_intoverpeak_chan[j] = np.nanstd(int_over_peak_obs.compressed())
-                    shape_chan[j] = np.nanmean(shape_obs)
-                    std_shape_chan[j] = np.nanstd(shape_obs.compressed())
-                except: 
-                    logger.warning(f"Couldn't calculate mean or std of sources in obsid: {obs[j]:10.0f}, flagging!")
-                    int_over_peak_chan[j] = ma.masked
-                    std_intoverpeak_chan[j] = ma.masked
-                    shape_chan[j] = ma.masked
-                    std_shape_chan[j] = ma.masked
-                    continue
-
-                if args.plot == "all":
-                    plt_io_obsid(int_over_peak_obs.compressed(), shape_obs.compressed(), f"{obs[j]:10.0f}", color=colors[i+3])
-                
-                num_srcs_postcut = len(int_over_peak_obs.compressed())
-                frac_srcs_flagged = int((num_srcs_postcut/num_srcs_precut)*100)
-                if num_srcs_postcut<100:
-                    logger.warning(f"Only {num_srcs_postcut} srcs in field: flagging {obs[j]:10.0f}")
-                    int_over_peak_chan[j] = ma.masked
-                    std_intoverpeak_chan[j] = ma.masked
-                    shape_chan[j] = ma.masked
-                    std_shape_chan[j] = ma.masked
-            else: 
-                int_over_peak_chan[j] = ma.masked
-                std_intoverpeak_chan[j] = ma.masked
-                shape_chan[j] = ma.masked
-                std_shape_chan[j] = ma.masked
-
-
+            record = None if obs[j] is ma.masked else metrics.get((int(obs[j]), extra_chan))
+            status = "missing" if record is None else record["status"]
+            if status == "ok":
+                int_over_peak_chan[j] = record["int_over_peak"]
+                std_intoverpeak_chan[j] = record["std_intoverpeak"]
+                shape_chan[j] = record["shape"]
+                std_shape_chan[j] = record["std_shape"]
+                continue
+
+            # Obsids without a catalogue or with too few crossmatched sources are dropped
+            # entirely, the others are only excluded from the io statistics
+            if obs[j] is not ma.masked and status in ("missing", "few_xm"):
+                obs[j] = ma.masked
+            int_over_peak_chan[j] = ma.masked
+            std_intoverpeak_chan[j] = ma.masked
+            shape_chan[j] = ma.masked
+            std_shape_chan[j] = ma.masked
 
         int_over_peak.append(int_over_peak_chan)
         shape.append(shape_chan)
@@ -312,8 +483,10 @@ def plt_io_obsid(
     shape,
     obsid,
     ext="png",
-    color="C6"
+    color="C6",
+    project=None,
 ):
+    project = args.project if project is None else project
 
     # Just plotting the shape compared to int/flux 
     fig = plt.figure(dpi=plt.rcParams['figure.dpi']*4.0)
@@ -326,7 +499,7 @@ def plt_io_obsid(
     ax.set_ylabel("log(shape) (a/b)")
     fig.suptitle(f"{obsid}: Int/peak vs shape")
 
-    plt.savefig(f"{args.project}/{obsid}/{obsid}_intoverpeak_shape.{ext}", bbox_inches='tight')
+    plt.savefig(f"{project}/{obsid}/{obsid}_intoverpeak_shape.{ext}", bbox_inches='tight')
     plt.close(fig)
     return 
 
@@ -546,6 +719,25 @@ if __name__ == "__main__":
 
 
 
+    parser.add_argument(
+        '--cores',
+        type=int,
+        default=1,
+        help="Number of processes used to extract the metrics of each obsid (default=1)"
+    )
+    parser.add_argument(
+        '--metrics_cache',
+        type=str,
+        default=None,
+        help="FITS table caching the metrics of each obsid. Obsids whose images and catalogues are unchanged are not re-read, so re-running with new thresholds only re-applies the cuts. (default=$project/$drift_iocheck_metrics.fits)"
+    )
+    parser.add_argument(
+        '--refresh_metrics',
+        action='store_true',
+        default=False,
+        help="Ignore the metrics cache and re-extract the metrics of every obsid (default=False)"
+    )
+
     parser.add_argument(
         '-v',
         '--verbose',
@@ -568,15 +760,12 @@ if __name__ == "__main__":
     rms_thresh = args.rms_thresh 
 
     ref_cat_file = f"{args.refcat}"
+    ref_mtime = file_mtime(ref_cat_file)
     if os.path.exists(ref_cat_file):
-        do_xm = True
-        if os.path.exists(ref_cat_file):
-            hdu = fits.open(ref_cat_file)
-            do_xm = hdu[1].data
-            hdu.close()
+        do_xm = ref_cat_file
     else:
         logger.warning(f"Can't find reference GGSM catalogue for xm! ")
-        do_xm = False
+        do_xm = None
 
     
     # if args.comparison == True: 
@@ -673,9 +862,29 @@ if __name__ == "__main__":
             np.savetxt(obs_txtfile[i].replace(".txt", "_missing_obsids.txt"), chan_missing_obsids.compressed(), fmt="%10.0f")
 
 
+    # Extracting the metrics of each obsid, reusing those cached by earlier runs
+    metrics = {}
+    if args.flag_high_rms is True or args.flag_bad_io is True:
+        metrics_cache = args.metrics_cache
+        if metrics_cache is None:
+            metrics_cache = f"{args.project}/{drift}_iocheck_metrics.fits"
+        metrics = collect_metrics(
+            obsids,
+            do_xm,
+            args.project,
+            extra=extension,
+            colors=[colors[i+3] for i in range(len(chans))],
+            io_check=args.flag_bad_io is True,
+            cache=metrics_cache,
+            ref_mtime=ref_mtime,
+            cores=args.cores,
+            plot=args.plot == "all",
+            refresh=args.refresh_metrics,
+        )
+
     # Cutting obsids with high RMS in MFS image 
     if args.flag_high_rms is True: 
-        rms_mask = cut_high_rms(obsids, rms_thresh=rms_thresh, extra=extension)
+        rms_mask = cut_high_rms(obsids, rms_thresh, metrics, extra=extension)
         for i in range(len(chans)):
             logger.warning(f"Number of obsids flagged for bad rms for {chans[i]}: {ma.count_masked(rms_mask[i])}")
     else: 
@@ -685,7 +894,7 @@ if __name__ == "__main__":
     # note: first cuts bad srcs, the xm with GGSM to find nice brihgt etc ones before doing the actually assessment 
 
     if args.flag_bad_io is True: 
-        drift_intoverpeak, drift_stdintoverpeak, drift_shape, drift_stdshape = check_io(obsids, missing_mask, do_xm, extra=extension)
+        drift_intoverpeak, drift_stdintoverpeak, drift_shape, drift_stdshape = check_io(obsids, missing_mask, metrics, extra=extension)
         for i in range(len(chans)):
             color = colors[i+3]
             logger.debug(f"Running the io cut on chan {chans[i]}")
@@ -12,68 +12,147 @@ Nov-2014
 """
 
 
+import os
 import numpy as np
 from astropy.io import fits
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
 import sys
 
+# Number of pixels read from the image at a time
+BLOCK_PIXELS = 16000000
+# Keywords of scaled images, which astropy can not memory-map
+SCALE_KEYWORDS = ("BSCALE", "BZERO", "BLANK")
 
-def trim(fin, fout):
-    """Searches for the four directions (top, bottom, left, right) for the first
-    valid row or column, where valid means not made up entirely of NaNs. Essentially
-    performs a crop to remove any row or column made up entirely of nan pixels. 
+
+def row_blocks(shape, block_pixels=BLOCK_PIXELS):
+    """Divide an image into blocks of whole rows
 
     Arguments:
-        fin (str) -- Path to the input fits file with dimensions to crop
-        fout (str) -- Path to new output fits file with cropped dimensions
+        shape (tuple[int,int]) -- Shape of the image as (ny, nx)
+
+    Keyword Arguments:
+        block_pixels (int) -- Approximate number of pixels in each block (default: 16000000)
+
+    Yields:
+        slice -- Rows of each block
     """
-    hdulist = fits.open(fin)
-    data = hdulist[0].data
-    # turn pixels that are identically zero, into masked pixels
-    data[np.where(data == 0.0)] = np.nan
+    ny, nx = shape
+    nrows = max(1, block_pixels // max(nx, 1))
+    for start in range(0, ny, nrows):
+        yield slice(start, min(start + nrows, ny))
+
 
-    print(f"Input image shape: {data.shape}")
+def masked_block(data, rows):
+    """Copy of a block of rows with pixels that are identically zero set to NaN"""
+    block = np.array(data[rows])
+    block[block == 0.0] = np.nan
+    return block
 
-    imin, imax = 0, data.shape[1] - 1
-    jmin, jmax = 0, data.shape[0] - 1
 
-    # select [ij]min/max to exclude rows/columns that are all zero
+def valid_rows_cols(data, block_pixels=BLOCK_PIXELS):
+    """Find which rows and columns contain at least one valid pixel, i.e. one that is
+    neither NaN nor identically zero, in a single pass over the image
 
-    for i in range(0, imax):
-        imin = i
-        if not np.all(np.isnan(data[:, i])):
-            break
-    print(f"imin: {imin}")
+    Arguments:
+        data (numpy.ndarray) -- Two dimensional (possibly memory-mapped) image
 
-    for i in range(imax, imin, -1):
-        imax = i
-        if not np.all(np.isnan(data[:, i])):
-            break
-    print(f"imax: {imax}")
+    Keyword Arguments:
+        block_pixels (int) -- Approximate number of pixels read at a time (default: 16000000)
 
-    for j in range(0, jmax):
-        jmin = j
-        if not np.all(np.isnan(data[j, :])):
-            break
-    print(f"jmin: {jmin}")
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray] -- Boolean validity of each row and each column
+    """
+    row_valid = np.zeros(data.shape[0], dtype=bool)
+    col_valid = np.zeros(data.shape[1], dtype=bool)
+    for rows in row_blocks(data.shape, block_pixels=block_pixels):
+        valid = ~np.isnan(masked_block(data, rows))
+        row_valid[rows] = valid.any(axis=1)
+        col_valid |= valid.any(axis=0)
 
-    for j in range(jmax, jmin, -1):
-        jmax = j
-        if not np.all(np.isnan(data[j, :])):
-            break
+    return row_valid, col_valid
 
-    print(f"jmax: {jmax}")
 
-    # End index is not inclusive
-    hdulist[0].data = data[jmin : (jmax + 1), imin : (imax + 1)]
+def valid_range(valid):
+    """First and last index to keep along an axis, given the validity of each row or
+    column. Matches scanning inwards from either edge for the first valid entry.
 
-    print(f"Output data shape: {hdulist[0].data.shape}")
+    Arguments:
+        valid (numpy.ndarray) -- Boolean validity along the axis
+
+    Returns:
+        tuple[int, int] -- The first and last (inclusive) index to keep
+    """
+    n = len(valid)
+    first = np.flatnonzero(valid[: n - 1])
+    lo = int(first[0]) if len(first) > 0 else max(n - 2, 0)
 
-    # recenter the image so the coordinates are correct.
-    hdulist[0].header["CRPIX1"] -= imin
-    hdulist[0].header["CRPIX2"] -= jmin
+    last = np.flatnonzero(valid[lo + 1 :])
+    hi = lo + 1 + int(last[-1]) if len(last) > 0 else min(lo + 1, n - 1)
+
+    return lo, hi
+
+
+def trim(fin, fout, block_pixels=BLOCK_PIXELS):
+    """Searches for the four directions (top, bottom, left, right) for the first
+    valid row or column, where valid means not made up entirely of NaNs. Essentially
+    performs a crop to remove any row or column made up entirely of nan pixels. 
+
+    The input image is memory-mapped and scanned once in blocks of rows, and only
+    the cropped section is written, block by block, so the full image is never held
+    in memory. Scaled images (BSCALE, BZERO or BLANK) can not be memory-mapped, and
+    are read into memory instead.
+
+    Arguments:
+        fin (str) -- Path to the input fits file with dimensions to crop
+        fout (str) -- Path to new output fits file with cropped dimensions
+
+    Keyword Arguments:
+        block_pixels (int) -- Approximate number of pixels read at a time (default: 16000000)
+    """
+    memmap = not any(key in fits.getheader(fin) for key in SCALE_KEYWORDS)
+    with fits.open(fin, memmap=memmap) as hdulist:
+        data = hdulist[0].data
+
+        print(f"Input image shape: {data.shape}")
+
+        # select [ij]min/max to exclude rows/columns that are all zero or nan
+        row_valid, col_valid = valid_rows_cols(data, block_pixels=block_pixels)
+        imin, imax = valid_range(col_valid)
+        print(f"imin: {imin}")
+        print(f"imax: {imax}")
+        jmin, jmax = valid_range(row_valid)
+        print(f"jmin: {jmin}")
+        print(f"jmax: {jmax}")
+
+        # End index is not inclusive
+        section = data[jmin : (jmax + 1), imin : (imax + 1)]
+        print(f"Output data shape: {section.shape}")
+
+        header = hdulist[0].header.copy()
+        header["BITPIX"] = DTYPE2BITPIX[section.dtype.name]
+        header["NAXIS1"] = section.shape[1]
+        header["NAXIS2"] = section.shape[0]
+        # data are written already scaled, with blank pixels as NaN
+        for key in SCALE_KEYWORDS:
+            header.remove(key, ignore_missing=True)
+
+        # recenter the image so the coordinates are correct.
+        header["CRPIX1"] -= imin
+        header["CRPIX2"] -= jmin
+
+        # save, StreamingHDU appends to an existing file so it is removed first
+        if os.path.exists(fout):
+            os.remove(fout)
+        out = fits.StreamingHDU(fout, header)
+        try:
+            for rows in row_blocks(section.shape, block_pixels=block_pixels):
+                out.write(masked_block(section, rows))
+        finally:
+            out.close()
+
+        for hdu in hdulist[1:]:
+            fits.append(fout, hdu.data, hdu.header)
 
-    # save
-    hdulist.writeto(fout, overwrite=True)
     print("wrote", fout)
 
 
@@ -9,13 +9,12 @@ import astropy.units as u
 
 from argparse import ArgumentParser
 from astropy.wcs import WCS
-from astropy.io import fits
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
-from astropy.time import Time
-from astropy.table import Table
 from mwa_pb_lookup.lookup_beam import beam_lookup_1d as gleamx_beam_lookup
 from gleam_x.bin.beam_value_at_radec import parse_metafits, beam_value
 from gleam_x.db.check_src_fov import check_coords
+from gleam_x.utils.catalogue_index import open_index
+from gleam_x.utils.metafits import load_metafits
 
 # TODO: Move to a proper GLEAM-X location
 # MWA location from CONV2UVFITS/convutils.h
@@ -144,21 +143,23 @@ def ggsm_row_model(row):
     return out
 
 
-def search_ggsm(a_src, ggsm_sky, search_radius):
-    """Search for components around a A-team source and return a mask of components
+def search_ggsm(a_src, ggsm_index, search_radius):
+    """Search for components around a A-team source and return the indices of components
     that are within a specified search_radius
 
     Args:
-        a_src (Source): A source to search around for nearby components
-        ggsm_sky (SkyCoord): Component positions from the GGSM
+        a_src (SkyCoord): A source position to search around for nearby components
+        ggsm_index (CatalogueIndex): Spatial index of the GGSM
         search_radius (units): The search radius to use
 
     Returns:
-        np.ndarray: Boolean mask describing whether GSSM components were near a source position
+        np.ndarray: Indices of the GGSM components near the source position
     """
-    mask = a_src.separation(ggsm_sky) < search_radius
+    matches = ggsm_index.cone(
+        a_src.ra.deg, a_src.dec.deg, search_radius.to(u.arcsecond).value
+    )
 
-    return mask
+    return matches
 
 
 def check_coords_mask(w: WCS, coords: SkyCoord, border_size: int) -> bool:
@@ -437,17 +438,15 @@ def ateam_model_creation(
 
     time, delays, freq, grid = parse_metafits(metafits_file)
 
-    header = fits.open(metafits_file)[0].header
+    obs = load_metafits(metafits_file)
 
     # Mid-point of the observation used for AltAz.
-    gpstime = header["GPSTIME"]
-    start_time = header["DATE-OBS"]
-    duration = header["EXPOSURE"] * u.s
-    obs_time = Time(start_time, format="isot", scale="utc") + 0.5 * duration
+    gpstime = obs.obsid
+    obs_time = obs.mid_time
 
     cenchan = round(freq / 1e6 / 1.28 + 0.5)
 
-    metafits_wcs = create_wcs(header["RA"], header["DEC"], cenchan)
+    metafits_wcs = create_wcs(obs.ra, obs.dec, cenchan)
     no_comps = 0
 
     if source_txt_path is not None and os.path.exists(source_txt_path):
@@ -457,10 +456,7 @@ def ateam_model_creation(
         model_text = "skymodel fileformat 1.1\n"
 
         assert ggsm is not None, "GGSM needs to be set for subtrmodel mode"
-        ggsm_tab = Table.read(ggsm)
-        ggsm_sky = SkyCoord(
-            ggsm_tab["RAJ2000"], ggsm_tab["DEJ2000"], unit=(u.deg, u.deg)
-        )
+        ggsm_index = open_index(ggsm)
     elif mode == "casa":
         model_text = ""
     elif mode in ("casaclean", "wsclean"):
@@ -503,16 +499,16 @@ def ateam_model_creation(
         elif mode == "count":
             no_comps += 1
         elif mode == "subtrmodel":
-            matches = search_ggsm(src.pos, ggsm_sky, search_radius)
-            comps = ggsm_tab[matches]
+            matches = search_ggsm(src.pos, ggsm_index, search_radius)
+            comps = ggsm_index.table(matches)
             no_comps += len(comps)
 
             print(f"{src.name} is going to the model...")
             if apply_beam:
                 print("...Applying primary beam attenuation to the components")
                 comps_response = gleamx_beam_lookup(
-                    ggsm_sky[matches].ra.deg,
-                    ggsm_sky[matches].dec.deg,
+                    ggsm_index.ra[matches],
+                    ggsm_index.dec[matches],
                     grid,
                     time,
                     freq,
@@ -2,7 +2,9 @@
 
 # extra comment
 
+import os
 import argparse
+from multiprocessing import Pool
 
 import numpy as np
 
@@ -10,13 +12,15 @@ from scipy import ndimage  # For lobe finding in the primary beam images
 from scipy.spatial import distance
 
 from astropy.io import fits
-from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz, FK5
 from astropy import units as u
 from astropy.wcs import WCS
 
 from mwa_pb.primary_beam import MWA_Tile_full_EE
 
+from gleam_x.utils.metafits import load_metafits
+from gleam_x.utils.beam_cache import BeamCache
+
 MWA = EarthLocation.from_geodetic(lat=-26.703319*u.deg, 
                                   lon=116.67081*u.deg, 
                                   height=377*u.m)
@@ -118,17 +122,18 @@ class Lobe(object):
 def parse_metafits(metafits):
     """Read in metafits file and return relevant information."""
 
-    m = fits.getheader(metafits)
+    obs = load_metafits(metafits)
 
-    delays = [int(d) for d in m["DELAYS"].split(",")]
-    t = Time(m["DATE-OBS"], format="isot", scale="utc")
-    freq = m["FREQCENT"] * 1.e6  # in Hz
-    pnt = SkyCoord(ra=m["RA"], dec=m["DEC"], unit=(u.deg, u.deg))
+    delays = obs.delays
+    t = obs.start_time
+    freq = obs.freq  # in Hz
+    pnt = obs.pointing
 
     return t, delays, freq, pnt
 
 
-def beam_value(ra, dec, t, delays, freq, interp=True, return_I=False):
+def beam_value(ra, dec, t, delays, freq, interp=True, return_I=False,
+               beam_cache=None, gridnum=None):
     """Get real XX and real YY beam value at given RA and Dec.
 
     Adapted from `beam_value_at_radec.py` by N. Hurley-Walker.
@@ -147,6 +152,12 @@ def beam_value(ra, dec, t, delays, freq, interp=True, return_I=False):
         Frequency at which to get beam value, in Hz.
     interp : bool, optional
         Passed to MWA_Tile_full_EE. [Default True]
+    beam_cache : gleam_x.utils.beam_cache.BeamCache, optional
+        If supplied the beam is interpolated from a cached alt/az grid rather
+        than evaluated with MWA_Tile_full_EE. [Default None]
+    gridnum : int, optional
+        Sweetspot grid number of the delays, used to name the cached beam.
+        [Default None]
 
     Returns
     -------
@@ -170,6 +181,13 @@ def beam_value(ra, dec, t, delays, freq, interp=True, return_I=False):
         ra = np.asarray(ra)
         dec = np.asarray(dec)
 
+    if beam_cache is not None:
+        rX, rY = beam_cache.beam_value(ra, dec, t, delays, freq, gridnum=gridnum)
+        if return_I:
+            return 0.5*(rX + rY)
+        else:
+            return rX, rY
+
     radec = SkyCoord(ra*u.deg, dec*u.deg)
     
     altaz = radec.transform_to(AltAz(obstime=t, location=MWA))
@@ -196,8 +214,188 @@ def beam_value(ra, dec, t, delays, freq, interp=True, return_I=False):
         return rX[0], rY[0]
 
 
+# Pixels evaluated per task handed to the process pool
+BEAM_CHUNK = 250000
+# Rows of the image computed and written at a time
+BEAM_ROWS = 500
+
+# State of the beam evaluation shared with the pool workers
+_beam_worker = {}
+
+
+def _init_beam_worker(header, t, delays, freq, beam_cache, gridnum):
+    """Set up a process to evaluate the beam at pixels of an image."""
+
+    _beam_worker["wcs"] = WCS(fits.Header.fromstring(header)).celestial
+    _beam_worker["t"] = t
+    _beam_worker["delays"] = delays
+    _beam_worker["freq"] = freq
+    _beam_worker["beam_cache"] = beam_cache
+    _beam_worker["gridnum"] = gridnum
+
+
+def _beam_pixels(x, y):
+    """Pseudo-I beam at pixel coordinates of the image set up by _init_beam_worker."""
+
+    r, d = _beam_worker["wcs"].all_pix2world(x, y, 0)
+    return beam_value(r, d, _beam_worker["t"], _beam_worker["delays"],
+                      _beam_worker["freq"], return_I=True,
+                      beam_cache=_beam_worker["beam_cache"],
+                      gridnum=_beam_worker["gridnum"])
+
+
+class BeamImager(object):
+    """Evaluate the pseudo-I beam over the pixels of an image, optionally in 
+    parallel and optionally interpolating from a coarse grid of pixels.
+
+    With a coarse grid the beam is evaluated exactly on every `coarse`-th row 
+    and column and upsampled with a bicubic spline. The spline is checked 
+    against the exact beam at four points inside every coarse cell, and cells that 
+    differ by more than `tolerance`, or that are near pixels without a valid 
+    sky position, are evaluated exactly.
+    """
+
+
+    def __init__(self, shape, pool=None, coarse=None, tolerance=1e-3):
+        """
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the image as (ny, nx).
+        pool : multiprocessing.Pool, optional
+            Pool of workers set up with _init_beam_worker. If None, the beam is
+            evaluated in this process, which must have been set up with 
+            _init_beam_worker. [Default None]
+        coarse : int, optional
+            Spacing in pixels of the coarse grid. [Default None, no coarse grid]
+        tolerance : float, optional
+            Largest acceptable difference of the interpolated beam. [Default 1e-3]
+        """
+
+        self.shape = shape
+        self.pool = pool
+        self.spline = None
+
+        ny, nx = shape
+        if coarse is not None and coarse > 1 and min(ny, nx) // coarse >= 4:
+            self._setup_coarse(coarse, tolerance)
+
+
+    def evaluate(self, x, y):
+        """Beam at pixel coordinates, split into chunks over the pool."""
+
+        x = np.asarray(x).ravel()
+        y = np.asarray(y).ravel()
+        chunks = [(x[i:i+BEAM_CHUNK], y[i:i+BEAM_CHUNK]) 
+                  for i in range(0, len(x), BEAM_CHUNK)]
+        if len(chunks) == 0:
+            return np.empty(0)
+
+        if self.pool is None:
+            values = [_beam_pixels(*c) for c in chunks]
+        else:
+            values = self.pool.starmap(_beam_pixels, chunks)
+
+        return np.concatenate([np.atleast_1d(v) for v in values])
+
+
+    def _setup_coarse(self, coarse, tolerance):
+        """Evaluate the coarse grid, and find the cells it does not describe well."""
+
+        from scipy.interpolate import RectBivariateSpline
+
+        ny, nx = self.shape
+        self.ynodes = np.unique(np.append(np.arange(0, ny, coarse), ny - 1))
+        self.xnodes = np.unique(np.append(np.arange(0, nx, coarse), nx - 1))
+
+        yy, xx = np.meshgrid(self.ynodes, self.xnodes, indexing="ij")
+        nodes = self.evaluate(xx, yy).reshape(yy.shape)
+
+        # Nodes off the sky disturb the spline over a couple of cells
+        bad = ndimage.binary_dilation(~np.isfinite(nodes), iterations=2)
+        exact = bad[:-1, :-1] | bad[1:, :-1] | bad[:-1, 1:] | bad[1:, 1:]
+
+        self.spline = RectBivariateSpline(self.ynodes, self.xnodes, 
+                                          np.where(np.isfinite(nodes), nodes, 0.),
+                                          kx=3, ky=3)
+
+        # Check the interpolation at the quarter points of each cell
+        failed = np.zeros_like(exact)
+        check = ~exact
+        for fy in (0.25, 0.75):
+            for fx in (0.25, 0.75):
+                yc = np.round(self.ynodes[:-1] + fy * np.diff(self.ynodes))
+                xc = np.round(self.xnodes[:-1] + fx * np.diff(self.xnodes))
+                ycc, xcc = np.meshgrid(yc, xc, indexing="ij")
+                actual = self.evaluate(xcc[check], ycc[check])
+                error = np.abs(self.spline.ev(ycc[check], xcc[check]) - actual)
+                failed[check] |= ~(error <= tolerance)
+        exact |= ndimage.binary_dilation(failed)
+
+        self.exact = exact
+        logging.info("Coarse beam grid of {0} nodes, {1} of {2} cells evaluated "
+                     "exactly".format(nodes.size, exact.sum(), exact.size))
+
+
+    def rows(self, y0, y1, mask=None):
+        """Beam over a block of rows of the image.
+
+        Parameters
+        ----------
+        y0, y1 : int
+            First and last (exclusive) row of the block.
+        mask : np.ndarray, optional
+            Pixels of the block to evaluate. Others are set to zero. [Default None]
+
+        Returns
+        -------
+        np.ndarray
+            The beam with shape (y1 - y0, nx).
+        """
+
+        nx = self.shape[1]
+        ys = np.arange(y0, y1)
+        xs = np.arange(nx)
+        if mask is None:
+            mask = np.ones((len(ys), nx), dtype=bool)
+
+        if self.spline is None:
+            block = np.zeros((len(ys), nx))
+            todo = mask
+        else:
+            block = np.where(mask, self.spline(ys, xs), 0.)
+            ycell = np.clip(np.searchsorted(self.ynodes, ys, side="right") - 1, 
+                            0, self.exact.shape[0] - 1)
+            xcell = np.clip(np.searchsorted(self.xnodes, xs, side="right") - 1, 
+                            0, self.exact.shape[1] - 1)
+            todo = mask & self.exact[np.ix_(ycell, xcell)]
+
+        yy, xx = np.nonzero(todo)
+        block[yy, xx] = self.evaluate(xx, yy + y0)
+
+        return block
+
+
+def _beam_header(hdr, shape, dtype):
+    """Header of a 2D floating point image with the WCS of another header."""
+
+    hdr = hdr.copy()
+    for key in ("BSCALE", "BZERO", "BLANK"):
+        hdr.remove(key, ignore_missing=True)
+    for i in range(3, hdr.get("NAXIS", 0) + 1):
+        hdr.remove("NAXIS{0}".format(i), ignore_missing=True)
+    hdr["BITPIX"] = -8 * np.dtype(dtype).itemsize
+    hdr["NAXIS"] = 2
+    hdr.set("NAXIS1", shape[1], after="NAXIS")
+    hdr.set("NAXIS2", shape[0], after="NAXIS1")
+
+    return hdr
+
+
 def make_beam_image(t, delays, freq, ra=None, dec=None, outname=None,  
-                    npix=1500, return_hdu=False, reference_image=None):
+                    npix=1500, return_hdu=False, reference_image=None,
+                    beam_cache=None, gridnum=None, cores=1, coarse=None,
+                    tolerance=1e-3):
     """Make a FITS image of the psuedo-I beam response.
 
     Parameters
@@ -220,7 +418,21 @@ def make_beam_image(t, delays, freq, ra=None, dec=None, outname=None,
     return_hdu : bool, optional
         Select True if wanting to return the HDUList object. [Default False]
     reference_image : str, optional
-        If supplied, the Stokes I beam is made for a reference image.
+        If supplied, the Stokes I beam is made for a reference image. Only 
+        pixels that are not NaN in the reference image are evaluated, and the
+        beam is written to `outname` in blocks of rows.
+    beam_cache : gleam_x.utils.beam_cache.BeamCache, optional
+        Interpolate the beam from a cache of alt/az grids. [Default None]
+    gridnum : int, optional
+        Sweetspot grid number of the delays. [Default None]
+    cores : int, optional
+        Number of processes to evaluate the beam with. [Default 1]
+    coarse : int, optional
+        Evaluate the beam every `coarse` pixels and upsample with a bicubic 
+        spline, evaluating exactly wherever that is off by more than 
+        `tolerance`. [Default None, every pixel is evaluated]
+    tolerance : float, optional
+        Largest acceptable difference of the upsampled beam. [Default 1e-3]
 
 
 
@@ -241,8 +453,6 @@ def make_beam_image(t, delays, freq, ra=None, dec=None, outname=None,
 
         # Initialise a FITS image:
         hdu = fits.PrimaryHDU()
-        arr = np.full((npix, npix), 0.)
-        hdu.data = arr
 
         hdu.header["CTYPE1"] = "RA---SIN"
         hdu.header["CTYPE2"] = "DEC--SIN"
@@ -254,32 +464,57 @@ def make_beam_image(t, delays, freq, ra=None, dec=None, outname=None,
         hdu.header["CRPIX2"] = npix//2 - 1
 
         hdr = hdu.header
-
-        indices = np.indices(arr.shape)
-        x = indices[0].flatten()
-        y = indices[1].flatten()
+        shape = (npix, npix)
+        ref_arr = None
 
     else:
-        ref = fits.open(reference_image)
+        ref = fits.open(reference_image, memmap=True)
         ref_arr = np.squeeze(ref[0].data)
         hdr = ref[0].header
-        arr = np.full_like(ref_arr, 0.)
-
-        indices = np.where(~np.isnan(ref_arr))
-        y = indices[0].flatten()
-        x = indices[1].flatten()
+        shape = ref_arr.shape
+        dtype = ref_arr.dtype if ref_arr.dtype.kind == "f" else np.float64
+        hdu = None
+
+    if beam_cache is not None:
+        # evaluated (or loaded) once here, before the workers start, so they
+        # share it rather than each evaluating the same beam on a cold cache
+        beam_cache.grid(delays, freq, gridnum=gridnum)
+
+    initargs = (hdr.tostring(), t, delays, freq,
+                beam_cache, gridnum)
+    if cores > 1:
+        pool = Pool(cores, initializer=_init_beam_worker, initargs=initargs)
+    else:
+        _init_beam_worker(*initargs)
+        pool = None
+
+    try:
+        imager = BeamImager(shape, pool=pool, coarse=coarse, 
+                            tolerance=tolerance)
+
+        if ref_arr is None:
+            # Now get beam values for each pixel:
+            arr = np.vstack([imager.rows(y0, min(y0 + BEAM_ROWS, shape[0]))
+                             for y0 in range(0, shape[0], BEAM_ROWS)])
+            hdu.data = arr
+            if outname is not None:
+                fits.writeto(outname, arr, hdr, overwrite=True)
+        elif outname is not None:
+            # Stream blocks of rows into the output, rather than holding the
+            # full image in memory
+            if os.path.exists(outname):
+                os.remove(outname)
+            out = fits.StreamingHDU(outname, _beam_header(hdr, shape, dtype))
+            for y0 in range(0, shape[0], BEAM_ROWS):
+                y1 = min(y0 + BEAM_ROWS, shape[0])
+                block = imager.rows(y0, y1, mask=np.isfinite(ref_arr[y0:y1]))
+                out.write(block.astype(dtype))
+            out.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    w = WCS(hdr).celestial
-    
-    # Now get beam values for each pixel:    
-    stride = 2250000  # 1500*1500
-    for i in range(0, len(x), stride):
-        r, d = w.all_pix2world(x[i:i+stride], y[i:i+stride], 0)   
-        arr[y[i:i+stride], x[i:i+stride]] = beam_value(r, d, t, delays, freq, 
-                                                       return_I=True)
-
-    if outname is not None:
-        fits.writeto(outname, arr, hdr, overwrite=True)
     if return_hdu:
         return hdu
 
@@ -369,6 +604,18 @@ def main():
                     help="Switch to return only the mainlobe.")
     ps.add_argument("-P", "--peak", action="store_false", dest="centroid",
                     help="Find peak of lobes rather than centroids. [Default False]")
+    ps.add_argument("-c", "--beam-cache", default=None, nargs="?", const="",
+                    help="Interpolate the beam from alt/az grids cached in this "
+                         "directory, evaluating them once per pointing and "
+                         "frequency. Without a directory GXBEAMCACHE is used.")
+    ps.add_argument("--cores", type=int, default=1,
+                    help="Number of processes used to make the beam image. [Default 1]")
+    ps.add_argument("--coarse", type=int, default=None,
+                    help="Evaluate the beam image every this many pixels and "
+                         "upsample with a bicubic spline. [Default None]")
+    ps.add_argument("--tolerance", type=float, default=1e-3,
+                    help="Largest difference of the upsampled beam before pixels "
+                         "are evaluated exactly. [Default 1e-3]")
 
     args = ps.parse_args()
 
@@ -378,9 +625,17 @@ def main():
     if args.metafits:
 
         t, delays, freq, pnt = parse_metafits(args.image)
+        beam_cache = None
+        if args.beam_cache is not None:
+            beam_cache = BeamCache(directory=args.beam_cache or None)
         hdu = make_beam_image(t, delays, freq, 
                               ra=pnt.ra.value,
-                              return_hdu=True)
+                              return_hdu=True,
+                              beam_cache=beam_cache,
+                              gridnum=load_metafits(args.image).gridnum,
+                              cores=args.cores,
+                              coarse=args.coarse,
+                              tolerance=args.tolerance)
 
     else:
 
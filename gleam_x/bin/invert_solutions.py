@@ -3,14 +3,21 @@
 
 
 from argparse import ArgumentParser
-import numpy as np
 from calplots import aocal
 
+from gleam_x.utils import jones
+
 
 def get_args():
     ps = ArgumentParser()
-    ps.add_argument("solutions")
-    ps.add_argument("-o", "--outname", default=None, type=str)
+    ps.add_argument("solutions", nargs="+", help="One or more solution files to invert")
+    ps.add_argument(
+        "-o",
+        "--outname",
+        default=None,
+        type=str,
+        help="Output name, only valid with a single solutions file. Otherwise each output is named <solutions>_inv.bin",
+    )
     return ps.parse_args()
 
 
@@ -18,22 +25,21 @@ def get_args():
 def invert_solutions(solutions, outname):
 
     ao = aocal.fromfile(solutions)
-
-    for time in range(ao.shape[0]):
-        for antenna in range(ao.shape[1]):
-            for channel in range(ao.shape[2]):
-                data_inv = np.linalg.inv(ao[time, antenna, channel, :].reshape((2,2)))
-                ao[time, antenna, channel, :] = data_inv.flatten()
+    ao = jones.invert(ao)
     ao.tofile(outname)
 
 def cli(args):
-    if args.outname is None:
-        args.outname = "{}_inv.bin".format(
-            args.solutions.replace(".bin", "")
-        )
-    invert_solutions(args.solutions, args.outname)
+    if args.outname is not None and len(args.solutions) > 1:
+        raise ValueError("--outname can only be used with a single solutions file")
+
+    for solutions in args.solutions:
+        outname = args.outname
+        if outname is None:
+            outname = "{}_inv.bin".format(
+                solutions.replace(".bin", "")
+            )
+        invert_solutions(solutions, outname)
 
 
 if __name__ == "__main__":
     cli(get_args())
-
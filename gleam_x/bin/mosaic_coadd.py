@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+
+import os
+import sys
+from argparse import ArgumentParser
+
+from astropy import units as u
+from astropy.coordinates import Angle
+
+import logging
+logging.basicConfig(format="%(levelname)s (%(module)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.getLogger("gleam_x.utils.coadd").setLevel(logging.INFO)
+
+from gleam_x.utils.coadd import (
+    DEFAULT_TILE,
+    KERNELS,
+    MANIFEST,
+    PSF_PLANES,
+    Accumulator,
+    OutputGrid,
+    Snapshot,
+    coadd,
+    update,
+)
+
+
+def read_list(path):
+    """File names listed one per line, as given to swarp with @list"""
+
+    with open(path, "r") as infile:
+        items = [line.strip() for line in infile]
+
+    return [item for item in items if item != "" and not item.startswith("#")]
+
+
+def parse_center(value, unit):
+    """Coordinate of the mosaic centre, in decimal degrees or sexagesimal as accepted
+    by the CENTER of swarp. Sexagesimal right ascensions are in hours."""
+
+    if ":" in value:
+        return Angle(value, unit=unit).deg
+
+    return float(value)
+
+
+def up_to_date(state, snapshots, planes, kernel, ra=None, dec=None, pixscale=None, shape=None):
+    """Whether the accumulators in state hold exactly the snapshots, unchanged"""
+
+    if not os.path.exists(os.path.join(state, MANIFEST)):
+        logger.info("No accumulators in {}".format(state))
+        return False
+
+    try:
+        acc = Accumulator.open(state)
+    except RuntimeError as e:
+        logger.error(str(e))
+        return False
+
+    reason = acc.incompatible(planes, kernel, ra=ra, dec=dec, pixscale=pixscale, shape=shape)
+    if reason is not None:
+        logger.info("Accumulators in {} need rebuilding, {}".format(state, reason))
+        return False
+
+    _, added, removed, changed = acc.changes(snapshots)
+    logger.info("{} snapshots added, {} removed and {} changed".format(len(added), len(removed), len(changed)))
+
+    return len(added) + len(removed) + len(changed) == 0
+
+
+def main():
+    ps = ArgumentParser(description="Reproject snapshot images onto a common ZEA grid and "
+                                    "co-add them weighted by their weight maps, without "
+                                    "writing resampled intermediate images. The PSF "
+                                    "planes (bmaj, bmin, bpa) are co-added in the same pass.")
+
+    ps.add_argument("images", type=str,
+                    help="File listing the snapshot images, one per line.")
+    ps.add_argument("--weights", type=str, default=None,
+                    help="File listing the weight map of each image, one per line "
+                         "in the same order. Uniform weights if not supplied.")
+    ps.add_argument("--ra", type=str, default=None,
+                    help="Right ascension of the centre of the mosaic, in degrees or hh:mm:ss. "
+                         "Required unless the accumulators in --state exist, whose centre "
+                         "is kept if not supplied.")
+    ps.add_argument("--dec", type=str, default=None,
+                    help="Declination of the centre of the mosaic, in degrees or dd:mm:ss. "
+                         "Required unless the accumulators in --state exist, whose centre "
+                         "is kept if not supplied.")
+    ps.add_argument("-o", "--outname", type=str, required=True,
+                    help="Output name. Writes <outname>.fits, <outname>.weight.fits "
+                         "and <outname>_bmaj/_bmin/_bpa.fits.")
+    ps.add_argument("--pixscale", type=float, default=None,
+                    help="Pixel size of the mosaic in degrees. Defaults to the median "
+                         "of the snapshots.")
+    ps.add_argument("--size", type=int, nargs=2, default=None, metavar=("NX", "NY"),
+                    help="Size of the mosaic in pixels. Defaults to the footprint of "
+                         "the snapshots.")
+    ps.add_argument("--kernel", type=str, default="lanczos3", choices=KERNELS,
+                    help="Interpolation kernel.")
+    ps.add_argument("--tile", type=int, default=DEFAULT_TILE,
+                    help="Size of the square tiles of the mosaic processed at a time.")
+    ps.add_argument("--threads", type=int, default=1,
+                    help="Number of threads processing tiles.")
+    ps.add_argument("--no-psf", action="store_true", default=False,
+                    help="Do not co-add the bmaj, bmin and bpa planes.")
+    ps.add_argument("--state", type=str, default=None,
+                    help="Directory the weighted sums and weights are persisted to, with a "
+                         "manifest of the snapshots and their checksums. When it already "
+                         "exists only the snapshots added, removed or changed since are "
+                         "processed, on the grid stored there. Unless --size is given the "
+                         "grid is extended to cover new snapshots.")
+    ps.add_argument("--rebuild", action="store_true", default=False,
+                    help="Discard the accumulators in --state and co-add every snapshot.")
+    ps.add_argument("--check", action="store_true", default=False,
+                    help="Only check whether the accumulators in --state are up to date "
+                         "with the listed snapshots, exiting with status 1 if not.")
+
+    args = ps.parse_args()
+
+    images = read_list(args.images)
+    if args.weights is not None:
+        weights = read_list(args.weights)
+        if len(weights) != len(images):
+            ps.error("{} images but {} weight maps".format(len(images), len(weights)))
+    else:
+        weights = [None] * len(images)
+
+    if len(images) == 0:
+        ps.error("No images listed in {}".format(args.images))
+
+    snapshots = [Snapshot(image, weight=weight, psf=not args.no_psf)
+                 for image, weight in zip(images, weights)]
+
+    shape = None if args.size is None else (args.size[1], args.size[0])
+    ra = None if args.ra is None else parse_center(args.ra, u.hourangle)
+    dec = None if args.dec is None else parse_center(args.dec, u.deg)
+
+    if args.check:
+        if args.state is None:
+            ps.error("--check requires --state")
+        planes = ("image",) + (() if args.no_psf else PSF_PLANES)
+        current = up_to_date(args.state, snapshots, planes, args.kernel, ra=ra, dec=dec,
+                             pixscale=args.pixscale, shape=shape)
+        sys.exit(0 if current else 1)
+
+    if (ra is None or dec is None) and (args.state is None or args.rebuild
+                                        or not os.path.exists(os.path.join(args.state, MANIFEST))):
+        ps.error("--ra and --dec are required without existing accumulators in --state")
+
+    if args.state is not None:
+        acc = update(args.state, snapshots, ra, dec, pixscale=args.pixscale, shape=shape,
+                     kernel=args.kernel, tile=args.tile, threads=args.threads,
+                     psf=not args.no_psf, rebuild=args.rebuild)
+        names = acc.write(args.outname, threads=args.threads)
+    else:
+        grid = OutputGrid.covering(snapshots, ra, dec, pixscale=args.pixscale, shape=shape)
+        names = coadd(snapshots, grid, args.outname, kernel=args.kernel,
+                      tile=args.tile, threads=args.threads, psf=not args.no_psf)
+
+    for name in names.values():
+        logger.info("Wrote {}".format(name))
+
+
+if __name__ == "__main__":
+    main()
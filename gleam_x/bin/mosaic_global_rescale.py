@@ -6,11 +6,12 @@ import os
 import numpy as np
 import astropy.units as u
 import matplotlib.pyplot as plt
-from astropy.coordinates import match_coordinates_sky, SkyCoord
 from astropy.io import fits
 from argparse import ArgumentParser
 from astropy.table import Table, hstack
 
+from gleam_x.utils.catalogue_index import CatalogueIndex, open_index
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,17 +19,15 @@ logger.addHandler(logging.StreamHandler())
 
 
 def cross_cata_ggsm(
-    cata_tab: Table, ggsm_tab: Table, seplimit=10 * u.arcsecond
+    cata_tab: Table, ggsm_index: CatalogueIndex, seplimit=10 * u.arcsecond
 ) -> Table:
-    logger.debug("Creating Skycoord objects")
-    cata_sky = SkyCoord(cata_tab["ra"] * u.deg, cata_tab["dec"] * u.deg)
-    ggsm_sky = SkyCoord(ggsm_tab["RAJ2000"] * u.deg, ggsm_tab["DEJ2000"] * u.deg)
-
     logger.info("Cross-matching catalogue to GGSM")
-    idx, sep, _ = cata_sky.match_to_catalog_sky(ggsm_sky)
+    idx, sep = ggsm_index.nearest(
+        cata_tab["ra"], cata_tab["dec"], radius=seplimit.to(u.arcsecond).value
+    )
 
     logger.debug(f"Removing matches greater than {seplimit.to(u.arcsecond)}")
-    mask = sep < seplimit
+    mask = idx >= 0
 
     logger.info(f"Have found {np.sum(mask)} matches")
     idx = idx[mask]
@@ -36,7 +35,7 @@ def cross_cata_ggsm(
 
     logger.debug("Reordering tables")
     cata_tab = cata_tab[mask]
-    ggsm_tab = ggsm_tab[idx]
+    ggsm_tab = ggsm_index.table(idx)
 
     logger.debug("Merging tables")
     merge_tab = hstack([cata_tab, ggsm_tab], join_type="exact")
@@ -178,9 +177,9 @@ def derive_apply_scale(
     cata_tab = Table.read(catalogue)
 
     logger.debug(f"Opening {ggsm}")
-    ggsm_tab = Table.read(ggsm)
+    ggsm_index = open_index(ggsm)
 
-    cross_tab = cross_cata_ggsm(cata_tab, ggsm_tab)
+    cross_tab = cross_cata_ggsm(cata_tab, ggsm_index)
 
     logger.info("Calculating ratios")
     cross_tab["model_flux"] = (
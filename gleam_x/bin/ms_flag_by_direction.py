@@ -30,7 +30,11 @@ from astropy.io import fits
 from astropy.table import Table
 import numpy as np
 from astropy.coordinates import EarthLocation
-from casacore.tables import taql, table
+from casacore.tables import table
+
+from gleam_x.utils.array_geometry import antenna_layout, subarray_mask
+from gleam_x.utils.ms_batch import resolve_measurement_sets, run_batch, write_summary
+from gleam_x.utils.ms_io import flag_antennas, DEFAULT_BLOCK_SIZE
 
 import matplotlib.pyplot as plt
 
@@ -58,76 +62,18 @@ def parse_antenna_ms(ms: Union[str,Path]) -> pd.DataFrame:
     logger.info(f"Parsing the antenna table of {ms}")
     ant_ms = table(f"{ms}/ANTENNA", readonly=True, ack=False)
 
-    ant_df = pd.DataFrame([a for a in ant_ms])
+    # whole columns are read at once, array columns are kept as one array per row
+    columns = {}
+    for col in ant_ms.colnames():
+        values = ant_ms.getcol(col)
+        columns[col] = list(values) if np.ndim(values) > 1 else values
+    ant_ms.close()
+
+    ant_df = pd.DataFrame(columns)
     logger.info(f"Loaded {len(ant_df)} antennas")
 
     return ant_df
 
-def create_rotation_matrices(ref0: EarthLocation) -> Tuple[np.ndarray, np.ndarray]:
-    """Create the two sets of rotation matrices to convert the geodetic XYZ coordinates
-    to the local tangent plane, with the origin/reference being that at the EarthLocation
-
-    Args:
-        ref0 (EarthLocation): The position that becomes the origin of LTP
-
-    Returns:
-        Tuple[np.ndarray, np.ndarray]: The (East, North, Up) position at the reference position in units of meters
-    """
-    
-    logger.debug(f"Obtaining rotations for {ref0.lon} {ref0.lat}")
-
-    # Math is shamelessly 'inspired' by: https://archive.psas.pdx.edu/CoordinateSystem/Latitude_to_LocalTangent.pdf
-    phi = ref0.lon.rad
-    lam = ref0.lat.rad
-    
-    # Precompute the trig functions used for later
-    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
-    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
-    
-    rot1 = (
-        ( -sin_phi, cos_phi, 0 ),
-        (  cos_phi, sin_phi, 0 ),
-        (0, 0, 1)
-    )
-    
-    rot2 = (
-        ( 1, 0, 0 ),
-        ( 0, -sin_lam, cos_lam ),
-        (0, cos_lam, sin_lam)
-    )
-    
-    return np.array(rot1), np.array(rot2)
-
-def derive_local_tangent_plane(
-    geodetic_pos: Iterable[float], ref0: EarthLocation
-) -> Tuple[float,float,float]:
-    """Convert the geodetic positions (XYZ) in meters to East-North-Up (ENU)
-    in meters at the supplied reference position. 
-
-    Args:
-        geodetic_pos (Iterable[float]): A position in the geodetic frame to convert to ENU
-        ref0 (EarthLocation): Reference/origin position of the LTP to produce the ENU positions
-
-    Returns:
-        Tuple[float,float,float]: ENU positions 
-    """
-    # any other preprocessing goes here
-    ant_xyz = np.array(geodetic_pos) * u.m
-
-    logger.debug(f"Antennas XYZ: {ant_xyz=}")
-
-    # get the geodetic position from the EarthLocation
-    ref_xyz = u.Quantity(ref0.geocentric).to(u.m)
-
-    # get the two rotations that depend on the reference/origin
-    # of the local tangent plane
-    rot1, rot2 = create_rotation_matrices(ref0)
-
-    # and finally apply the rotations to the offset XYZ position
-    ant_enu = rot2 @ rot1 @ (ant_xyz - ref_xyz).value
-    
-    return tuple(ant_enu)
-
 def get_ant_subarray_flags(ant_table: pd.DataFrame, direction: str) -> Iterable[bool]:
     """Using the ENU positions to derive the appropriate flags to split
     the array into the desired quadrant sub-array. 
@@ -152,18 +98,15 @@ def get_ant_subarray_flags(ant_table: pd.DataFrame, direction: str) -> Iterable[
 
     logger.info(f"Flagging for direction {direction}")
 
-    if direction == "east":
-        mask = ant_table["East"] <= 700
-    elif direction == "west":
-        mask = ant_table["East"] >= -120
-    elif direction == "north":
-        mask = ant_table["North"] <= 720
-    elif direction == "south":
-        mask = ant_table["North"] >= -70
-    else:
+    if direction not in DIRECTIONS:
         logger.error(f"Supplied direction {direction} is invalid. ")
         raise ValueError("Invalid direction supplied")
 
+    mask = pd.Series(
+        subarray_mask(ant_table["East"], ant_table["North"], direction),
+        index=ant_table.index,
+    )
+
     logger.debug(f"{mask=}")
     logger.debug(f"{np.sum(mask)}")
     
@@ -226,43 +169,49 @@ def plot_layout(ant_table: pd.DataFrame, direction: str, path: Union[str,Path]=N
         fig.tight_layout()
         fig.savefig(path)
     
-def apply_flagging_to_ms(ms: Union[str, Path], idx_to_flag: Iterable[int]) -> None:
+def apply_flagging_to_ms(
+    ms: Union[str, Path], idx_to_flag: Iterable[int], block_size: int = DEFAULT_BLOCK_SIZE
+) -> Tuple[int, int]:
     """Given a set of antenna IDs (based on the index position of a ANTENNA table),
-    use taql to flag visibilities
+    flag visibilities. FLAG and FLAG_ROW are written for all antennas in a single
+    pass over the measurement set, in blocks of rows. 
 
     Args:
         ms (Union[str,Path]): Measurement set to apply flagging to
         idx_to_flag (Iterable[int]): Antennas to flag
+        block_size (int, optional): Number of rows read and written at a time. Defaults to 50000.
+
+    Returns:
+        Tuple[int, int]: Number of visibilities flagged, and the number that remain unflagged
     """
 
     
     logger.info(f"Flagging {ms}")
     logger.info(f"Antennas to flag: {idx_to_flag}")
 
-    unflag1 = taql("CALC sum([select nfalse(FLAG) from $ms])")
+    flagged, unflagged = flag_antennas(ms, idx_to_flag, block_size=block_size)
 
-    for idx in idx_to_flag:
-        taql(f"UPDATE $ms set FLAG_ROW=T WHERE ANTENNA1=={idx} || ANTENNA2=={idx}")
-        taql(f"UPDATE $ms set FLAG=T WHERE ANTENNA1=={idx} || ANTENNA2=={idx}")
+    logger.info(f"Flagged {flagged} visibilities")
+    logger.info(f"{unflagged} visibilities remain unflagged")
 
-    unflag2 = taql("CALC sum([select nfalse(FLAG) from $ms])")
-
-    logger.info(f"Flagged {int(unflag1 - unflag2)} visibilities")
-    logger.info(f"{int(unflag2)} visibilities remain unflagged")
+    return flagged, unflagged
 
 def ms_flag_by_direction(
     ms: Union[str,Path], direction: str = "north", apply: bool = True, plot: bool=False, dump_table: bool=False
-) -> None:
+) -> dict:
     """Flag an MWA measurment set of interest into a quadrant. Antennas will be 
-    flagged using taql, and flagged antennas are identified by converting the 
+    flagged in a single blocked pass, and flagged antennas are identified by converting the 
     POSITION field (XYZ) into a East-North-Up (ENU) at the MWA location. 
 
     Args:
         ms (Union[str,Path]): Path to a measurement set of interest
         direction (str, optional): Direction of interest. Acceptable values are 'north', 'south', 'east', 'west'. Defaults to "north".
-        apply (bool, optional): Apply the antenna flagging using taql. Defaults to True.
+        apply (bool, optional): Apply the antenna flagging to the measurement set. Defaults to True.
         plot (bool, optional): Create a plot of the MWA layout and which tiles are to be flagged. Defaults to False.
         dump_table (bool, optional): Save the processed ANTENNA table, with ENU positions, to a csv. File name is based on the measurment set name. Defaults to False.
+
+    Returns:
+        dict: The direction, the number of antennas to flag and, if applied, the number of visibilities flagged and remaining unflagged
     """
     ms = Path(ms)
     if not ms.exists():
@@ -277,14 +226,10 @@ def ms_flag_by_direction(
 
     logger.info(f"Using reference position of {MWA.lon} {MWA.lat}")
 
-    # do transformation from XYZ-> ENU
-    res = ant_table['POSITION'].apply(
-        derive_local_tangent_plane, 
-        args=(MWA,),
-    )
-
-    # and save them to the table
-    ant_table[['East', 'North', 'Height']] = pd.DataFrame(res.tolist(), index=ant_table.index)
+    # transformation from XYZ -> ENU for all antennas at once, from the
+    # positions cached for this measurement set
+    layout = antenna_layout(ms)
+    ant_table[['East', 'North', 'Height']] = pd.DataFrame(layout.enu, index=ant_table.index)
 
     logger.debug(ant_table[['POSITION', 'East', 'North']])
 
@@ -309,19 +254,32 @@ def ms_flag_by_direction(
         logger.info(f"Creating {out_path}")
         ant_table.to_csv(out_path)
 
+    idx_to_flag = np.argwhere(
+        np.array(ant_table['FLAGGED'])
+    ).squeeze()
+
+    stats = {
+        "direction": direction,
+        "antennas": int(np.size(idx_to_flag)),
+    }
+
     # and now apply the flags
     if apply:
-        idx_to_flag = np.argwhere(
-            np.array(ant_table['FLAGGED'])
-        ).squeeze()
-        apply_flagging_to_ms(ms, idx_to_flag)
+        flagged, unflagged = apply_flagging_to_ms(ms, idx_to_flag)
+        stats.update(flagged=flagged, unflagged=unflagged)
+
+    return stats
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(
         description="Flag all antenna that do not correspond to a desired direction. "
     )
-    parser.add_argument("ms", type=str, help="Path to a measurement set to flag")
+    parser.add_argument(
+        "ms",
+        type=str,
+        help="Path to a measurement set to flag. May also be a glob pattern matching several measurement sets, or a new-line delimited file of obsids. ",
+    )
     
     parser.add_argument(
         "-d",
@@ -358,28 +316,64 @@ if __name__ == "__main__":
         action='store_true',
         help='Run against all direction. If enable, apply is forced to be False. '
     )
+    parser.add_argument(
+        '--ms-suffix',
+        type=str,
+        default='.ms',
+        help='Appended to each obsid to form the measurement set name when a file of obsids is supplied. '
+    )
+    parser.add_argument(
+        '-j',
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of measurement sets processed concurrently in batch mode. '
+    )
+    parser.add_argument(
+        '--summary',
+        type=str,
+        default=None,
+        help='Write a JSON summary of the per-measurement set timing and flagging statistics to this file. In batch mode it is otherwise written to stdout. '
+    )
 
     args = parser.parse_args()
 
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
+    ms_paths = resolve_measurement_sets(args.ms, suffix=args.ms_suffix)
+
     if args.all:
-        for d in DIRECTIONS:
+        for ms in ms_paths:
+            for d in DIRECTIONS:
                 # Will never apply the flagging
                 ms_flag_by_direction(
-                    args.ms,
+                    ms,
                     direction=d,
                     apply=False,
                     plot=args.products,
                     dump_table=args.products
                 )
 
-    else:
+    elif len(ms_paths) == 1 and args.summary is None:
         ms_flag_by_direction(
-            args.ms,
+            ms_paths[0],
+            direction=args.direction,
+            apply=args.apply,
+            plot=args.products,
+            dump_table=args.products
+        )
+
+    else:
+        records = run_batch(
+            ms_flag_by_direction,
+            ms_paths,
+            workers=args.workers,
             direction=args.direction,
             apply=args.apply,
             plot=args.products,
             dump_table=args.products
         )
+        summary = write_summary(records, path=args.summary)
+        if summary["failed"] > 0:
+            sys.exit(1)
@@ -12,6 +12,7 @@ from __future__ import print_function, division
 
 import numpy as np
 import sys
+import logging
 import warnings
 
 from datetime import datetime
@@ -19,9 +20,21 @@ from casacore.tables import table, taql, maketabdesc, makescacoldesc
 
 from argparse import ArgumentParser
 
+from gleam_x.utils.array_geometry import antenna_layout
+from gleam_x.utils.ms_batch import resolve_measurement_sets, run_batch, write_summary
+from gleam_x.utils.ms_io import (
+    iter_masked_data,
+    flag_baselines as flag_baseline_rows,
+    DEFAULT_BLOCK_SIZE,
+)
+
 
 CASA_DATA_COLUMNS = {"DATA": "data", "CORRECTED_DATA": "corrected"}
 
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
 
 class MeasurementSet:
     """Easier handling of a Measurement Set."""
@@ -37,175 +50,346 @@ class MeasurementSet:
         self.data_column = data_column
 
     def baseline_preparation(self):
+        """Identify the baselines present in the filtered table, sorted by
+        baseline length. A dense (antenna, antenna) lookup array is built so
+        that the baseline index of any set of rows can be found in one step.
+        """
 
         mset = self.filtered
 
-        antenna_table = table(self.name + "/ANTENNA", readonly=True, ack=False)
-        self.antennas = list(set(mset.getcol("ANTENNA1")))
-        self.nbaselines = int(len(self.antennas) * (len(self.antennas) - 1) / 2)
-        self.baselines = []
-        self.station_names = {}
-        self.baseline_stats = np.full((self.nbaselines, 5), 1.0, dtype=np.float32)
-        i = 0
-        for ant1 in self.antennas:
-            for ant2 in self.antennas:
-                baseline = set([ant1, ant2])
-                if ant1 != ant2 and baseline not in self.baselines:
+        layout = antenna_layout(self.name)
+        nant = len(layout)
 
-                    self.baselines.append(baseline)
-                    self.baseline_stats[i, 0] = ant1
-                    self.baseline_stats[i, 1] = ant2
+        ant1 = mset.getcol("ANTENNA1")
+        ant2 = mset.getcol("ANTENNA2")
 
-                    # get baseline length:
-                    ant1_pos = antenna_table.getcol("POSITION", startrow=ant1, nrow=1)[
-                        0
-                    ]
-                    ant2_pos = antenna_table.getcol("POSITION", startrow=ant2, nrow=1)[
-                        0
-                    ]
+        # unique baselines actually present, encoded as a single integer key
+        keys = np.unique(ant1.astype(np.int64) * nant + ant2)
+        bl_ant1 = keys // nant
+        bl_ant2 = keys % nant
 
-                    self.baseline_stats[i, 2] = cartesian_dist3d(ant1_pos, ant2_pos)
+        lengths = layout.baseline_length(bl_ant1, bl_ant2)
+        order = np.argsort(lengths, kind="stable")
 
-                    i += 1
+        self.antennas = list(np.unique(np.concatenate((bl_ant1, bl_ant2))))
+        self.nbaselines = len(keys)
+        self.baselines = [set(bl) for bl in zip(bl_ant1[order], bl_ant2[order])]
 
-        # Get station names as well:
-        station_names = antenna_table.getcol("NAME")
-        for i in range(len(station_names)):
-            self.station_names[i] = station_names[i]
+        self.baseline_stats = np.full((self.nbaselines, 5), 1.0, dtype=np.float32)
+        self.baseline_stats[:, 0] = bl_ant1[order]
+        self.baseline_stats[:, 1] = bl_ant2[order]
+        self.baseline_stats[:, 2] = lengths[order]
 
-        self.baseline_stats = self.baseline_stats[self.baseline_stats[:, 2].argsort()]
+        self.baseline_lookup = np.full((nant, nant), -1, dtype=np.int64)
+        self.baseline_lookup[bl_ant1[order], bl_ant2[order]] = np.arange(
+            self.nbaselines
+        )
 
-    @staticmethod
-    def get_data(mset):
+        self.station_names = {i: name for i, name in enumerate(layout.names)}
 
-        flags = mset.filtered.getcol("FLAG")
-        data = mset.filtered.getcol(mset.data_column)
-        data[flags] = np.nan
+    def baseline_index(self, ant1, ant2):
+        """Index into ``baseline_stats`` for each of the supplied antenna pairs"""
+        return self.baseline_lookup[ant1, ant2]
 
-        return data
+    def iter_chan_avg(self, block_size=DEFAULT_BLOCK_SIZE):
+        """Stream the channel averaged visibilities of the filtered table in
+        blocks of rows, so only a single block is ever held in memory.
 
-    @staticmethod
-    def flag_baselines(ms, baselines):
-        """example taql expressions:
-        SELECT FROM some.ms WHERE any(ANTENNA1==[0,0,1] && ANTENNA2==[1,3,2])
-        update MY.MS set FLAG_ROW=T where isdefined(FLAG) && all(FLAG)
+        Yields:
+            tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: ANTENNA1, ANTENNA2 and the
+            mean visibility across channels for each row and polarisation
         """
+        blocks = iter_masked_data(
+            self.filtered,
+            self.data_column,
+            block_size=block_size,
+            extra_columns=("ANTENNA1", "ANTENNA2"),
+        )
+        for _, data, cols in blocks:
+            # Hides empty slice warnings when channel already completely flagged
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                data_avg = np.nanmean(data, axis=1)
 
-        ant1, ant2 = zip(*baselines)
-        unflag1 = taql("CALC sum([select nfalse(FLAG) from $ms])")
-
-        print("Flagging {} baselines.".format(len(ant1)))
-        taql("update $ms set FLAG_ROW=T where any(ANTENNA1==$ant1 && ANTENNA2==$ant2)")
-        taql("update $ms set FLAG=T where any(ANTENNA1==$ant1 && ANTENNA2==$ant2)")
+            yield cols["ANTENNA1"], cols["ANTENNA2"], data_avg
 
-        unflag2 = taql("CALC sum([select nfalse(FLAG) from $ms])")
-        print("Number of visibilities flagged: {}".format(unflag1[0] - unflag2[0]))
+    @staticmethod
+    def flag_baselines(ms, baselines, block_size=DEFAULT_BLOCK_SIZE):
+        """Flag FLAG and FLAG_ROW of the supplied (ANTENNA1, ANTENNA2) baselines
+        in a single blocked pass over the measurement set.
+        """
 
+        logger.info("Flagging {} baselines in {}.".format(len(baselines), ms))
+        flagged, _ = flag_baseline_rows(ms, baselines, block_size=block_size)
+        logger.info("Number of visibilities flagged in {}: {}".format(ms, flagged))
 
-def cartesian_dist3d(c1, c2):
-    """3-D Cartesian distance between vectors ``c1`` and ``c2``."""
-    return np.sqrt((c2[0] - c1[0]) ** 2 + (c2[1] - c1[1]) ** 2 + (c2[2] - c1[2]) ** 2)
+        return flagged
 
 
 def chan_avg(mset, data_column="CORRECTED_DATA", stride=1000):
+    """Mean visibility across channels for each row/pol of the filtered table,
+    read in blocks of ``stride`` rows.
     """
+
+    blocks = [data_avg for _, _, data_avg in mset.iter_chan_avg(block_size=stride)]
+    if len(blocks) == 0:
+        return np.full((0, 4), np.nan, dtype=np.complex128)
+
+    return np.concatenate(blocks).astype(np.complex128)
+
+
+class BaselineAccumulator:
+    """Running per-baseline sums of the channel averaged visibilities, from which
+    the mean amplitude and standard deviation of each baseline are derived. Blocks of
+    rows may be added in any order, so the visibilities never need to be loaded at once.
     """
 
-    data = MeasurementSet.get_data(mset)
-    data_avg_amp = np.full((mset.filtered.nrows(), 4), np.nan, dtype=np.complex_)
+    def __init__(self, nbaselines, npol=4):
+        self.nbaselines = nbaselines
+        self.npol = npol
+        shape = (nbaselines, npol)
+        self.count = np.zeros(shape)
+        self.sum_amp = np.zeros(shape)
+        self.sum_amp2 = np.zeros(shape)
+        self.sum_real = np.zeros(shape)
+        self.sum_imag = np.zeros(shape)
+
+    def add(self, index, data_avg_amp):
+        """Accumulate a block of rows
+
+        Args:
+            index (numpy.ndarray): baseline index of each row
+            data_avg_amp (numpy.ndarray): channel averaged visibilities with shape (nrows, npol)
+        """
+        nb = self.nbaselines
+        for pol in range(self.npol):
+            d = data_avg_amp[:, pol]
+            valid = np.isfinite(d)
+            d = np.where(valid, d, 0)
+            amp = np.abs(d)
+
+            self.count[:, pol] += np.bincount(index, weights=valid, minlength=nb)
+            self.sum_amp[:, pol] += np.bincount(index, weights=amp, minlength=nb)
+            self.sum_amp2[:, pol] += np.bincount(index, weights=amp ** 2, minlength=nb)
+            self.sum_real[:, pol] += np.bincount(index, weights=d.real, minlength=nb)
+            self.sum_imag[:, pol] += np.bincount(index, weights=d.imag, minlength=nb)
+
+    def stats(self):
+        """Per-baseline mean amplitude and standard deviation of the accumulated rows
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray]: the mean amplitude and the standard deviation
+            for each baseline, both with shape (nbaselines, npol). Baselines without valid data are NaN.
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
 
-    # Hides empty slice warnings when channel already completely flagged
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
+            count = np.where(self.count > 0, self.count, np.nan)
 
-        # read in data in chunks to help with memory (for my laptop mostly):
-        for i in range(0, mset.filtered.nrows(), stride):
-            if i + stride > mset.filtered.nrows():
-                end = mset.filtered.nrows()
-            else:
-                end = i + stride
-            # mean visibility across channels for each row/pol:
-            data_avg_amp[i:end, :] = np.nanmean(data[i:end, :, :], axis=1)
+            # abs for the complex vis, np.std does this as well internally
+            mean_amp = self.sum_amp / count
+            mean_abs2 = (self.sum_real / count) ** 2 + (self.sum_imag / count) ** 2
+            var = np.maximum(self.sum_amp2 / count - mean_abs2, 0)
 
-    return data_avg_amp
+        return mean_amp.astype(np.float32), np.sqrt(var).astype(np.float32)
 
 
-def get_baseline_stats(
-    mset, data_avg_amp, window=5000, sigma=3, return_baselines=False
-):
+def grouped_baseline_stats(index, data_avg_amp, nbaselines):
+    """Per-baseline mean amplitude and standard deviation of the channel
+    averaged visibilities, computed for all baselines in a single pass.
+
+    Args:
+        index (numpy.ndarray): baseline index of each row
+        data_avg_amp (numpy.ndarray): channel averaged visibilities with shape (nrows, npol)
+        nbaselines (int): total number of baselines
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray]: the mean amplitude and the standard deviation
+        for each baseline, both with shape (nbaselines, npol). Baselines without valid data are NaN.
     """
+    accumulator = BaselineAccumulator(nbaselines, npol=data_avg_amp.shape[1])
+    accumulator.add(index, data_avg_amp)
+
+    return accumulator.stats()
+
+
+def stream_baseline_stats(mset, block_size=DEFAULT_BLOCK_SIZE):
+    """Per-baseline statistics accumulated block by block directly from the
+    measurement set. ``mset.baseline_preparation`` must have been called.
+
+    Args:
+        mset (MeasurementSet): measurement set to process
+        block_size (int, optional): number of rows read at a time. Defaults to 50000.
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray]: the mean amplitude and the standard deviation
+        for each baseline
     """
+    accumulator = None
+    for ant1, ant2, data_avg in mset.iter_chan_avg(block_size=block_size):
+        if accumulator is None:
+            accumulator = BaselineAccumulator(mset.nbaselines, npol=data_avg.shape[1])
+        accumulator.add(mset.baseline_index(ant1, ant2), data_avg)
 
-    mset.baseline_preparation()
+    if accumulator is None:
+        accumulator = BaselineAccumulator(mset.nbaselines)
 
-    ant1 = mset.filtered.getcol("ANTENNA1")
-    ant2 = mset.filtered.getcol("ANTENNA2")
+    return accumulator.stats()
 
-    baseline_avg = np.full((len(mset.baseline_stats), 4), np.nan, dtype=np.float32)
-    baseline_std = np.full((len(mset.baseline_stats), 4), np.nan, dtype=np.float32)
 
-    for i in range(len(mset.baseline_stats)):
+def sliding_window_outliers(distances, baseline_avg, window=5000, sigma=3):
+    """Find baselines whose mean amplitude deviates from the baselines with a similar
+    length. The window statistics are evaluated from prefix sums over the length
+    sorted baselines, rather than recomputing a selection for each baseline.
 
-        a1 = mset.baseline_stats[i, 0]
-        a2 = mset.baseline_stats[i, 1]
+    Args:
+        distances (numpy.ndarray): baseline lengths, sorted in ascending order
+        baseline_avg (numpy.ndarray): mean amplitude of each baseline with shape (nbaselines, npol)
+        window (float, optional): half-width of the sliding window in baseline length. Defaults to 5000.
+        sigma (float, optional): deviation threshold in units of the window standard deviation. Defaults to 3.
 
-        d = data_avg_amp[(ant1 == int(a1)) & (ant2 == int(a2))]
+    Returns:
+        numpy.ndarray: boolean mask of baselines that are outliers in any polarisation
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    values = np.asarray(baseline_avg, dtype=np.float64)
+    valid = np.isfinite(values)
+    values = np.where(valid, values, 0)
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
+    def prefix(x):
+        return np.concatenate((np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)))
 
-            # abs for the complex vis? np.std does this as well internally
-            avg = np.nanmean(np.abs(d), axis=0)
-            std = np.nanstd(d, axis=0)
+    cum_count = prefix(valid.astype(np.float64))
+    cum_sum = prefix(values)
+    cum_sum2 = prefix(values ** 2)
 
-        baseline_avg[i, :] = avg
-        baseline_std[i, :] = std
+    # window is the open interval (dist - window, dist + window)
+    lower = np.searchsorted(distances, distances - window, side="right")
+    upper = np.searchsorted(distances, distances + window, side="left")
 
-    count = 0
-    flag_string = ""
-    baselines = []
-    for i in range(len(mset.baseline_stats)):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
 
-        dist = mset.baseline_stats[i, 2]
+        count = cum_count[upper] - cum_count[lower]
+        window_avg = (cum_sum[upper] - cum_sum[lower]) / count
+        window_var = (cum_sum2[upper] - cum_sum2[lower]) / count - window_avg ** 2
+        window_std = np.sqrt(np.maximum(window_var, 0))
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
+        deviant = np.abs(baseline_avg - window_avg) > sigma * window_std
+
+    return deviant.any(axis=1)
 
-            window_selection = (mset.baseline_stats[:, 2] < dist + window) & (
-                mset.baseline_stats[:, 2] > dist - window
-            )
 
-            window_std = np.nanstd(baseline_avg[window_selection], axis=0)
-            window_avg = np.nanmean(baseline_avg[window_selection], axis=0)
+def get_baseline_stats(
+    mset,
+    data_avg_amp=None,
+    window=5000,
+    sigma=3,
+    return_baselines=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """Find baselines whose amplitudes are outliers among baselines of similar
+    length. If ``data_avg_amp`` is None the statistics are streamed from the
+    measurement set in blocks of ``block_size`` rows.
+    """
+
+    mset.baseline_preparation()
+
+    if data_avg_amp is None:
+        baseline_avg, baseline_std = stream_baseline_stats(mset, block_size=block_size)
+    else:
+        ant1 = mset.filtered.getcol("ANTENNA1")
+        ant2 = mset.filtered.getcol("ANTENNA2")
+        index = mset.baseline_index(ant1, ant2)
 
-            if (np.abs(baseline_avg[i] - window_avg) > sigma * window_std).any():
-                # output suitable to pass to CASA's flagdata:
-                flag_string += ";{}&{}".format(
-                    mset.station_names[int(mset.baseline_stats[i, 0])],
-                    mset.station_names[int(mset.baseline_stats[i, 1])],
-                )
+        baseline_avg, baseline_std = grouped_baseline_stats(
+            index, data_avg_amp, mset.nbaselines
+        )
 
-                baselines.append(
-                    (int(mset.baseline_stats[i, 0]), int(mset.baseline_stats[i, 1]))
-                )
+    outliers = sliding_window_outliers(
+        mset.baseline_stats[:, 2], baseline_avg, window=window, sigma=sigma
+    )
 
-                count += 1
+    baselines = [
+        (int(a1), int(a2))
+        for a1, a2 in mset.baseline_stats[outliers, :2]
+    ]
 
     if not return_baselines:
-        flag_string = flag_string.lstrip(";")
-        print(flag_string)
+        print(casa_flag_string(mset, baselines))
     else:
         return baselines
 
 
+def casa_flag_string(mset, baselines):
+    """Baselines as a list suitable to pass to CASA's flagdata"""
+    return ";".join(
+        "{}&{}".format(mset.station_names[a1], mset.station_names[a2])
+        for a1, a2 in baselines
+    )
+
+
+def flag_by_uvdist(
+    ms,
+    column,
+    window=5000,
+    sigma=3,
+    apply=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+    report=True,
+):
+    """Search a single MeasurementSet for outlying baselines, and optionally flag them.
+
+    Args:
+        ms (str): name of the MeasurementSet
+        column (str): name of the column in the MeasurementSet to search on
+        window (float, optional): sliding window used for searching. Defaults to 5000.
+        sigma (float, optional): outlier threshold. Defaults to 3.
+        apply (bool, optional): flag the selected baselines. Defaults to False.
+        block_size (int, optional): number of rows read at a time. Defaults to 50000.
+        report (bool, optional): print the CASA-compatible baseline list when not applying. Defaults to True.
+
+    Returns:
+        dict: the number of baselines selected, the number of visibilities flagged and the
+        CASA-compatible list of baselines
+    """
+    mset = MeasurementSet(ms, column)
+    baselines = get_baseline_stats(
+        mset, window=window, sigma=sigma, return_baselines=True, block_size=block_size
+    )
+    flag_string = casa_flag_string(mset, baselines)
+    mset.filtered.close()
+    mset.mset.close()
+
+    flagged = 0
+    if not apply:
+        if report:
+            print(flag_string)
+    elif len(baselines) > 0:
+        flagged = MeasurementSet.flag_baselines(ms, baselines, block_size=block_size)
+    else:
+        logger.info("No baselines to flag in {}.".format(ms))
+
+    return {
+        "column": column,
+        "baselines": len(baselines),
+        "flagged": flagged,
+        "flag_string": flag_string,
+    }
+
+
 def main():
     """
     """
 
     ps = ArgumentParser(
-        description="Find baselines to flag - can be memory intensive so may not work on large MeasurementSets."
+        description="Find baselines to flag. Visibilities are streamed in blocks of rows, so memory is bounded by the block size."
+    )
+    ps.add_argument(
+        "ms",
+        type=str,
+        help="name of MeasurementSet. May also be a glob pattern matching several MeasurementSets, or a new-line delimited file of obsids.",
     )
-    ps.add_argument("ms", type=str, help="name of MeasurementSet")
     ps.add_argument(
         "column", type=str, help="name of column in MeasurementSet to search on."
     )
@@ -229,21 +413,53 @@ def main():
         action="store_true",
         help="Flag baselines if >1 baselines are selected. If not selected then a list of CASA-compatible baslines will be printed that can be fed to CASA's flagdata.",
     )
+    ps.add_argument(
+        "-b",
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Number of rows of the MeasurementSet read at a time. Peak memory scales with this. ",
+    )
+    ps.add_argument(
+        "--ms-suffix",
+        type=str,
+        default=".ms",
+        help="Appended to each obsid to form the MeasurementSet name when a file of obsids is supplied.",
+    )
+    ps.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of MeasurementSets processed concurrently in batch mode.",
+    )
+    ps.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Write a JSON summary of the per-MeasurementSet timing and flagging statistics to this file. In batch mode it is otherwise written to stdout.",
+    )
 
     args = ps.parse_args()
 
-    mset = MeasurementSet(args.ms, args.column)
-    d = chan_avg(mset, args.column, stride=50000)
-    if args.apply:
-        baselines = get_baseline_stats(
-            mset, d, window=args.window, sigma=args.sigma, return_baselines=True
-        )
-        if len(baselines) > 0:
-            MeasurementSet.flag_baselines(args.ms, baselines)
-        else:
-            print("No baselines to flag.")
+    ms_paths = resolve_measurement_sets(args.ms, suffix=args.ms_suffix)
+    options = dict(
+        column=args.column,
+        window=args.window,
+        sigma=args.sigma,
+        apply=args.apply,
+        block_size=args.block_size,
+    )
+
+    if len(ms_paths) == 1 and args.summary is None:
+        flag_by_uvdist(ms_paths[0], **options)
     else:
-        get_baseline_stats(mset, d, window=args.window, sigma=args.sigma)
+        records = run_batch(
+            flag_by_uvdist, ms_paths, workers=args.workers, report=False, **options
+        )
+        summary = write_summary(records, path=args.summary)
+        if summary["failed"] > 0:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -9,7 +9,12 @@ import numpy as np
 from numba import njit, float64, complex128, prange
 from casacore.tables import table
 from astropy.constants import c; c = c.value
+import astropy.units as u
+from astropy.time import Time
 from argparse import ArgumentParser
+
+from gleam_x.utils.array_geometry import antenna_layout
+from gleam_x.utils.ms_io import row_blocks, DEFAULT_BLOCK_SIZE
 # from radical import phaserotate
 
 logging.basicConfig(format="%(levelname)s (%(module)s): %(message)s")
@@ -31,17 +36,12 @@ class MeasurementSet(object):
         self.lambdas = c / self.freqs
         self.midlambda = c / self.midfreq
 
-        # Calculate antenna positions wrt refant antenna
-        times = sorted(set(mset.getcol('TIME')))
-        self.midtime = times[len(times) // 2]
-        (_U, _V, _), antennas = -mset.getcol('UVW').T, mset.getcol('ANTENNA2')
-
-
-        # Force U, V indices to align with antenna IDs
-        self.U = np.zeros_like(self.antids, dtype=np.float64)
-        self.U[antennas] = _U
-        self.V = np.zeros_like(self.antids, dtype=np.float64)
-        self.V[antennas] = _V
+        # Antenna positions wrt refant antenna are derived from the cached
+        # ANTENNA table when first used, rather than from the full UVW column
+        self.filename = filename
+        self.refant = refant
+        self._midtime = None
+        self._antenna_uvw = None
 
         # Load data and associated row information
         # Filter out flagged rows, and autocorrelations
@@ -53,13 +53,38 @@ class MeasurementSet(object):
         self._data = None
         self.colnames = mset.colnames()
         if datacolumn is None:
-            datacolumn = ["DATA"]
-            if "CORRECTED_DATA" in self.colnames:
-                datacolumn.append("CORRECTED_DATA")
-            if "MODEL_DATA" in self.colnames:
-                datacolumn.append("MODEL_DATA")
+            datacolumn = default_datacolumns(self.colnames)
         self.datacolumn = datacolumn
 
+    @property
+    def midtime(self):
+        if self._midtime is None:
+            times = np.unique(self.mset.getcol('TIME'))
+            self._midtime = times[len(times) // 2]
+        return self._midtime
+
+    @property
+    def antenna_uvw(self):
+        """uvw of every antenna relative to the reference antenna, towards the
+        phase centre at the middle of the observation"""
+        if self._antenna_uvw is None:
+            layout = antenna_layout(self.filename)
+            lst = Time(self.midtime / 86400.0, format='mjd', scale='utc').sidereal_time(
+                'apparent', longitude=layout.lon * u.deg
+            ).rad
+            self._antenna_uvw = layout.baseline_uvw(
+                np.full_like(self.antids, self.refant), self.antids, lst - self.ra0, self.dec0
+            )
+        return self._antenna_uvw
+
+    @property
+    def U(self):
+        return self.antenna_uvw[:, 0]
+
+    @property
+    def V(self):
+        return self.antenna_uvw[:, 1]
+
     @property
     def data(self):
         if self._data is None:
@@ -135,14 +160,89 @@ def woffset(data, oldw, neww, lambdas):
     return data * np.exp(phase)
 
 
-def do_rotate(msname, ra, dec, datacolumn):
+def phase_factor(oldw, neww, lambdas):
+    """Phase rotation of each row and channel for a change of w, shared by all
+    of the polarisations and data columns of those rows
+    """
+    offset = -2 * np.pi * (neww - oldw)
+    phase = offset[:, None] / lambdas[None, :]
+
+    factor = np.empty(phase.shape, dtype=np.complex64)
+    factor.real = np.cos(phase)
+    factor.imag = np.sin(phase)
+
+    return factor
+
+
+def default_datacolumns(colnames):
+    datacolumn = ["DATA"]
+    if "CORRECTED_DATA" in colnames:
+        datacolumn.append("CORRECTED_DATA")
+    if "MODEL_DATA" in colnames:
+        datacolumn.append("MODEL_DATA")
+    return datacolumn
+
+
+def stream_rotate(msname, ra, dec, datacolumn, block_size=DEFAULT_BLOCK_SIZE):
+    """Phase rotate a measurement set a block of rows at a time. Each block is 
+    rotated in place in the precision of the data columns and written back, so
+    the memory used is bounded by the block size rather than the size of the 
+    measurement set.
+
+    Args:
+        msname (str): Measurement set to rotate
+        ra (float): New phase centre right ascension in radians
+        dec (float): New phase centre declination in radians
+        datacolumn (list[str]): Data columns to rotate. If None DATA, CORRECTED_DATA and MODEL_DATA are rotated when present
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Returns:
+        tuple[float,float]: The original phase centre in radians
+    """
+    mset = table(msname, readonly=False, ack=False)
+    try:
+        ra0, dec0 = mset.FIELD.getcell('PHASE_DIR', 0)[0]
+        lambdas = c / mset.SPECTRAL_WINDOW.getcell('CHAN_FREQ', 0)
+        if datacolumn is None:
+            datacolumn = default_datacolumns(mset.colnames())
+
+        logger.info("Rotating columns: {}".format(datacolumn))
+        start = tm.time()
+        for startrow, nrow in row_blocks(mset.nrows(), block_size=block_size):
+            uvw = mset.getcol("UVW", startrow=startrow, nrow=nrow)
+            new_uvw = rotateuvw(uvw, ra, dec, ra0, dec0)
+            factor = phase_factor(uvw[:, 2], new_uvw[:, 2], lambdas)[:, :, None]
+
+            for col in datacolumn:
+                data = mset.getcol(col, startrow=startrow, nrow=nrow)
+                data *= factor
+                mset.putcol(col, data, startrow=startrow, nrow=nrow)
+            mset.putcol("UVW", new_uvw, startrow=startrow, nrow=nrow)
+
+        mset.flush()
+        logger.info("Phase rotated visibilities elapsed: {}".format(tm.time() - start))
+    finally:
+        mset.close()
+
+    return ra0, dec0
+
+
+def do_rotate(msname, ra, dec, datacolumn, in_memory=False, block_size=DEFAULT_BLOCK_SIZE):
     """
     """
 
-    ms = MeasurementSet(msname, datacolumn=datacolumn)
     ra = np.radians(ra)
     dec = np.radians(dec)
 
+    if not in_memory:
+        stream_rotate(msname, ra, dec, datacolumn, block_size=block_size)
+        set_phase_dir(msname, ra, dec)
+        return
+
+    ms = MeasurementSet(msname, datacolumn=datacolumn)
+
     logger.info("Rotating columns: {}".format(ms.datacolumn))
     uvw, rotated = phase_rotate(uvw=ms.uvw, 
         data=ms.data,
@@ -158,6 +258,10 @@ def do_rotate(msname, ra, dec, datacolumn):
     ms.mset.flush()
     ms.mset.close()
 
+    set_phase_dir(msname, ra, dec)
+
+
+def set_phase_dir(msname, ra, dec):
     field = table(msname+"/FIELD", readonly=False, ack=False)
     field.putcell('PHASE_DIR', 0, np.array([[ra, dec]]))
     field.flush()
@@ -173,9 +277,16 @@ def main():
     ps.add_argument("dec", type=float)
     ps.add_argument("-c", "--datacolumn", "--data-column", 
         dest="datacolumn", type=str, default=None, nargs="*")
+    ps.add_argument("-b", "--block-size", dest="block_size", type=int, 
+        default=DEFAULT_BLOCK_SIZE, 
+        help="Number of rows rotated at a time. [Default {}]".format(DEFAULT_BLOCK_SIZE))
+    ps.add_argument("--in-memory", dest="in_memory", action="store_true", 
+        help="Read the full data columns into memory and rotate them in double "
+             "precision, rather than streaming blocks of rows.")
     args = ps.parse_args()
 
-    do_rotate(args.msname, args.ra, args.dec, args.datacolumn)
+    do_rotate(args.msname, args.ra, args.dec, args.datacolumn, 
+        in_memory=args.in_memory, block_size=args.block_size)
 
 
 if __name__ == "__main__":
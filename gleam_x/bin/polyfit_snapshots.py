@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 from math import ceil
 
 from astropy.time import Time
@@ -23,6 +24,31 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 
 import argparse
+from functools import partial
+
+from gleam_x.utils.crossmatch import SkyIndex, crossmatch_to_file
+from gleam_x.utils.correction_screen import evaluate_screen, polynomial_correction
+
+# Crossmatch radius between the source-finding results and the sky model
+MATCH_RADIUS = 45  # arcseconds
+
+# Reference catalogue and index shared with crossmatch workers
+_matcher = {}
+
+# Correction screens, keyed by image shape, shared with rescale workers
+_screens = {}
+
+# Columns of the source-finding catalogues which use the flux density
+FLUX_COLUMNS = [
+    "background",
+    "local_rms",
+    "peak_flux",
+    "err_peak_flux",
+    "int_flux",
+    "err_int_flux",
+    "residual_mean",
+    "residual_std",
+]
 
 
 def make_plot(x, y, w, model, title, ylabel, outname):
@@ -89,6 +115,144 @@ def sigma_clip(ratios, n=1):
     return ind
 
 
+def snapshot_correction(ra, dec, P_dec, P_ra=None, ra_cent=0.0):
+    """Multiplicative flux density correction at the supplied positions. We generated
+    log10 ratios so use 10^ to get back to raw correction e.g. a 4th order polynomial
+    would look like: corr = 10** ( a*(Dec)^3 + b*(Dec)^2 + c*Dec + d)
+
+    Args:
+        ra (np.ndarray): Right ascension in degrees
+        dec (np.ndarray): Declination in degrees
+        P_dec (np.ndarray): Polynomial coefficients of the declination correction
+        P_ra (np.ndarray, optional): Polynomial coefficients of the RA-offset correction. Defaults to None.
+        ra_cent (float, optional): RA the offsets are measured from. Defaults to 0.0.
+
+    Returns:
+        np.ndarray: The correction factor
+    """
+    corr = polynomial_correction(P_dec, dec)
+    if P_ra is not None:
+        corr = corr * polynomial_correction(P_ra, ra - ra_cent)
+
+    return corr
+
+
+def metafits_ra(fitsimage):
+    """The pointing RA of a snapshot from its metafits. The metafits is better for
+    the RA than the image, because of the denormal projection
+    """
+    path, fl = os.path.split(fitsimage)
+    metafits = glob.glob("{0}/{1}*metafits*".format(path, fl[0:10]))
+    metafits = metafits[0]
+    meta = fits.getheader(metafits)
+
+    return meta["RA"]
+
+
+def init_matcher(index, skymodel, skymodel_path):
+    """Set the sky model index used by ``match_snapshot``, once per worker process"""
+    _matcher["index"] = index
+    _matcher["table"] = skymodel
+    _matcher["path"] = skymodel_path
+
+
+def match_snapshot(fitsimage, outsuf=""):
+    """Crossmatch the source-finding results of a snapshot against the sky model.
+    A previously matched catalogue is reused if it was made from the current
+    source-finding results and sky model.
+
+    Args:
+        fitsimage (str): Snapshot image, with a corresponding _comp.fits catalogue
+        outsuf (str, optional): Suffix added to the matched catalogue name. Defaults to "".
+
+    Returns:
+        str: Path to the matched catalogue, or None if there are no source-finding results
+    """
+    sf = fitsimage.replace(".fits", "_comp.fits")
+    sfm = fitsimage.replace(".fits", f"_comp_matched{outsuf}.fits")
+
+    if not os.path.exists(sf):
+        # Fall back to an existing match if the source-finding has since been removed
+        return sfm if os.path.exists(sfm) else None
+
+    if "index" not in _matcher:
+        # Without a sky model only existing matches can be used
+        return sfm if os.path.exists(sfm) else None
+
+    nmatch = crossmatch_to_file(
+        sf,
+        sfm,
+        _matcher["index"],
+        _matcher["table"],
+        MATCH_RADIUS,
+        ref_path=_matcher["path"],
+    )
+    if nmatch >= 0:
+        print("Matched {0} sources for {1}".format(nmatch, fitsimage))
+
+    return sfm
+
+
+def image_shape(infits):
+    """Shape of the primary image of a FITS file, read from its header"""
+    hdr = fits.getheader(infits)
+    return tuple(hdr[f"NAXIS{i}"] for i in range(hdr["NAXIS"], 0, -1))
+
+
+def share_screen(screen_shape, dtype=np.float32):
+    """Allocate a correction screen in shared memory
+
+    Returns:
+        tuple[SharedMemory, np.ndarray]: The shared memory block and an array backed by it
+    """
+    dtype = np.dtype(dtype)
+    shm = SharedMemory(create=True, size=int(np.prod(screen_shape)) * dtype.itemsize)
+    screen = np.ndarray(screen_shape, dtype=dtype, buffer=shm.buf)
+
+    return shm, screen
+
+
+def init_screens(specs):
+    """Attach to the shared memory correction screens, once per worker process
+
+    Args:
+        specs (dict): Image shape to the (shared memory name, screen shape, dtype) of its screen
+    """
+    for img_shape, (name, screen_shape, dtype) in specs.items():
+        shm = SharedMemory(name=name)
+        _screens[img_shape] = (shm, np.ndarray(screen_shape, dtype=dtype, buffer=shm.buf))
+
+
+def rescale_file(infits, outfits, correction):
+    """Write a rescaled copy of an image or source-finding catalogue. Images are
+    multiplied by the shared correction screen for their shape, catalogues have
+    their flux density columns corrected at each source position.
+
+    Args:
+        infits (str): Image or catalogue to rescale
+        outfits (str): Output file
+        correction (Callable): Correction as a function of RA and Dec, used for catalogues
+    """
+    print("Creating {0} from {1}".format(outfits, infits))
+    # Modify each fits file to produce a new version
+    hdu_in = fits.open(infits)
+    if hdu_in[0].data is None:
+        # Then it is a source-finding catalogue not an image
+        cat = hdu_in[1].data
+        cat_corr = correction(cat["ra"], cat["dec"])
+        for col in FLUX_COLUMNS:
+            cat[col] *= cat_corr
+    else:
+        # This is an image not a source-finding catalogue
+        _, screen = _screens[hdu_in[0].data.shape]
+        hdu_in[0].data = np.array(screen * hdu_in[0].data, dtype=np.float32)
+
+    hdu_in.writeto(outfits, overwrite=True)
+    hdu_in.close()
+
+    return outfits
+
+
 parser = argparse.ArgumentParser()
 group1 = parser.add_argument_group("Input files")
 group1.add_argument(
@@ -130,6 +294,13 @@ group2.add_argument(
     type=int,
     help="Set the order of the polynomial fit. (default = 5)",
 )
+group2.add_argument(
+    "--cores",
+    dest="cores",
+    default=1,
+    type=int,
+    help="Number of processes used to crossmatch the snapshots and write the rescaled files (default = 1)",
+)
 group2.add_argument(
     "--ra",
     action="store_true",
@@ -242,27 +413,30 @@ else:
 
     obsids = []
 
-    for fitsimage in infiles:
-        sf = fitsimage.replace(".fits", "_comp.fits")
-        sfm = fitsimage.replace(".fits", f"_comp_matched{outsuf}.fits")
+    # Cross-match with a sky model to get model flux densities. The sky model is
+    # indexed once, and the snapshots are matched against it concurrently
+    if results.skymodel is not None:
+        skymodel = Table.read(results.skymodel)
+        index = SkyIndex.from_table(skymodel, ra_col="RAJ2000", dec_col="DEJ2000")
+        initargs = (index, skymodel, results.skymodel)
+    else:
+        initargs = None
 
-        # Cross-match with a sky model to get model flux densities
-        if not os.path.exists(sfm):
+    match = partial(match_snapshot, outsuf=outsuf)
+    if results.cores > 1 and initargs is not None:
+        with Pool(results.cores, initializer=init_matcher, initargs=initargs) as pool:
+            matched = pool.map(match, infiles)
+    else:
+        if initargs is not None:
+            init_matcher(*initargs)
+        matched = [match(fitsimage) for fitsimage in infiles]
+
+    for fitsimage, sfm in zip(infiles, matched):
+        if sfm is None:
             # Rely on the user running Aegean and just fail if the source-finding isn't there
-            if not os.path.exists(sf):
-                print("Source-finding results for {0} not found".format(fitsimage))
-                sys.exit(1)
-
-            os.system(
-                'stilts tmatch2 \
-            values1="RAJ2000 DEJ2000" \
-            values2="ra dec" \
-            in1={0} in2={1} \
-            matcher=sky params=45 \
-            out={2}'.format(
-                    results.skymodel, sf, sfm
-                )
-            )
+            print("Source-finding results for {0} not found".format(fitsimage))
+            sys.exit(1)
+
         gpstime = Time(int(fitsimage[0:10]), format="gps")
 
         # We get this from the FITS image rather than the metafits because I make sub-band images
@@ -270,11 +444,7 @@ else:
         centfreq = hdr["CRVAL3"] / 1.0e6  # MHz
 
         # But the metafits is better for the RA, because of the denormal projection
-        path, _ = os.path.split(fitsimage)
-        metafits = glob.glob("{0}/{1}*metafits*".format(path, fitsimage[0:10]))
-        metafits = metafits[0]
-        meta = fits.getheader(metafits)
-        ra_cent = meta["RA"]
+        ra_cent = metafits_ra(fitsimage)
 
         # Get the cross-matched catalogue
         hdu = fits.open(sfm)
@@ -459,129 +629,77 @@ else:
 
 if results.do_rescale is True:
 
-    # Create a cache for correction screens with the same image size
+    if results.correct_ra is not True:
+        P_ra = None
+
+    if results.correct_all is True:
+        extlist = ["", "_bkg", "_rms", "_weight", "_comp"]
+    else:
+        extlist = [""]
+
+    # Create a cache for correction screens with the same image size. The
+    # screens are held in shared memory so the workers do not receive copies.
     corr = {}
+    jobs = []
 
-    for item, fitsimage in enumerate(infiles):
-        print("{0} of {1}) {2}".format(item + 1, len(infiles), fitsimage))
-        if results.correct_all is True:
-            extlist = ["", "_bkg", "_rms", "_weight", "_comp"]
-        else:
-            extlist = [""]
+    try:
+        for item, fitsimage in enumerate(infiles):
+            print("{0} of {1}) {2}".format(item + 1, len(infiles), fitsimage))
 
-        for ext in extlist:
-            infits = fitsimage.replace(".fits", ext + ".fits")
-            outfits = infits.replace(
-                ext + ".fits", f"_rescaled{outsuf}" + ext + ".fits"
+            # going to need the RA in order to calculate the RA offsets
+            ra_cent = metafits_ra(fitsimage)
+            correction = partial(
+                snapshot_correction, P_dec=P_dec, P_ra=P_ra, ra_cent=ra_cent
             )
 
-            if (not os.path.exists(outfits)) or results.overwrite is True:
-                print("Creating {0} from {1}".format(outfits, infits))
-                # Modify each fits file to produce a new version
-                hdu_in = fits.open(infits)
-                if hdu_in[0].data is None:
-                    # Then it is a source-finding catalogue not an image
-                    cat = hdu_in[1].data
-                    dec = cat["dec"]
-                    dec_corr = np.zeros(dec.shape)
-                    ra_corr = np.zeros(ra.shape)
-                    # We generated log10 ratios so use 10^ to get back to raw correction
-                    # e.g. a 4th order polynomial would look like:
-                    # corr = 10** ( a*(Dec)^3 + b*(Dec)^2 + c*Dec + d)
-                    for i in range(0, results.poly_order + 1):
-                        dec_corr += P_dec[i] * pow(dec, results.poly_order - i)
-                    dec_corr = 10 ** dec_corr
-                    # Obviously only modify columns which use the flux density
-                    cols = [
-                        "background",
-                        "local_rms",
-                        "peak_flux",
-                        "err_peak_flux",
-                        "int_flux",
-                        "err_int_flux",
-                        "residual_mean",
-                        "residual_std",
-                    ]
-                    for col in cols:
-                        cat[col] *= dec_corr
-
-                    if results.correct_ra is True:
-                        for i in range(0, results.poly_order + 1):
-                            ra_corr += P_ra[i] * pow(
-                                ra - ra_cent, results.poly_order - i
-                            )
-                        ra_corr = 10 ** ra_corr
-                        for col in cols:
-                            cat[col] *= ra_corr
-
-                    print("Creating {0}".format(outfits))
-
-                    hdu_in.writeto(outfits, overwrite=True)
-                    hdu_in.close()
-                else:
-                    # This is an image not a source-finding catalogue
+            for ext in extlist:
+                infits = fitsimage.replace(".fits", ext + ".fits")
+                outfits = infits.replace(
+                    ext + ".fits", f"_rescaled{outsuf}" + ext + ".fits"
+                )
+
+                if os.path.exists(outfits) and results.overwrite is not True:
+                    continue
+
+                jobs.append((infits, outfits, correction))
+                if ext == "_comp":
+                    continue
+
+                # Derive the correction screen once, and use it for all image
+                # based fits files. The WCS is evaluated on a decimated grid, and
+                # without the RA term the screen is smooth enough to be
+                # interpolated directly.
+                img_shape = image_shape(infits)
+                if img_shape not in corr.keys():
+                    print(f"Calculation correction screen for shape {img_shape}")
                     # wcs in format [stokes,freq,y,x]; stokes and freq are length 1 if they exist
-                    w = wcs.WCS(hdu_in[0].header, naxis=2)
-                    naxes = hdu_in[0].header["NAXIS"]
-
-                    # going to need the RA in order to calculate the RA offsets
-                    path, fl = os.path.split(infits)
-                    metafits = glob.glob("{0}/{1}*metafits*".format(path, fl[0:10]))
-                    metafits = metafits[0]
-                    meta = fits.getheader(metafits)
-                    ra_cent = meta["RA"]
-                    if naxes == 4:
-                        m, n = 2, 3
-                    elif naxes == 2:
-                        m, n = 0, 1
-
-                    img_shape = hdu_in[0].data.shape
-
-                    # Derive the correction screen once, and use it for all
-                    # image based fits files
-                    if img_shape not in corr.keys():
-                        print(f"Calculation correction screen for shape {img_shape}")
-
-                        # create an array but don't set the values (they are random)
-                        indexes = np.empty(
-                            (hdu_in[0].data.shape[m] * hdu_in[0].data.shape[n], 2),
-                            dtype=int,
-                        )
-                        idx = np.array([(j, 0) for j in range(hdu_in[0].data.shape[n])])
-                        j = hdu_in[0].data.shape[n]
-                        for i in range(hdu_in[0].data.shape[m]):
-                            idx[:, 1] = i
-                            indexes[i * j : (i + 1) * j] = idx
-
-                        # put ALL the pixels into our vectorized functions and minimise our overheads
-                        ra, dec = w.wcs_pix2world(indexes, 1).transpose()
-                        dec_corr = np.zeros(dec.shape)
-                        ra_corr = np.zeros(ra.shape)
-
-                        for i in range(0, results.poly_order + 1):
-                            dec_corr += P_dec[i] * pow(dec, results.poly_order - i)
-                        dec_corr = 10 ** dec_corr
-
-                        if results.correct_ra is True:
-                            for i in range(0, results.poly_order + 1):
-                                ra_corr += P_ra[i] * pow(
-                                    ra - ra_cent, results.poly_order - i
-                                )
-                            ra_corr = 10 ** ra_corr
-                            corr_apply = dec_corr * ra_corr
-
-                        else:
-                            corr_apply = dec_corr
-
-                        corr_apply = corr_apply.reshape(
-                            hdu_in[0].data.shape[m], hdu_in[0].data.shape[n]
-                        )
-                        print(f"Caching correction screen for {img_shape}")
-                        corr[img_shape] = corr_apply
-
-                    hdu_in[0].data = np.array(
-                        corr[img_shape] * hdu_in[0].data, dtype=np.float32
+                    w = wcs.WCS(fits.getheader(infits), naxis=2)
+                    shm, screen = share_screen(img_shape[-2:])
+                    evaluate_screen(
+                        correction,
+                        w,
+                        img_shape[-2:],
+                        out=screen,
+                        origin=1,
+                        smooth=results.correct_ra is not True,
                     )
-
-                    hdu_in.writeto(outfits, overwrite=True)
-                    hdu_in.close()
+                    print(f"Caching correction screen for {img_shape}")
+                    corr[img_shape] = (shm, screen)
+
+        if results.cores > 1 and len(jobs) > 1:
+            specs = {
+                img_shape: (shm.name, screen.shape, screen.dtype)
+                for img_shape, (shm, screen) in corr.items()
+            }
+            with Pool(results.cores, initializer=init_screens, initargs=(specs,)) as pool:
+                pool.starmap(rescale_file, jobs, chunksize=1)
+        else:
+            _screens.update(corr)
+            for job in jobs:
+                rescale_file(*job)
+    finally:
+        _screens.clear()
+        for shm, screen in corr.values():
+            del screen
+            shm.close()
+            shm.unlink()
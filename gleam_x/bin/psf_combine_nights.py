@@ -1,6 +1,8 @@
 #! /usr/bin/env python
 
+import os
 import sys
+import json
 import numpy as np
 import logging, warnings
 import matplotlib.pyplot as plt
@@ -8,11 +10,13 @@ from astropy.io import fits
 from argparse import ArgumentParser
 from typing import Iterable, Tuple
 from astropy.wcs import WCS
-from astropy.nddata import Cutout2D
-from astropy.nddata.utils import NoOverlapError
 from astropy.utils.exceptions import AstropyWarning
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 
+from gleam_x.utils.box_mean import BoxMean
+
 warnings.simplefilter("ignore", category=AstropyWarning)
 
 logger = logging.getLogger(__name__)
@@ -22,110 +26,247 @@ logger.addHandler(logging.StreamHandler())
 PLOT = False  # Was only used throughout debugging.
 
 
-def weighted_mean(maps: np.ndarray, weights: np.ndarray = None):
-    """Perform the means through and array of shape (N,X,Y)
-
-    Args:
-        maps (np.ndarray): Input maps to average
-        weights (bool, optional): Weight the mean by the inverse variance. Defaults to None.
-    """
-    logger.debug(f"weight_mean maps shape is {maps.shape}")
-    logger.info(f"Calculating weighted average...")
-
-    if weights is None:
-        logger.info("No weights specific, assuming equal weights. ")
-    else:
-        weights = np.ma.masked_array(weights, np.isnan(weights))
-
-    masked_maps = np.ma.masked_array(maps, np.isnan(maps))
-
-    data = np.ma.average(masked_maps, axis=0, weights=weights).filled(np.nan)
-
-    logger.debug(f"weight_mean averaged shape is {data.shape}")
-
-    return data
-
-
-def calculate_weights(
-    psfs: Iterable[str],
-    rmss: Iterable[str],
+def night_box_rms(
+    psf: str,
+    rms: str,
     nan_fill: float = np.nan,
-    progress: bool = False,
     box_size: Tuple[int, int] = (50, 50),
-):
-    """Calculate the weights for the provided RMS files
+) -> np.ndarray:
+    """Average RMS in a box around the position of each pixel of a PSF map. The box
+    means of the whole RMS map are computed from its integral images, and sampled
+    at every PSF pixel at once.
 
     Args:
-        psfs (Iterable[str]): Path to PSF fit cubes
-        rmss (Iterable[sre]): Path to the coadded RMS files
-    
+        psf (str): Path to a PSF fit cube
+        rms (str): Path to the coadded RMS file of the same night
+
     Keyword Args:
-        nan_fill (float): Value to use when NaNs are found for the RMS std
+        nan_fill (float): Value to use when there are no valid RMS pixels in a box
         box_size (tuple[int, int]): Box size in pixels to use when calculating the average RMS (Defaults: (50, 50))
-    """
-    weight_cube = []
-    for psf, rms in zip(psfs, rmss):
-        logger.info(f"Calculating average RMS across {psf}")
-        logger.info(f"Box size for each sampling is {box_size}")
-        with fits.open(psf) as psf_fits, fits.open(rms) as rms_fits:
-
-            # psf fits images have (bmaj, bmin, bpa, blur) images. The first will do.
-            idxs = np.indices(psf_fits[0].data[0].shape).reshape((2, -1))
-            psf_wcs = WCS(psf_fits[0].header).celestial
-            psf_sky = psf_wcs.pixel_to_world(idxs[1], idxs[0])
 
-            rms_wcs = WCS(rms_fits[0].header)
+    Returns:
+        np.ndarray: The average RMS, with the shape of a single PSF map plane
+    """
+    logger.info(f"Calculating average RMS across {psf}")
+    logger.info(f"Box size for each sampling is {box_size}")
+    with fits.open(psf) as psf_fits, fits.open(rms) as rms_fits:
+        # psf fits images have (bmaj, bmin, bpa, blur) images. The first will do.
+        psf_shape = psf_fits[0].data[0].shape
+        idxs = np.indices(psf_shape).reshape((2, -1))
+        psf_wcs = WCS(psf_fits[0].header).celestial
+        psf_sky = psf_wcs.pixel_to_world(idxs[1], idxs[0])
 
-            logger.debug(f"Shape of psf_fits {psf}: {psf_fits[0].data.shape}")
-            logger.debug(f"Shape for rms_fits is {rms_fits[0].data.shape}")
+        rms_wcs = WCS(rms_fits[0].header).celestial
 
-            rms_img = np.zeros_like(idxs[0], dtype=np.float32)
-            valid = 0
-            for idx, pos_sky in tqdm(enumerate(psf_sky), disable=not progress):
-                try:
-                    d = Cutout2D(
-                        rms_fits[0].data,
-                        pos_sky,
-                        wcs=rms_wcs,
-                        size=box_size,
-                        fill_value=np.nan,
-                        mode="partial",
-                    )
-                    if np.all(np.isnan(d.data)):
-                        pos_rms = nan_fill
-                    else:
-                        pos_rms = np.nanmean(d.data)
-                        valid += 1
-                except NoOverlapError:
-                    pos_rms = nan_fill
-                except ValueError:
-                    pos_rms = nan_fill
+        logger.debug(f"Shape of psf_fits {psf}: {psf_fits[0].data.shape}")
+        logger.debug(f"Shape for rms_fits is {rms_fits[0].data.shape}")
 
-                rms_img[idx] = pos_rms
+        rms_x, rms_y = rms_wcs.world_to_pixel(psf_sky)
+        box_mean = BoxMean(rms_fits[0].data)
 
-            rms_img = rms_img.reshape(psf_fits[0].data[0].shape)
-            weight_cube.append(rms_img)
+    rms_img, counts = box_mean.sample(rms_y, rms_x, box_size, fill_value=nan_fill)
+    rms_img = rms_img.astype(np.float32).reshape(psf_shape)
 
-            logger.debug(f"Value of rms_img for {psf} is {np.nansum(rms_img)}")
-            logger.debug(f"...... max is {np.nanmax(rms_img)}")
-            logger.debug(f"...... max is {np.nanmin(rms_img)}")
-            logger.debug(f"Number of valid pixels {valid}")
+    logger.debug(f"Value of rms_img for {psf} is {np.nansum(rms_img)}")
+    logger.debug(f"...... max is {np.nanmax(rms_img)}")
+    logger.debug(f"...... max is {np.nanmin(rms_img)}")
+    logger.debug(f"Number of valid pixels {np.sum(counts > 0)}")
 
-            if PLOT:
-                fig, ax = plt.subplots(1, 1)
+    if PLOT:
+        fig, ax = plt.subplots(1, 1)
 
-                ax.imshow(rms_img)
+        ax.imshow(rms_img)
 
-                fig.savefig(f"{psf}.rms.png")
+        fig.savefig(f"{psf}.rms.png")
 
-                fig, ax = plt.subplots(1, 1)
+    return rms_img
 
-                ax.imshow(psf_fits[0].data[0])
 
-                fig.savefig(f"{psf}.slice0.png")
+class PSFAccumulator:
+    """Running inverse variance weighted sums of PSF cubes, so that nights are added
+    one at a time and peak memory does not depend on the number of nights. When
+    given a directory the sums are memory-mapped from it, along with a record of
+    the nights already added, so a later run can add new nights without redoing
+    the others. Each night is recorded with the sizes and modification times of its
+    files, along with the weighting scheme, so a state that no longer matches the
+    nights can be detected.
+    """
 
-    logger.info("Inverting collected average RMS into weights")
-    return 1.0 / np.array(weight_cube) ** 2
+    STATE = "state.json"
+    ARRAYS = ("weighted_sum", "weight_sum", "counts")
+
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        header: fits.Header,
+        path: str = None,
+        weighting: dict = None,
+    ):
+        """
+        Args:
+            shape (tuple[int, ...]): Shape of each PSF cube, (beamparams, decpixs, rapixs)
+            header (fits.Header): Header used for the combined cube
+
+        Keyword Args:
+            path (str): Directory to persist the running sums in. If None they are held in memory (Default: None)
+            weighting (dict): Parameters of the weighting scheme the nights are added with (Default: None)
+        """
+        self.shape = tuple(shape)
+        self.header = header
+        self.path = path
+        self.weighting = weighting
+        self.nights = []
+
+        dtypes = (np.float64, np.float64, np.int32)
+        if path is None:
+            arrays = [np.zeros(self.shape, dtype=d) for d in dtypes]
+        else:
+            os.makedirs(path, exist_ok=True)
+            arrays = [
+                np.lib.format.open_memmap(
+                    f"{path}/{name}.npy", mode="w+", dtype=d, shape=self.shape
+                )
+                for name, d in zip(self.ARRAYS, dtypes)
+            ]
+            header.totextfile(f"{path}/header.txt", overwrite=True)
+            self._write_state()
+
+        self.weighted_sum, self.weight_sum, self.counts = arrays
+
+    @classmethod
+    def open(cls, path: str) -> "PSFAccumulator":
+        """Resume the running sums persisted in a directory
+
+        Args:
+            path (str): Directory previously used to persist an accumulator
+        """
+        with open(f"{path}/{cls.STATE}", "r") as infile:
+            state = json.load(infile)
+
+        if state["pending"] is not None:
+            raise RuntimeError(
+                f"{path} was interrupted while adding {state['pending']}. Remove it and combine all nights again."
+            )
+
+        acc = cls.__new__(cls)
+        acc.shape = tuple(state["shape"])
+        acc.header = fits.Header.fromtextfile(f"{path}/header.txt")
+        acc.path = path
+        acc.weighting = state.get("weighting")
+        acc.nights = state["nights"]
+        acc.weighted_sum, acc.weight_sum, acc.counts = [
+            np.load(f"{path}/{name}.npy", mmap_mode="r+") for name in cls.ARRAYS
+        ]
+
+        return acc
+
+    def _write_state(self, pending: str = None):
+        state = {
+            "shape": self.shape,
+            "weighting": self.weighting,
+            "nights": self.nights,
+            "pending": pending,
+        }
+        tmp = f"{self.path}/{self.STATE}.tmp"
+        with open(tmp, "w") as out:
+            json.dump(state, out, indent=2)
+        os.replace(tmp, f"{self.path}/{self.STATE}")
+
+    def __contains__(self, psf: str) -> bool:
+        return any(night["psf"] == psf for night in self.nights)
+
+    def stale(self, nights: Iterable[dict], weighting: dict = None) -> str:
+        """Why the running sums can not be extended to a set of nights, None if they can.
+        Nights can only be added, a night that was removed or whose files changed since
+        it was added can not be taken back out.
+
+        Args:
+            nights (Iterable[dict]): Records of the nights to combine, see ``night_record``
+
+        Keyword Args:
+            weighting (dict): Parameters of the weighting scheme to use (Default: None)
+
+        Returns:
+            str: The reason, or None
+        """
+        if self.weighting != weighting:
+            return f"the weighting changed from {self.weighting} to {weighting}"
+
+        current = {night["psf"]: night for night in nights}
+        for night in self.nights:
+            if not isinstance(night, dict):
+                return "the nights were recorded without their file details"
+            if night["psf"] not in current:
+                return f"{night['psf']} is no longer listed"
+            if night != current[night["psf"]]:
+                return f"{night['psf']} has changed since it was added"
+
+        return None
+
+    def add(self, night: dict, psf_data: np.ndarray, weights: np.ndarray = None):
+        """Add a night to the running sums
+
+        Args:
+            night (dict): Record of the night, see ``night_record``
+            psf_data (np.ndarray): PSF cube of the night, (beamparams, decpixs, rapixs)
+
+        Keyword Args:
+            weights (np.ndarray): Weight of each pixel, (decpixs, rapixs). If None all pixels have unit weight (Default: None)
+        """
+        if psf_data.shape != self.shape:
+            raise ValueError(
+                f"Shape of {night['psf']} {psf_data.shape} does not match the combined shape {self.shape}"
+            )
+
+        weights = np.ones(self.shape[1:]) if weights is None else weights
+        valid = np.isfinite(psf_data) & np.isfinite(weights)
+
+        if self.path is not None:
+            self._write_state(pending=night["psf"])
+
+        self.weighted_sum += np.where(valid, psf_data * weights, 0.0)
+        self.weight_sum += np.where(valid, weights, 0.0)
+        self.counts += valid
+
+        self.nights.append(night)
+        if self.path is not None:
+            for arr in (self.weighted_sum, self.weight_sum, self.counts):
+                arr.flush()
+            self._write_state()
+
+    def mean(self) -> np.ndarray:
+        """The weighted mean of the nights added so far, NaN where no night contributes"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(
+                self.weight_sum != 0, self.weighted_sum / self.weight_sum, np.nan
+            ).astype(np.float32)
+
+
+def _file_stat(path: str) -> list:
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def night_record(psf: str, rms: str = None) -> dict:
+    """Paths, sizes and modification times of the PSF cube and RMS map of a night"""
+    return {
+        "psf": psf,
+        "psf_stat": _file_stat(psf),
+        "rms": rms,
+        "rms_stat": None if rms is None else _file_stat(rms),
+    }
+
+
+def _night_weights(
+    night: Tuple[str, str], box_size: Tuple[int, int] = (50, 50)
+) -> np.ndarray:
+    """Inverse variance weights of a single (psf, rms) night, from its average RMS"""
+    return 1.0 / night_box_rms(*night, box_size=box_size) ** 2
+
+
+def _night_data(psf: str) -> Tuple[np.ndarray, fits.Header]:
+    with fits.open(psf) as psf_fits:
+        return np.array(psf_fits[0].data), psf_fits[0].header
 
 
 def combine_psf_cubes(
@@ -134,8 +275,10 @@ def combine_psf_cubes(
     output: str = None,
     progress: bool = False,
     box_size: Tuple[int, int] = (50, 50),
+    cores: int = 1,
+    state: str = None,
 ):
-    """Combine the psf cubes.
+    """Combine the psf cubes. Nights are added one at a time to running weighted sums.
 
     Args:
         psfs (Iterable[str]): Paths to the psf cubes to process
@@ -143,36 +286,75 @@ def combine_psf_cubes(
     Keywords Args:
         rmss (Iterable[str]): Paths to the rms files that are used to weight each cube (Defaults: None)
         output (str): If not NOne, sets the path to save the averaged PSF parameters to. The header of the first 'psfs' will be used. (Default: None)
-        progress (bool): Display a progress bar when calculating the weights (Default: False)
+        progress (bool): Display a progress bar over the nights (Default: False)
         box_size (tuple[int, int]): Box size in pixels to use when calculating the average RMS (Defaults: (50, 50))
+        cores (int): Number of nights to process in parallel when calculating the weights (Default: 1)
+        state (str): Directory to persist the running sums in. Nights already added to it are skipped, so new nights can be added to an earlier combination. If a night was removed or changed, or the weighting differs, every night is combined again (Default: None)
+
+    Returns:
+        np.ndarray: The combined psf cube
     """
-    weights = None
+    psfs = list(psfs)
     if rmss is not None:
+        rmss = list(rmss)
         assert len(psfs) == len(
             rmss
         ), f"The number of psfs ({len(psfs)}) and rms ({len(rmss)}) maps do not match."
 
-        # Output shape will be (nfiles, decpixs, rapixs)
-        weights = calculate_weights(psfs, rmss, progress=progress, box_size=box_size)
-        logger.debug(f"Computed weight shape is {weights.shape}")
-
-    psf_fits = [fits.open(p) for p in psfs]
-
-    # shape is (nfiles, beamsparams, decpixs, rapixs)
-    # switch the nfiles and beams around
-    psf_data = np.array([psf[0].data for psf in psf_fits])
-    psf_data = psf_data.swapaxes(0, 1)
-    logger.debug(f"PSF data cube shape is {psf_data.shape}")
-
-    # Iterating over beamparams means same shape as weights computed above
-    psf_cube = np.array([weighted_mean(i, weights=weights) for i in psf_data])
+    records = [
+        night_record(psf, None if rmss is None else rmss[i]) for i, psf in enumerate(psfs)
+    ]
+    # the box size only matters when the nights are weighted by their rms
+    weighting = {
+        "rms": rmss is not None,
+        "box_size": None if rmss is None else [int(b) for b in box_size],
+    }
+
+    acc = None
+    if state is not None and os.path.exists(f"{state}/{PSFAccumulator.STATE}"):
+        acc = PSFAccumulator.open(state)
+        reason = acc.stale(records, weighting=weighting)
+        if reason is None:
+            logger.info(f"Resuming from {state} with {len(acc.nights)} nights")
+        else:
+            logger.warning(f"Combining all nights again in {state}, {reason}")
+            acc = None
+
+    todo = [i for i, psf in enumerate(psfs) if acc is None or psf not in acc]
+    logger.info(f"Adding {len(todo)} of {len(psfs)} nights")
+
+    weights = [None] * len(todo)
+    pool = None
+    if rmss is not None and len(todo) > 0:
+        task = partial(_night_weights, box_size=tuple(box_size))
+        nights = [(psfs[i], rmss[i]) for i in todo]
+        if cores > 1 and len(todo) > 1:
+            pool = Pool(min(cores, len(todo)))
+            weights = pool.imap(task, nights)
+        else:
+            weights = map(task, nights)
+
+    try:
+        for i, weight in tqdm(zip(todo, weights), total=len(todo), disable=not progress):
+            psf_data, header = _night_data(psfs[i])
+            if acc is None:
+                acc = PSFAccumulator(psf_data.shape, header, path=state, weighting=weighting)
+            acc.add(records[i], psf_data, weights=weight)
+            logger.debug(f"Added {psfs[i]}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if acc is None:
+        raise ValueError("No psf cubes were supplied")
+
+    psf_cube = acc.mean()
     logger.debug(f"Average pdf data cube is {psf_cube.shape}")
 
     if output is not None:
         logger.info(f"Creating output file {output}")
-        fits.writeto(
-            output, data=psf_cube, header=psf_fits[0][0].header, overwrite=True
-        )
+        fits.writeto(output, data=psf_cube, header=acc.header, overwrite=True)
 
     if PLOT:
         fig, axes = plt.subplots(2, 2)
@@ -183,17 +365,16 @@ def combine_psf_cubes(
         fig.tight_layout()
         fig.savefig("psf_cube.png")
 
-        if weights is not None:
-            sampling = np.sum(np.isfinite(weights), axis=0)
+        fig, ax = plt.subplots(1, 1)
 
-            fig, ax = plt.subplots(1, 1)
+        cim = ax.imshow(acc.counts[0])
+        ax.set(title="Valid Pixels across field")
 
-            cim = ax.imshow(sampling)
-            ax.set(title="Valid Pixels across field")
+        fig.colorbar(cim, label="Number of Valid Pixels")
+        fig.tight_layout()
+        fig.savefig("psf_sampling.png")
 
-            fig.colorbar(cim, label="Number of Valid Pixels")
-            fig.tight_layout()
-            fig.savefig("psf_sampling.png")
+    return psf_cube
 
 
 if __name__ == "__main__":
@@ -231,6 +412,19 @@ if __name__ == "__main__":
         type=int,
         help="Box size, in pixels, to use for each measure of the RMS around a point in the PSF map",
     )
+    parser.add_argument(
+        "-s",
+        "--state",
+        default=None,
+        help="Directory to keep the running weighted sums in. Nights already added to it are skipped, so new nights can be added without redoing the others",
+    )
+    parser.add_argument(
+        "-c",
+        "--cores",
+        default=1,
+        type=int,
+        help="Number of nights whose weights are calculated in parallel",
+    )
 
     args = parser.parse_args()
 
@@ -249,5 +443,7 @@ if __name__ == "__main__":
         output=args.output,
         progress=args.progress,
         box_size=args.box_size,
+        cores=args.cores,
+        state=args.state,
     )
 
@@ -23,6 +23,8 @@ from astropy import wcs
 
 from argparse import ArgumentParser
 
+from gleam_x.utils.healpix_groups import HealpixGroups, neighbourhoods, NO_PIXEL
+
 
 # read table and filter out the dodgy sources
 def read_table(inputfile):
@@ -33,12 +35,9 @@ def read_table(inputfile):
     return Table(hdu[1].data)
 
 
-@np.vectorize
 def unwrap(ang):
     r = ang - 2 * np.pi * (ang // (2 * np.pi))
-    if r > np.pi:
-        r -= 2 * np.pi
-    return r
+    return np.where(r > np.pi, r - 2 * np.pi, r)
 
 
 # add a HEALPix pixel column to the table
@@ -48,28 +47,36 @@ def radec2hpix(ra, dec, order=4):
     return hp.ang2pix(2 ** order, theta, phi)
 
 
-def get_neighbours(pix, order=4, nn=1):
-    neighbours = set([pix])
-    for i in range(nn):
-        for p in neighbours.copy():
-            theta, phi = hp.pix2ang(2 ** order, p)
-            neighbours |= set(hp.pixelfunc.get_all_neighbours(2 ** order, theta, phi))
-            neighbours -= set([-1])
-    return list(neighbours)
+def hpx_to_car(pix_dict, mywcs, shape, order=4):
+    """Project values held per HEALPix pixel onto an image, with every pixel of the
+    image looked up at once
+
+    Args:
+        pix_dict (dict): HEALPix pixel to the tuple of values at that pixel, of which the first four are projected
+        mywcs (astropy.wcs.WCS): WCS of the image
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        order (int): HEALPix order of the pixels (default: 4)
+
+    Returns:
+        numpy.ndarray: Projected values with shape (4, ny, nx), NaN where there is no HEALPix value
+    """
+    ny, nx = shape
+    lookup = np.full((hp.nside2npix(2 ** order) + 1, 4), np.nan, dtype=np.float32)
+    if len(pix_dict) > 0:
+        pixels = np.fromiter(pix_dict.keys(), dtype=np.int64)
+        lookup[pixels] = [v[:4] for v in pix_dict.values()]
+
+    xx, yy = np.meshgrid(np.arange(nx), np.arange(ny))
+    ra, dec = mywcs.all_pix2world(xx, yy, 0)
+    valid = np.isfinite(ra) & np.isfinite(dec)
 
+    # Pixels without valid coordinates index the trailing row of NaNs
+    p = np.full((ny, nx), len(lookup) - 1, dtype=np.int64)
+    p[valid] = radec2hpix(ra[valid], dec[valid], order=order)
 
-def get_h_neighbours(pix, order=4, nn=1):
-    neighbours = set([pix])
-    for i in range(nn):
-        for p in neighbours.copy():
-            theta, phi = hp.pix2ang(2 ** order, p)
-            nb = list(
-                set(hp.pixelfunc.get_all_neighbours(2 ** order, theta, phi)) - set([-1])
-            )
-            nb_theta, nb_phi = zip(*[hp.pix2ang(2 ** order, a) for a in nb])
-            mask = np.where(abs(nb_phi - phi) < 0.1)[0]
-            neighbours |= set(nb[i] for i in mask)
-    return list(neighbours)
+    return np.moveaxis(lookup[p], -1, 0)
 
 
 def main():
@@ -120,52 +127,49 @@ def main():
     table.add_column(ncol)
 
     print("averaging")
-    # iterate over the unique pixels in the data
-
-    pixels = set()
-    for p in set(table["hpx"]):
-        pixels |= set(get_neighbours(p, order=options.order, nn=2))
-    pix_dict = {}
-    missed = []
-    for p in pixels:
-        # find all the neighbours
-        nb = get_neighbours(p, order=options.order)
-        src_mask = np.where(np.in1d(table["hpx"], nb))[0]
-        if sum(src_mask) < 5:
-            missed.append(p)
-        # calculate the median values of a/b/pa
-        blur = np.mean(
-            (table[src_mask]["a"] * table[src_mask]["b"])
-            / (table[src_mask]["psf_a"] * table[src_mask]["psf_b"])
-        )
-        a = np.mean(table[src_mask]["a"]) / 3600.0
-        b = np.mean(table[src_mask]["b"]) / 3600.0
-        pa = np.mean(table[src_mask]["pa"]) if not options.zeropa else 0
-        # blur = np.mean(table[src_mask]['a']*table[src_mask]['b']*np.cos(np.radians(latitude-table[src_mask]['dec']))/(bmaj*bmin*3600*3600))
-
-        nsrc = len(src_mask)
-        pix_dict[p] = (a, b, pa, blur, nsrc)
-
-    print("Number of missed pixels is {0}".format(len(missed)))
-    for p in missed:
-        nb = get_h_neighbours(p, order=options.order, nn=2)
-        src_mask = np.where(np.in1d(table["hpx"], nb))[0]
-        # if sum(src_mask)<5:
-        #     print m, src_mask, 'still missed'
-        #     continue
-        # else:
-        #     print "fixed up",m
-        ## calculate the median values of a/b/pa
-        blur = np.mean(
-            (table[src_mask]["a"] * table[src_mask]["b"])
-            / (table[src_mask]["psf_a"] * table[src_mask]["psf_b"])
-        )
-        a = np.mean(table[src_mask]["a"]) / 3600.0
-        b = np.mean(table[src_mask]["b"]) / 3600.0
-        pa = np.mean(table[src_mask]["pa"]) if not options.zeropa else 0
-        # blur = np.mean(table[src_mask]['a']*table[src_mask]['b']*np.cos(np.radians(latitude-table[src_mask]['dec']))/(bmaj*bmin*3600*3600))
-        nsrc = len(src_mask)
-        pix_dict[p] = (a, b, pa, blur, nsrc)
+    # per-pixel sums of every quantity, from which the means over any set of
+    # neighbouring pixels are formed
+    groups = HealpixGroups(
+        table["hpx"],
+        {
+            "a": table["a"],
+            "b": table["b"],
+            "pa": table["pa"],
+            "blur": (table["a"] * table["b"]) / (table["psf_a"] * table["psf_b"]),
+            "row": np.arange(len(table)),
+        },
+        order=options.order,
+    )
+
+    # the unique pixels in the data, and every pixel within two steps of them
+    pixels = np.unique(neighbourhoods(groups.pixels(), order=options.order, nn=2))
+    pixels = pixels[pixels != NO_PIXEL]
+
+    # all the neighbours of each pixel
+    nb = neighbourhoods(pixels, order=options.order)
+    # a pixel is missed when the summed row indices of its sources is below 5
+    missed = groups.sum("row", nb) < 5
+    print("Number of missed pixels is {0}".format(np.sum(missed)))
+
+    # missed pixels use the sources of their horizontal neighbours instead
+    values = {}
+    for name in ("a", "b", "pa", "blur"):
+        values[name] = groups.mean(name, nb)
+    nsrc = groups.count(nb)
+    if np.any(missed):
+        h_nb = neighbourhoods(pixels[missed], order=options.order, nn=2, max_dphi=0.1)
+        for name in values:
+            values[name][missed] = groups.mean(name, h_nb)
+        nsrc[missed] = groups.count(h_nb)
+
+    # calculate the mean values of a/b/pa
+    a = values["a"] / 3600.0
+    b = values["b"] / 3600.0
+    pa = values["pa"] if not options.zeropa else np.zeros(len(pixels))
+    blur = values["blur"]
+    pix_dict = {
+        p: v for p, v in zip(pixels.tolist(), zip(a, b, pa, blur, nsrc.tolist()))
+    }
 
     print("making car grid")
     # make a grid for our cartesian projection
@@ -200,17 +204,7 @@ def main():
     mywcs = wcs.WCS(header)
     print("projecting hpx->car")
     # for each pixel in the cartesian grid, seek the value from the hpix grid
-    for j in range(ny):
-        for i in range(nx):
-            ra, dec = mywcs.all_pix2world(i, j, 0)
-            if np.all(np.isfinite([ra, dec])):
-                p = radec2hpix(ra, dec, order=options.order)
-            else:
-                p = -1
-            if p in pix_dict.keys():
-                car[:, j, i] = pix_dict[p][:4]
-            else:
-                car[:, j, i] = [np.nan, np.nan, np.nan, np.nan]
+    car[:] = hpx_to_car(pix_dict, mywcs, (ny, nx), order=options.order)
     header["CTYPE3"] = ("Beam", "0=a,1=b,2=pa (degrees),3=blur")
     if options.output is None:
         # Try some common extensions
@@ -2,19 +2,25 @@
 
 from __future__ import print_function, division
 
+import os
 from argparse import ArgumentParser
+from multiprocessing import Pool
 
 import numpy as np
-from astropy.coordinates import SkyCoord
-from astropy import units as u
 from astropy.io import fits
-from astropy.wcs import WCS
 
 import logging
 logging.basicConfig(format="%(levelname)s (%(module)s): %(message)s")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+from gleam_x.utils.solid_angle import (
+    DEFAULT_TILE,
+    SolidAngleFactor,
+    allocate_fits,
+    check_projection,
+)
+
 
 def strip_wcsaxes(hdr):
     """Strip extra axes in a header object."""
@@ -31,119 +37,62 @@ def strip_wcsaxes(hdr):
     return hdr
 
 
-def radec_to_lm(ra, dec, ra0, dec0):
-    """Convert RA,DEC to l,m."""
-
-    l = np.cos(dec)*np.sin(ra-ra0)
-    m = np.sin(dec)*np.cos(dec0) - np.cos(dec)*np.sin(dec0)*np.cos(ra-ra0)
-
-    return l, m
-
-
-def dOmega(ra, dec, ra0, dec0):
-    """Calculate dOmega from RA,DEC.
+def make_sinfactor_map(fitsimage, stride=None, ra0=None, dec0=None,
+                       outname=None, tile=DEFAULT_TILE, threads=1):
+    """Make a map of dOmega for a given image and reference coordinates.
 
-    dOmega = dldm / (1-l^2-m^2)^1/2
+    stride is no longer used, the map is evaluated in tiles of tile x tile pixels
+    on threads threads.
     """
 
-    ra = np.radians(ra)
-    dec = np.radians(dec)
-    ra0 = np.radians(ra0)
-    dec0 = np.radians(dec0)
-
-    l, m = radec_to_lm(ra, dec, ra0, dec0)
-    n = np.sqrt(1 - l**2 - m**2)
-
-    return 1. / n
-
-
-def check_projection(hdr, projections=["SIN", "ZEA"]):
-    """Check that projection == 'SIN'."""
-
-    projection = hdr["CTYPE1"].split("-")[-1]
-
-    if  projection not in projections:
-        raise ValueError("projection is not {}: projection={}".format(
-            projections, projection))
-    else:
-        return projection
-
-
-def make_sinfactor_map(fitsimage, stride=16000000, ra0=None, dec0=None,
-                       outname=None):
-    """Make a map of dOmega for a given image and reference coordinates."""
-
-    hdu = fits.open(fitsimage)
+    hdr = fits.getheader(fitsimage)
     try:
-        projection = check_projection(hdu[0].header)
+        check_projection(hdr)
     except ValueError:
         logger.warning("dOmega factors only valid for SIN projection.")
         raise
-    else:
-
-        shape = np.squeeze(hdu[0].data).shape
-        arr = np.full(shape, np.nan)
 
-        w = WCS(hdu[0].header).celestial
+    if ra0 is None:
+        ra0 = hdr["CRVAL1"]
+    if dec0 is None:
+        dec0 = hdr["CRVAL2"]
 
-        if ra0 is None:
-            ra0 = hdu[0].header["CRVAL1"]
-        if dec0 is None:
-            dec0 = hdu[0].header["CRVAL2"]
-
-        indices=  np.indices(shape)
-        y = indices[0].flatten()
-        x = indices[1].flatten()
-        n = len(x) 
-
-        for i in range(0, n, stride):
-
-            r, d = w.all_pix2world(x[i:i+stride], y[i:i+stride], 0)
-            factors = dOmega(r, d, ra0, dec0)
-
-            arr[y[i:i+stride], x[i:i+stride]] = factors
+    factor = SolidAngleFactor(hdr, ra0, dec0)
 
     if outname is None:
         outname = fitsimage.replace(".fits", "_dOmega.fits")
 
-    fits.writeto(outname, arr.astype(np.float32), strip_wcsaxes(hdu[0].header), overwrite=True)
+    with allocate_fits(outname, strip_wcsaxes(hdr), factor.shape) as out:
+        data = out[0].data
+        for region, values in factor.tiles(tile=tile, threads=threads):
+            data[region] = values
 
 
 
-def make_ratio_map(fitsimage, ra0, dec0, stride=16000000, outname=None):
+def make_ratio_map(fitsimage, ra0, dec0, stride=None, outname=None,
+                   tile=DEFAULT_TILE, threads=1):
     """Make a map of ratio of dOmega."""
 
-    hdu = fits.open(fitsimage)
+    hdr = fits.getheader(fitsimage)
     try:
-        projection = check_projection(hdu[0].header)
+        check_projection(hdr)
     except ValueError:
         logger.warning("dOmega ratios only valid for SIN and ZEA projections.")
         raise
-    else:
-
-        shape = np.squeeze(hdu[0].data).shape
-        arr = np.full(shape, np.nan)
-
-        w = WCS(hdu[0].header).celestial
-
-        indices=  np.indices(shape)
-        y = indices[0].flatten()
-        x = indices[1].flatten()
-        n = len(x) 
 
-        for i in range(0, n, stride):
-
-            r, d = w.all_pix2world(x[i:i+stride], y[i:i+stride], 0)
-            factors = dOmega(r, d, ra0, dec0)
-
-            arr[y[i:i+stride], x[i:i+stride]] = 1. / factors
+    factor = SolidAngleFactor(hdr, ra0, dec0)
 
     if outname is None:
         # return hdu instead of writing file - avoid unnecessary file creation
-        hdu[0].data = arr
-        return hdu
-    else:
-        fits.writeto(outname, arr, strip_wcsaxes(hdu[0].header), overwrite=True)
+        arr = np.full(factor.shape, np.nan)
+        for region, values in factor.tiles(tile=tile, threads=threads):
+            arr[region] = 1. / values
+        return fits.HDUList([fits.PrimaryHDU(data=arr, header=hdr)])
+
+    with allocate_fits(outname, strip_wcsaxes(hdr), factor.shape, dtype=np.float64) as out:
+        data = out[0].data
+        for region, values in factor.tiles(tile=tile, threads=threads):
+            data[region] = 1. / values
 
 
 
@@ -172,6 +121,95 @@ def make_effective_psf(dOmega_map, outname, bmaj, bmin=None, bpa=0.):
         fits.writeto(outname_aspect, psf[aspect].astype(np.float32), hdu[0].header, overwrite=True)
 
 
+def make_projected_psf(new_image, original_image, tile=DEFAULT_TILE, threads=1):
+    """Create the PSF axes of a reprojected image, as make_ratio_map followed by
+    make_effective_psf, with every tile of the dOmega ratio written straight
+    into the three outputs.
+
+    Args:
+        new_image (str): Resampled/reprojected image in ZEA projection
+        original_image (str): Original image in SIN projection, supplying the restoring beam and reference position
+
+    Keyword Args:
+        tile (int): Size of the square tiles in pixels (default: 2048)
+        threads (int): Number of threads evaluating tiles (default: 1)
+    """
+
+    hdr = fits.getheader(original_image)
+    bmaj = hdr["BMAJ"]
+    bmin = hdr.get("BMIN", bmaj)
+    bpa = hdr.get("BPA", 0.)
+    ra0 = hdr["CRVAL1"]
+    dec0 = hdr["CRVAL2"]
+
+    new_hdr = fits.getheader(new_image)
+    try:
+        check_projection(new_hdr)
+    except ValueError:
+        logger.warning("dOmega ratios only valid for SIN and ZEA projections.")
+        raise
+    factor = SolidAngleFactor(new_hdr, ra0, dec0)
+
+    outname = new_image.replace(".fits", "")
+    outputs = {aspect: allocate_fits(outname+"_"+aspect+".fits", new_hdr, factor.shape)
+               for aspect in ["bmaj", "bmin", "bpa"]}
+    try:
+        outputs["bmin"][0].data[:] = bmin
+        outputs["bpa"][0].data[:] = bpa
+        data = outputs["bmaj"][0].data
+        for region, values in factor.tiles(tile=tile, threads=threads):
+            data[region] = bmaj / (1. / values)
+    finally:
+        for out in outputs.values():
+            out.close()
+
+    return {"image": new_image}
+
+
+def _project_pair(pair, tile=DEFAULT_TILE, threads=1):
+    new_image, original_image = pair
+    logger.info("Processing {}".format(new_image))
+    make_projected_psf(new_image, original_image, tile=tile, threads=threads)
+
+
+def read_batch(path):
+    """Pairs of new and original images, one whitespace separated pair per line."""
+
+    pairs = []
+    with open(path, "r") as infile:
+        for line in infile:
+            items = line.split()
+            if len(items) == 0 or items[0].startswith("#"):
+                continue
+            if len(items) != 2:
+                raise ValueError("Expected a new and an original image, got: {}".format(line.strip()))
+            pairs.append(tuple(items))
+
+    return pairs
+
+
+def process_batch(pairs, workers=1, threads=None, tile=DEFAULT_TILE):
+    """Create the projected PSF of many images, at most workers images at a time.
+
+    Keyword Args:
+        workers (int): Number of images processed concurrently (default: 1)
+        threads (int): Threads per image. If None the CPUs are shared between the workers (default: None)
+        tile (int): Size of the square tiles in pixels (default: 2048)
+    """
+
+    workers = max(1, min(workers, len(pairs)))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    if workers == 1:
+        for pair in pairs:
+            _project_pair(pair, tile=tile, threads=threads)
+        return
+
+    with Pool(processes=workers) as pool:
+        pool.starmap(_project_pair, [(pair, tile, threads) for pair in pairs], chunksize=1)
+
+
 
 def main():
     """
@@ -183,38 +221,34 @@ def main():
                                     "varies over the new map.",
                         )
 
-    ps.add_argument("new_image", type=str,
+    ps.add_argument("new_image", type=str, nargs="?", default=None,
                     help="New (resampled/reprojected) FITS image in ZEA projection.")
-    ps.add_argument("original_image", type=str,
+    ps.add_argument("original_image", type=str, nargs="?", default=None,
                     help="Original FITS image in SIN projection. Used to get "
                          "original CRVAL1/CRVAL2 values.")
+    ps.add_argument("--batch", type=str, default=None,
+                    help="File listing a new and an original image on each line, "
+                         "processed instead of the positional images.")
+    ps.add_argument("--workers", type=int, default=1,
+                    help="Number of images processed concurrently in batch mode.")
+    ps.add_argument("--threads", type=int, default=None,
+                    help="Threads evaluating the tiles of each image. Defaults to "
+                         "the CPUs available shared between the workers.")
+    ps.add_argument("--tile", type=int, default=DEFAULT_TILE,
+                    help="Size of the square tiles in pixels.")
 
 
     args = ps.parse_args()
 
-    hdr = fits.getheader(args.original_image)
-    bmaj = hdr["BMAJ"]
-    try:
-        bmin = hdr["BMIN"]
-    except KeyError:
-        bmin = bmaj
-    try:
-        bpa = hdr["BPA"]
-    except KeyError:
-        bpa = 0.
-
-    original_projection = "SIN"
-    with fits.open(args.original_image) as f:
-        ra0 = f[0].header["CRVAL1"]
-        dec0 = f[0].header["CRVAL2"]
+    if args.batch is not None:
+        pairs = read_batch(args.batch)
+    elif args.new_image is not None and args.original_image is not None:
+        pairs = [(args.new_image, args.original_image)]
+    else:
+        ps.error("Either a new and an original image, or --batch, must be supplied.")
 
-    outname = args.new_image.replace(".fits", "")
-    hdu = make_ratio_map(args.new_image, ra0, dec0, outname=None)
-    make_effective_psf(hdu, outname, bmaj, bmin, bpa)
+    process_batch(pairs, workers=args.workers, threads=args.threads, tile=args.tile)
 
 
 if __name__ == "__main__":
     main()
-
-
-    
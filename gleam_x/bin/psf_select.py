@@ -3,10 +3,9 @@
 from __future__ import print_function, division
 
 import numpy as np
-import os, sys, re
+import os, sys
 
 import astropy
-from astropy.io import fits
 from astropy.io.votable import writeto as writetoVO
 from astropy.table import Table, Column
 from astropy.io.votable import parse_single_table
@@ -14,6 +13,19 @@ from astropy.io.votable import parse_single_table
 # optparse is being deprecated and argparse is now available on Zeus.
 from argparse import ArgumentParser
 
+from gleam_x.utils.crossmatch import SkyIndex
+
+# Sources with a neighbour closer than this, in arcseconds, are not isolated
+ISOLATION_RADIUS = 600.0
+# Separation in arcseconds within which a source is matched to NVSS/SUMSS
+NS_MATCH_RADIUS = 30.0
+# Aegean columns written to the output when filtering against NVSS/SUMSS
+KEEP_COLUMNS = [
+    "ra", "dec", "peak_flux", "err_peak_flux", "int_flux", "err_int_flux",
+    "local_rms", "a", "err_a", "b", "err_b", "pa", "err_pa", "psf_a", "psf_b",
+    "psf_pa", "residual_std", "flags",
+]
+
 
 def main():
     """
@@ -67,7 +79,7 @@ def main():
     parser.add_argument(
         "--prefix",
         default="example",
-        help="Add a prefix to temporary file names to prevent bad race conditions",
+        help="Prefix for temporary file names. No longer used as the selection is done in memory, kept for compatibility",
     )
 
     options = parser.parse_args()
@@ -81,7 +93,6 @@ def main():
         inputfile = options.input
 
     ext = options.input.split(".")[-1]  # make sure .vot can be used as input
-    prefix = options.prefix
 
     if options.output:
         outputfile = options.output
@@ -89,54 +100,28 @@ def main():
         outputfile = inputfile.replace("." + ext, "_psfcat.fits")
 
     # Read the VO table and start processing
+    data = Table.read(inputfile)
+
     if options.isolate is True:
-        sparse = re.sub("." + ext, "_isolated.fits", inputfile)
-        os.system(
-            'stilts tmatch1 matcher=sky values="ra dec" params=600 \
-                  action=keep0 in='
-            + inputfile
-            + " out="
-            + sparse
-        )
-    else:
-        sparse = inputfile
+        # Only keep sources without another source within 10 arcminutes
+        data = data[SkyIndex.from_table(data).isolated(ISOLATION_RADIUS)]
 
     if options.usefilter is True:
-        nscat = options.nscat
+        nscat = Table.read(options.nscat)
         # Snapshot: Get rid of crazy-bright sources, really super-extended sources, and sources with high residuals after fit
-        os.system(
-            "stilts tpipe in="
-            + sparse
-            + " cmd='select ((local_rms<1.0)&&((int_flux/peak_flux)<3)&&((residual_std/peak_flux)<0.1))' out={0}_temp_crop.fits".format(
-                prefix
-            )
-        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crop = data[
+                (data["local_rms"] < 1.0)
+                & ((data["int_flux"] / data["peak_flux"]) < 3)
+                & ((data["residual_std"] / data["peak_flux"]) < 0.1)
+            ]
 
-        # Match GLEAM with NVSS/SUMSS
-        os.system(
-            "stilts tmatch2 matcher=sky params=30 in1="
-            + nscat
-            + ' in2={0}_temp_crop.fits out={0}_temp_ns_match.fits values1="RAJ2000 DEJ2000" values2="ra dec" fixcols="dups" suffix1="_ns" suffix2=""'.format(
-                prefix
-            )
-        )
+        # Match GLEAM with NVSS/SUMSS, keeping the matched rows in their original order
+        ns_index = SkyIndex.from_table(nscat, ra_col="RAJ2000", dec_col="DEJ2000")
+        cat_idx, _, _ = ns_index.best_match(crop["ra"], crop["dec"], NS_MATCH_RADIUS)
 
         # Keep only basic aegean headings
-        os.system(
-            "stilts tpipe in={0}_temp_ns_match.fits cmd='keepcols \"ra dec peak_flux err_peak_flux int_flux err_int_flux local_rms a err_a b err_b pa err_pa psf_a psf_b psf_pa residual_std flags\"' out=".format(
-                prefix
-            )
-            + outputfile
-        )
-
-        os.remove("{0}_temp_crop.fits".format(prefix))
-        os.remove("{0}_temp_ns_match.fits".format(prefix))
-
-        hdu = fits.open(outputfile)
-        data = hdu[1].data
-    else:
-        hdu = fits.open(sparse)
-        data = hdu[1].data
+        data = crop[np.sort(cat_idx)][KEEP_COLUMNS]
 
     x = data["ra"]
     if max(x) > 360.0:
@@ -148,14 +133,11 @@ def main():
 
     # Downselect to unresolved sources
 
-    mask = []
     # Filter out any sources where Aegean's flags weren't zero
-    indices = np.where(
-        (data["flags"] == 0)
-        & ((data["peak_flux"] / data["local_rms"]) >= options.minsnr)
-    )
-    mask.extend(indices[0])
-    mask = np.array(mask)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mask = (data["flags"] == 0) & (
+            (data["peak_flux"] / data["local_rms"]) >= options.minsnr
+        )
 
     tab = Table(data[mask])
     tab.description = "Sources selected for PSF calculation."
@@ -4,25 +4,34 @@ from __future__ import print_function
 
 import copy, os, shutil, glob, sys, string, re, types
 import math
-from astropy.io import fits
+import json
+import shlex
+
+from gleam_x.utils.fits_header import read_header
+from gleam_x.utils.metafits import load_metafits
 
 yes=0
 no=1
 
 ######################################################################
-def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, update=0, doparse=1):        
-    """ use python/fits to add/print/update/delete header keywords"""
+def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, update=0, doparse=1, results=None):        
+    """ use python/fits to add/print/update/delete header keywords
+    if results is a dict, printed keywords are stored in it rather than written to stdout"""
 
+    # keep stdout clean for shell/json output
+    out=sys.stdout if results is None else sys.stderr
+    inf=None
     try:
         if (update):
+            from astropy.io import fits
             inf=fits.open(file,'update')
+            hdr=inf[extn].header
         else:
-            inf=fits.open(file)
+            hdr=readhdr(file,extn)
     except:
-        print("Could not open file {0}\n".format(file))
+        print("Could not open file {0}\n".format(file), file=out)
         return 0
 
-    hdr=inf[extn].header
     for i in range(0,len(cmdlist)):
         cmd=cmdlist[i]
         arg=arglist[i]
@@ -104,6 +113,9 @@ def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, up
                 if (len(cards)>0):
                     for card in cards:
                         ret=hdr.get(card)
+                        if (results is not None):
+                            results[card]=ret
+                            continue
                         s=""
                         if (printfile):
                             s+="%s" % file
@@ -111,7 +123,7 @@ def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, up
                             s+="[%s]" % extn
                         print("{0}[{1}] = {2}".format(s,card,ret))
                 else:
-                    print("Could not find keyword matching {0}\n".format(arg))
+                    print("Could not find keyword matching {0}\n".format(arg), file=out)
 
             else:
                 if (arg.count("$") > 0):
@@ -121,7 +133,10 @@ def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, up
                     try:
                         ret=hdr.get(arg)
                     except:
-                        print("Could not find keyword {0}\n".format(arg))
+                        print("Could not find keyword {0}\n".format(arg), file=out)
+                if (results is not None):
+                    results[arg]=ret
+                    continue
                 s=""
                 if (printfile):
                     s+="%s" % file
@@ -134,7 +149,67 @@ def pyhead(file, extn, cmdlist, arglist, verbose=1, printfile=1, printextn=1, up
     if (update):
         inf.verify('fix')
         inf.flush()
-    inf.close()
+    if (inf is not None):
+        inf.close()
+######################################################################
+def readhdr(file, extn):
+    """reads a header for printing, only parsing the header blocks if possible
+    and falling back to astropy for anything the simple reader cannot handle
+    (named extensions, malformed cards); primary headers of metafits files
+    come from the shared metafits cache
+    """
+
+    try:
+        if (file.endswith(".metafits") and str(extn) == "0"):
+            try:
+                return load_metafits(file).header
+            except KeyError:
+                # not a metafits file the observation record understands
+                pass
+        return read_header(file, extn)
+    except ValueError:
+        from astropy.io import fits
+        return fits.getheader(file, extn)
+######################################################################
+def shellname(key):
+    """converts a keyword or expression to a valid shell variable name
+    """
+
+    name=re.sub("[^A-Za-z0-9_]", "_", key)
+    if (not re.match("[A-Za-z_]", name)):
+        name="_" + name
+    return name
+######################################################################
+def shellvalue(val):
+    """formats a value the same way as the printed output, quoted for the shell
+    """
+
+    if (val is None):
+        return "''"
+    return shlex.quote("{0}".format(val))
+######################################################################
+def printshell(filelist, results):
+    """prints KEY=value lines that can be eval'd by a shell; with several
+    files each keyword becomes an array with one element per file
+    """
+
+    keys=[]
+    for res in results:
+        for key in res:
+            if (key not in keys):
+                keys.append(key)
+    for key in keys:
+        vals=[shellvalue(res.get(key)) for res in results]
+        if (len(filelist) == 1):
+            print("{0}={1}".format(shellname(key), vals[0]))
+        else:
+            print("{0}=({1})".format(shellname(key), " ".join(vals)))
+######################################################################
+def printjson(filelist, results):
+    """prints the keywords of every file as a JSON object keyed by file name
+    """
+
+    print(json.dumps(dict(zip(filelist, results)), indent=2, default=str))
 ######################################################################
 def evalhdr(hdr,arg):
     """evaluates expressions involving header keywords
@@ -196,8 +271,9 @@ def getcardmatches(hdr, template):
 def usage():
     (xdir,xname)=os.path.split(sys.argv[0])
 
-    print("Usage:  {0} [-p keyword/expression] [-d keyword] [-u/-a keyword value/expression]  [-H value/expression] [-f <command_filename>] [-i] <filename(s)>".format(xname))
+    print("Usage:  {0} [-p keyword/expression] [-k keyword,keyword,...] [-d keyword] [-u/-a keyword value/expression]  [-H value/expression] [-f <command_filename>] [-i] [-s/-j] <filename(s)>".format(xname))
     print("\t-p will print the value of the keyword")
+    print("\t-k will print the values of a comma separated list of keywords")
     print("\t-d will delete the keyword")
     print("\t-u will update the keyword")
     print("\t-a will add a keyword")
@@ -207,7 +283,10 @@ def usage():
     print("\tenclose expressions in single quotes")
     print("\tkeywords to print can have wildcards (*,?)")
     print("\tcannot mix expressions and wildcards")
-    print("\tfor Booleans, use fits.TRUE or fits.FALSE\n")
+    print("\tfor Booleans, use fits.TRUE or fits.FALSE")
+    print("\t-s will print KEY=value lines for eval in a shell, as arrays over multiple files")
+    print("\t-j will print the values as JSON, keyed by file")
+    print("\t-s and -j can only be used with -p and -k\n")
     
 ######################################################################
 def main():
@@ -224,6 +303,7 @@ def main():
     i=1
     update=0
     doparse=1
+    output=None
     while (i<len(sys.argv)):
         arg=sys.argv[i]
         isarg=0
@@ -241,6 +321,22 @@ def main():
             arglist.append(sys.argv[i+1])
             i+=1
             isarg=1        
+        if (arg.startswith("-k")):
+            # print several keywords
+            for key in sys.argv[i+1].split(","):
+                if (len(key)>0):
+                    cmdlist.append('p')
+                    arglist.append(key)
+            i+=1
+            isarg=1
+        if (arg.startswith("-s")):
+            # shell output
+            output='shell'
+            isarg=1
+        if (arg.startswith("-j")):
+            # json output
+            output='json'
+            isarg=1
         if (arg.startswith("-d")):
             # delete
             cmdlist.append('d')
@@ -298,7 +394,12 @@ def main():
     if (len(cmdlist)==0 and len(filelist)>0):
         cmdlist.append('p')
         arglist.append("*")
-    
+
+    if (output is not None and (update or set(cmdlist) != set(['p']))):
+        print("-s and -j can only be used to print keywords", file=sys.stderr)
+        sys.exit(1)
+
+    results=[]
     for file in filelist:
         if (file.find("[") > -1):
             i1=file.find("[")
@@ -307,8 +408,17 @@ def main():
             file=file[0:i1]
         else:
             ext=0
-            
-        pyhead(file, ext, cmdlist, arglist, 1, len(filelist)>1, ext != 0, update,doparse=doparse)
+
+        if (output is None):
+            pyhead(file, ext, cmdlist, arglist, 1, len(filelist)>1, ext != 0, update,doparse=doparse)
+        else:
+            results.append({})
+            pyhead(file, ext, cmdlist, arglist, 1, 0, 0, update, doparse=doparse, results=results[-1])
+
+    if (output == 'shell'):
+        printshell(filelist, results)
+    elif (output == 'json'):
+        printjson(filelist, results)
 
 
 ######################################################################
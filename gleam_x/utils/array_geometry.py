@@ -0,0 +1,238 @@
+"""Geometry of the array for the measurement set tools. The ANTENNA table of a
+measurement set (or the tile table of a metafits file) is read once into an
+ArrayLayout holding the geocentric (XYZ) and local East-North-Up (ENU) positions
+of every antenna, from which baseline lengths, uvw coordinates and subarray
+selections are derived for all antennas or baselines in a single call.
+"""
+
+import os
+
+import numpy as np
+from casacore.tables import table
+
+# MWA location from CONV2UVFITS/convutils.h
+MWA_LAT = -26.703319
+MWA_LON = 116.67081
+MWA_HEIGHT = 377.0
+
+# From NHW, as described in the GLEAM-X survey paper. Antennas outside of
+# the region are flagged to form the subarray of each direction.
+#   east: East > 700, west: East < -120, north: North > 720, south: North < -70
+SUBARRAYS = {
+    "east": ("East", ">", 700),
+    "west": ("East", "<", -120),
+    "north": ("North", ">", 720),
+    "south": ("North", "<", -70),
+}
+
+_LAYOUT_CACHE = {}
+
+
+def reference_xyz(lat=MWA_LAT, lon=MWA_LON, height=MWA_HEIGHT):
+    """Geocentric position in metres of a geodetic location, in degrees and metres"""
+    import astropy.units as u
+    from astropy.coordinates import EarthLocation
+
+    loc = EarthLocation.from_geodetic(lat=lat * u.deg, lon=lon * u.deg, height=height * u.m)
+    return u.Quantity(loc.geocentric).to(u.m).value
+
+
+def enu_rotation(lat=MWA_LAT, lon=MWA_LON):
+    """Rotation from geocentric offsets to the local tangent plane (East, North, Up)
+    at a location. The product of the two rotations described in
+    https://archive.psas.pdx.edu/CoordinateSystem/Latitude_to_LocalTangent.pdf
+    """
+    phi = np.radians(lon)
+    lam = np.radians(lat)
+
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+
+    rot1 = np.array(((-sin_phi, cos_phi, 0), (cos_phi, sin_phi, 0), (0, 0, 1)))
+    rot2 = np.array(((1, 0, 0), (0, -sin_lam, cos_lam), (0, cos_lam, sin_lam)))
+
+    return rot2 @ rot1
+
+
+def xyz_to_enu(xyz, lat=MWA_LAT, lon=MWA_LON, height=MWA_HEIGHT):
+    """Convert geocentric positions to East-North-Up about a reference location
+
+    Args:
+        xyz (numpy.ndarray): Geocentric positions in metres with shape (N, 3)
+
+    Keyword Args:
+        lat (float): Latitude of the reference in degrees (default: MWA)
+        lon (float): Longitude of the reference in degrees (default: MWA)
+        height (float): Height of the reference in metres (default: MWA)
+
+    Returns:
+        numpy.ndarray: East, North and Up positions in metres with shape (N, 3)
+    """
+    offsets = np.asarray(xyz, dtype=np.float64) - reference_xyz(lat, lon, height)
+    return offsets @ enu_rotation(lat, lon).T
+
+
+def enu_to_xyz(enu, lat=MWA_LAT, lon=MWA_LON, height=MWA_HEIGHT):
+    """Inverse of ``xyz_to_enu``"""
+    enu = np.asarray(enu, dtype=np.float64)
+    return enu @ enu_rotation(lat, lon) + reference_xyz(lat, lon, height)
+
+
+def subarray_mask(east, north, direction):
+    """Antennas to flag so that the remainder forms the subarray of a direction
+
+    Args:
+        east (numpy.ndarray): East position of each antenna in metres
+        north (numpy.ndarray): North position of each antenna in metres
+        direction (str): One of 'north', 'south', 'east' or 'west'
+
+    Raises:
+        ValueError: An invalid direction has been supplied
+
+    Returns:
+        numpy.ndarray: Boolean mask that is True for antennas outside the subarray
+    """
+    if direction not in SUBARRAYS:
+        raise ValueError(f"Invalid direction {direction}, expected one of {tuple(SUBARRAYS)}")
+
+    axis, side, limit = SUBARRAYS[direction]
+    values = np.asarray(east if axis == "East" else north)
+
+    return values <= limit if side == ">" else values >= limit
+
+
+class ArrayLayout:
+    """Positions of the antennas of an array"""
+
+    def __init__(self, names, xyz=None, enu=None, lat=MWA_LAT, lon=MWA_LON, height=MWA_HEIGHT):
+        """
+        Args:
+            names (numpy.ndarray): Name of each antenna, in antenna index order
+
+        Keyword Args:
+            xyz (numpy.ndarray): Geocentric positions in metres with shape (N, 3) (default: None)
+            enu (numpy.ndarray): East-North-Up positions in metres with shape (N, 3). At least one of
+            xyz and enu must be supplied (default: None)
+            lat (float): Latitude of the reference for the ENU positions in degrees (default: MWA)
+            lon (float): Longitude of the reference for the ENU positions in degrees (default: MWA)
+            height (float): Height of the reference for the ENU positions in metres (default: MWA)
+        """
+        if xyz is None and enu is None:
+            raise ValueError("Either xyz or enu positions are required")
+
+        self.names = np.asarray(names)
+        self.lat, self.lon, self.height = lat, lon, height
+        self.xyz = enu_to_xyz(enu, lat, lon, height) if xyz is None else np.asarray(xyz, dtype=np.float64)
+        self.enu = xyz_to_enu(self.xyz, lat, lon, height) if enu is None else np.asarray(enu, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def east(self):
+        return self.enu[:, 0]
+
+    @property
+    def north(self):
+        return self.enu[:, 1]
+
+    @property
+    def up(self):
+        return self.enu[:, 2]
+
+    @classmethod
+    def from_ms(cls, ms):
+        """Read the ANTENNA table of a measurement set
+
+        Args:
+            ms (Union[str,Path]): Path to the measurement set
+        """
+        ant_tab = table(f"{ms}/ANTENNA", readonly=True, ack=False)
+        try:
+            names = ant_tab.getcol("NAME")
+            xyz = ant_tab.getcol("POSITION")
+        finally:
+            ant_tab.close()
+
+        return cls(names, xyz=xyz)
+
+    @classmethod
+    def from_metafits(cls, metafits, pol="X"):
+        """Tile layout of an observation from the tile table of its metafits file,
+        ordered by the tile number
+
+        Args:
+            metafits (str): Path to the metafits file
+
+        Keyword Args:
+            pol (str): Polarisation of the inputs describing the tiles (default: 'X')
+        """
+        from gleam_x.utils.metafits import load_metafits
+
+        obs = load_metafits(metafits, tiles=True)
+        names, north, east = obs.tile_positions(pol=pol)
+        height = obs.tiles["Height"][obs.tile_order(pol=pol)] if "Height" in obs.tiles else np.zeros(len(names))
+
+        return cls(names, enu=np.stack((east, north, height), axis=-1))
+
+    def baseline_vectors(self, ant1, ant2):
+        """Geocentric baseline vectors (antenna2 - antenna1) in metres with shape (N, 3)"""
+        return self.xyz[np.asarray(ant2)] - self.xyz[np.asarray(ant1)]
+
+    def baseline_length(self, ant1, ant2):
+        """Length in metres of each of the supplied baselines"""
+        return np.linalg.norm(self.baseline_vectors(ant1, ant2), axis=-1)
+
+    def baseline_uvw(self, ant1, ant2, ha, dec):
+        """uvw coordinates of baselines towards a direction, following equation 4.1
+        of Thompson, Moran and Swenson (3rd edition)
+
+        Args:
+            ant1 (numpy.ndarray): First antenna of each baseline
+            ant2 (numpy.ndarray): Second antenna of each baseline
+            ha (float): Hour angle of the direction in radians
+            dec (float): Declination of the direction in radians
+
+        Returns:
+            numpy.ndarray: uvw in metres with shape (N, 3)
+        """
+        # Geocentric XYZ to the equatorial frame with X towards the local meridian
+        lon = np.radians(self.lon)
+        bx, by, bz = self.baseline_vectors(ant1, ant2).T
+        x = bx * np.cos(lon) + by * np.sin(lon)
+        y = -bx * np.sin(lon) + by * np.cos(lon)
+        z = bz
+
+        sin_h, cos_h = np.sin(ha), np.cos(ha)
+        sin_d, cos_d = np.sin(dec), np.cos(dec)
+
+        u = sin_h * x + cos_h * y
+        v = -sin_d * cos_h * x + sin_d * sin_h * y + cos_d * z
+        w = cos_d * cos_h * x - cos_d * sin_h * y + sin_d * z
+
+        return np.stack((u, v, w), axis=-1)
+
+    def subarray_mask(self, direction):
+        """Antennas to flag so that the remainder forms the subarray of a direction"""
+        return subarray_mask(self.east, self.north, direction)
+
+
+def antenna_layout(ms):
+    """Layout of the antennas of a measurement set, read once per process and reused
+    until the ANTENNA table is modified
+
+    Args:
+        ms (Union[str,Path]): Path to the measurement set
+
+    Returns:
+        ArrayLayout: The antenna positions
+    """
+    key = os.path.abspath(str(ms))
+    stamp = os.path.getmtime(f"{ms}/ANTENNA")
+
+    cached = _LAYOUT_CACHE.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, ArrayLayout.from_ms(ms))
+        _LAYOUT_CACHE[key] = cached
+
+    return cached[1]
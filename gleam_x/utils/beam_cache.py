@@ -0,0 +1,238 @@
+"""Cache of the MWA primary beam evaluated on an alt/az grid. The power beam of a
+tile depends only on its dipole delays and the frequency, not on the time of the
+observation, and GLEAM-X only uses a handful of sweetspot pointings and
+frequencies. Each (pointing, frequency) is therefore evaluated with the full
+embedded element model once, saved as a memory-mappable array, and any later
+RA/Dec/time query is answered by transforming to alt/az and interpolating the
+grid.
+"""
+
+import os
+import logging
+import tempfile
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+logger = logging.getLogger(__name__)
+
+# Grid spacing in degrees of the cached beams
+DEFAULT_RESOLUTION = 0.25
+
+# MWA location from CONV2UVFITS/convutils.h
+MWA_LAT = -26.703319
+MWA_LON = 116.67081
+MWA_HEIGHT = 377.0
+
+
+def default_cache_dir():
+    """Directory beams are cached in, GXBEAMCACHE if it is set"""
+    return os.environ.get(
+        "GXBEAMCACHE", os.path.join(os.path.expanduser("~"), ".cache", "gleam_x", "beam")
+    )
+
+
+def beam_key(delays, freq, gridnum=None, resolution=DEFAULT_RESOLUTION):
+    """Name identifying a cached beam. Sweetspot pointings are named by their grid
+    number, anything else by its delays.
+
+    Args:
+        delays (list[int]): The 16 dipole delays
+        freq (float): Frequency in Hz
+
+    Keyword Args:
+        gridnum (int): Sweetspot grid number of the delays (default: None)
+        resolution (float): Grid spacing in degrees (default: 0.25)
+
+    Returns:
+        str: Name of the beam
+    """
+    pointing = (
+        f"grid{int(gridnum)}"
+        if gridnum is not None
+        else "d" + "-".join(str(int(d)) for d in delays)
+    )
+    return f"{pointing}_{int(round(freq))}Hz_{resolution:g}deg"
+
+
+def evaluate_altaz_grid(delays, freq, resolution=DEFAULT_RESOLUTION):
+    """Evaluate the XX and YY power beam over the sky above the horizon
+
+    Args:
+        delays (list[int]): The 16 dipole delays
+        freq (float): Frequency in Hz
+
+    Keyword Args:
+        resolution (float): Grid spacing in degrees (default: 0.25)
+
+    Returns:
+        numpy.ndarray: Beam with shape (2, nza, naz), for zenith angles from 0 to 90 degrees and
+        azimuths from 0 to 360 degrees inclusive
+    """
+    from mwa_pb.primary_beam import MWA_Tile_full_EE
+
+    za = np.radians(np.linspace(0, 90, int(round(90 / resolution)) + 1))
+    az = np.radians(np.linspace(0, 360, int(round(360 / resolution)) + 1))
+    za, az = np.meshgrid(za, az, indexing="ij")
+
+    rX, rY = MWA_Tile_full_EE(
+        za=[za],
+        az=[az],
+        freq=freq,
+        delays=delays,
+        power=True,
+        interp=True,
+        pixels_per_deg=10,
+    )
+
+    return np.stack((np.squeeze(rX), np.squeeze(rY))).astype(np.float32)
+
+
+class BeamGrid:
+    """Primary beam held on an alt/az grid"""
+
+    def __init__(self, data, resolution=DEFAULT_RESOLUTION):
+        """
+        Args:
+            data (numpy.ndarray): XX and YY beam with shape (2, nza, naz) as made by ``evaluate_altaz_grid``
+
+        Keyword Args:
+            resolution (float): Grid spacing in degrees (default: 0.25)
+        """
+        self.data = data
+        self.resolution = resolution
+
+    def altaz_value(self, alt, az, order=1):
+        """Beam at a set of horizontal coordinates. Directions below the horizon have
+        a response of zero.
+
+        Args:
+            alt (numpy.ndarray): Altitude in degrees
+            az (numpy.ndarray): Azimuth in degrees
+
+        Keyword Args:
+            order (int): Order of the spline interpolation (default: 1)
+
+        Returns:
+            tuple[numpy.ndarray,numpy.ndarray]: XX and YY beam
+        """
+        alt = np.asarray(alt, dtype=np.float64)
+        az = np.mod(np.asarray(az, dtype=np.float64), 360.0)
+
+        coords = np.stack(((90.0 - alt).ravel(), az.ravel())) / self.resolution
+        values = [
+            map_coordinates(np.asarray(pol), coords, order=order, mode="nearest").reshape(alt.shape)
+            for pol in self.data
+        ]
+
+        below = ~(alt >= 0)
+        for v in values:
+            v[below] = 0.0
+            v[~np.isfinite(alt)] = np.nan
+
+        return values[0], values[1]
+
+    def value(self, ra, dec, t, order=1):
+        """Beam at a set of celestial coordinates at a time
+
+        Args:
+            ra (numpy.ndarray): Right ascension in degrees
+            dec (numpy.ndarray): Declination in degrees
+            t (astropy.time.Time): Time of the observation
+
+        Keyword Args:
+            order (int): Order of the spline interpolation (default: 1)
+
+        Returns:
+            tuple[numpy.ndarray,numpy.ndarray]: XX and YY beam
+        """
+        import astropy.units as u
+        from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+
+        location = EarthLocation.from_geodetic(
+            lat=MWA_LAT * u.deg, lon=MWA_LON * u.deg, height=MWA_HEIGHT * u.m
+        )
+        radec = SkyCoord(np.atleast_1d(ra) * u.deg, np.atleast_1d(dec) * u.deg)
+        altaz = radec.transform_to(AltAz(obstime=t, location=location))
+
+        return self.altaz_value(altaz.alt.deg, altaz.az.deg, order=order)
+
+
+class BeamCache:
+    """Directory of beams evaluated on alt/az grids, created on first use"""
+
+    def __init__(self, directory=None, resolution=DEFAULT_RESOLUTION):
+        """
+        Keyword Args:
+            directory (str): Directory the beams are kept in. If None GXBEAMCACHE, or a directory in the home
+            directory of the user, is used (default: None)
+            resolution (float): Grid spacing in degrees (default: 0.25)
+        """
+        self.directory = default_cache_dir() if directory is None else directory
+        self.resolution = resolution
+        self._grids = {}
+
+    def path(self, delays, freq, gridnum=None):
+        return os.path.join(
+            self.directory,
+            f"{beam_key(delays, freq, gridnum=gridnum, resolution=self.resolution)}.npy",
+        )
+
+    def grid(self, delays, freq, gridnum=None):
+        """Beam of a pointing and frequency, evaluated and saved if it is not already cached
+
+        Args:
+            delays (list[int]): The 16 dipole delays
+            freq (float): Frequency in Hz
+
+        Keyword Args:
+            gridnum (int): Sweetspot grid number of the delays (default: None)
+
+        Returns:
+            BeamGrid: The cached beam
+        """
+        path = self.path(delays, freq, gridnum=gridnum)
+        if path in self._grids:
+            return self._grids[path]
+
+        if os.path.exists(path):
+            data = np.load(path, mmap_mode="r")
+        else:
+            logger.info(f"Evaluating the beam for {os.path.basename(path)}")
+            data = evaluate_altaz_grid(delays, freq, resolution=self.resolution)
+            self._save(path, data)
+
+        self._grids[path] = BeamGrid(data, resolution=self.resolution)
+
+        return self._grids[path]
+
+    def _save(self, path, data):
+        """Write a beam under a temporary name and move it into place, so that
+        concurrent jobs never read a partial file. Failures only disable caching."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".beam_", suffix=".npy", dir=self.directory)
+            with os.fdopen(fd, "wb") as out:
+                np.save(out, data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Unable to cache beam in {path}: {e}")
+
+    def beam_value(self, ra, dec, t, delays, freq, gridnum=None, order=1):
+        """XX and YY beam at a set of celestial coordinates
+
+        Args:
+            ra (numpy.ndarray): Right ascension in degrees
+            dec (numpy.ndarray): Declination in degrees
+            t (astropy.time.Time): Time of the observation
+            delays (list[int]): The 16 dipole delays
+            freq (float): Frequency in Hz
+
+        Keyword Args:
+            gridnum (int): Sweetspot grid number of the delays (default: None)
+            order (int): Order of the spline interpolation (default: 1)
+
+        Returns:
+            tuple[numpy.ndarray,numpy.ndarray]: XX and YY beam
+        """
+        return self.grid(delays, freq, gridnum=gridnum).value(ra, dec, t, order=order)
@@ -0,0 +1,80 @@
+"""NaN-aware box averages of an image, evaluated at many positions at once. The
+image is reduced to integral images (two dimensional cumulative sums) of its
+finite values and of the number of finite pixels, after which the mean of any
+box is a handful of lookups regardless of the box size.
+"""
+
+import numpy as np
+
+
+class BoxMean:
+    """Integral images of an image, for fast box means that ignore NaNs"""
+
+    def __init__(self, data):
+        """
+        Args:
+            data (numpy.ndarray): Two dimensional image. Non-finite pixels are excluded from the means.
+        """
+        data = np.asarray(data)
+        if data.ndim != 2:
+            raise ValueError(f"Expected a two dimensional image, received shape {data.shape}")
+
+        self.shape = data.shape
+        ny, nx = self.shape
+        count_dtype = np.int32 if data.size < np.iinfo(np.int32).max else np.int64
+
+        finite = np.isfinite(data)
+        self.sums = np.zeros((ny + 1, nx + 1), dtype=np.float64)
+        self.sums[1:, 1:][finite] = data[finite]
+        self.counts = np.zeros((ny + 1, nx + 1), dtype=count_dtype)
+        self.counts[1:, 1:] = finite
+
+        for table in (self.sums, self.counts):
+            np.add.accumulate(table, axis=0, out=table)
+            np.add.accumulate(table, axis=1, out=table)
+
+    def _limits(self, position, size, length):
+        """First and last (exclusive) pixel of boxes centred on positions along an axis,
+        following the rounding of astropy's Cutout2D, clipped to the image
+        """
+        start = np.ceil(position - size / 2.0)
+        stop = start + size
+        start = np.clip(start, 0, length).astype(np.int64)
+        stop = np.clip(stop, 0, length).astype(np.int64)
+
+        return start, stop
+
+    def _box_sum(self, table, y0, y1, x0, x1):
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def sample(self, y, x, box_size, fill_value=np.nan):
+        """Mean of the finite pixels in boxes centred on a set of positions. Boxes
+        partially off the image use the pixels that overlap it.
+
+        Args:
+            y (numpy.ndarray): Zero-based pixel position along the first (row) axis
+            x (numpy.ndarray): Zero-based pixel position along the second (column) axis
+            box_size (tuple[int,int]): Box size in pixels as (ny, nx)
+
+        Keyword Args:
+            fill_value (float): Value for boxes without any finite pixels, or non-finite positions (default: numpy.nan)
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray]: Mean of each box, and the number of finite pixels it contained
+        """
+        y = np.asarray(y, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        valid = np.isfinite(y) & np.isfinite(x)
+        y = np.where(valid, y, 0)
+        x = np.where(valid, x, 0)
+
+        y0, y1 = self._limits(y, box_size[0], self.shape[0])
+        x0, x1 = self._limits(x, box_size[1], self.shape[1])
+
+        counts = np.where(valid, self._box_sum(self.counts, y0, y1, x0, x1), 0)
+        sums = self._box_sum(self.sums, y0, y1, x0, x1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, sums / counts, fill_value)
+
+        return means, counts
@@ -0,0 +1,333 @@
+"""On-disk spatial index of a reference catalogue, such as the GGSM or the
+NVSS/SUMSS calibrator list in models/. The columns of the catalogue are stored
+as memory-mappable arrays alongside a HEALPix partition of its sources, so tools
+can query a catalogue without parsing the FITS table or building SkyCoord
+objects every time they run. The index is built once, next to the catalogue,
+and rebuilt whenever the catalogue changes.
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+import healpy as hp
+from astropy.table import Table
+from scipy.spatial import cKDTree
+
+from gleam_x.utils.crossmatch import SkyIndex, radec_to_unit, arcsec_to_chord
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+# HEALPix resolution of the partition, roughly 1.8 degree pixels
+DEFAULT_NSIDE = 32
+
+
+def default_index_path(catalogue):
+    """Directory the index of a catalogue is stored in by default"""
+    return f"{catalogue}.idx"
+
+
+def _source_stamp(catalogue):
+    stat = os.stat(catalogue)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+class CatalogueIndex(SkyIndex):
+    """Spatial index over a reference catalogue, with its columns held in (possibly
+    memory-mapped) arrays. Row indices returned by the queries follow the row order
+    of the original catalogue.
+    """
+
+    def __init__(self, columns, ra_col="RAJ2000", dec_col="DEJ2000", units=None, nside=DEFAULT_NSIDE, partition=None):
+        """
+        Args:
+            columns (dict[str,numpy.ndarray]): Column name to values, in the row order of the catalogue
+
+        Keyword Args:
+            ra_col (str): Name of the right ascension column, in degrees (default: 'RAJ2000')
+            dec_col (str): Name of the declination column, in degrees (default: 'DEJ2000')
+            units (dict[str,str]): Units of each column (default: None)
+            nside (int): HEALPix resolution of the partition (default: 32)
+            partition (tuple[numpy.ndarray,numpy.ndarray]): Rows sorted by HEALPix pixel, and the offset
+            of each pixel into them. Computed if not supplied (default: None)
+        """
+        self.columns = columns
+        self.units = {} if units is None else units
+        self.ra_col = ra_col
+        self.dec_col = dec_col
+        self.ra = np.asarray(columns[ra_col], dtype=np.float64)
+        self.dec = np.asarray(columns[dec_col], dtype=np.float64)
+        self.xyz = radec_to_unit(self.ra, self.dec)
+        self.nside = nside
+
+        if partition is None:
+            pix = hp.vec2pix(nside, *self.xyz.T, nest=True)
+            order = np.argsort(pix, kind="stable")
+            offsets = np.searchsorted(pix[order], np.arange(hp.nside2npix(nside) + 1))
+            partition = (order, offsets)
+        self.order, self.offsets = partition
+
+        self._tree = None
+
+    @property
+    def tree(self):
+        """KD-tree over the unit vectors of the sources, built on first use"""
+        if self._tree is None:
+            self._tree = cKDTree(self.xyz)
+        return self._tree
+
+    @property
+    def colnames(self):
+        return list(self.columns)
+
+    @classmethod
+    def from_table(cls, table, ra_col="RAJ2000", dec_col="DEJ2000", nside=DEFAULT_NSIDE):
+        """Index an astropy table held in memory
+
+        Args:
+            table (astropy.table.Table): Reference catalogue
+
+        Keyword Args:
+            ra_col (str): Name of the right ascension column (default: 'RAJ2000')
+            dec_col (str): Name of the declination column (default: 'DEJ2000')
+            nside (int): HEALPix resolution of the partition (default: 32)
+        """
+        columns = {}
+        units = {}
+        for name in table.colnames:
+            col = table[name]
+            values = col.filled() if hasattr(col, "filled") else col
+            values = np.asarray(values)
+            if values.dtype.kind == "O":
+                logger.warning(f"Skipping column {name} with an unsupported data type")
+                continue
+            columns[name] = values
+            if col.unit is not None:
+                units[name] = col.unit.to_string()
+
+        return cls(columns, ra_col=ra_col, dec_col=dec_col, units=units, nside=nside)
+
+    def save(self, path, source=None):
+        """Write the index to a directory. The directory is assembled under a temporary
+        name and renamed into place, so concurrent builds do not see a partial index.
+
+        Args:
+            path (str): Directory to write the index to
+
+        Keyword Args:
+            source (str): Catalogue the index was built from, recorded to detect when it changes (default: None)
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        tmp = tempfile.mkdtemp(prefix=".idx_", dir=parent)
+        try:
+            names = list(self.columns)
+            for i, name in enumerate(names):
+                np.save(f"{tmp}/col_{i}.npy", np.ascontiguousarray(self.columns[name]))
+            np.save(f"{tmp}/order.npy", self.order)
+            np.save(f"{tmp}/offsets.npy", self.offsets)
+
+            meta = {
+                "version": INDEX_VERSION,
+                "nside": self.nside,
+                "nrows": len(self),
+                "ra_col": self.ra_col,
+                "dec_col": self.dec_col,
+                "columns": names,
+                "units": self.units,
+                "source": None if source is None else os.path.abspath(source),
+                "stamp": None if source is None else _source_stamp(source),
+            }
+            with open(f"{tmp}/meta.json", "w") as out:
+                json.dump(meta, out, indent=2)
+
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(f"{path}/meta.json"):
+                raise
+            logger.debug(f"{path} was written by another process")
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open an index written by ``save``
+
+        Args:
+            path (str): Directory containing the index
+
+        Keyword Args:
+            mmap (bool): Memory-map the arrays rather than reading them into memory (default: True)
+        """
+        with open(f"{path}/meta.json", "r") as infile:
+            meta = json.load(infile)
+
+        mmap_mode = "r" if mmap else None
+        columns = {
+            name: np.load(f"{path}/col_{i}.npy", mmap_mode=mmap_mode)
+            for i, name in enumerate(meta["columns"])
+        }
+        partition = (
+            np.load(f"{path}/order.npy", mmap_mode=mmap_mode),
+            np.load(f"{path}/offsets.npy", mmap_mode=mmap_mode),
+        )
+
+        return cls(
+            columns,
+            ra_col=meta["ra_col"],
+            dec_col=meta["dec_col"],
+            units=meta["units"],
+            nside=meta["nside"],
+            partition=partition,
+        )
+
+    def cone(self, ra, dec, radius):
+        """Indices of all sources within a radius of a single position. Only the
+        HEALPix pixels overlapping the cone are searched.
+
+        Args:
+            ra (float): Right ascension in degrees
+            dec (float): Declination in degrees
+            radius (float): Search radius in arcseconds
+
+        Returns:
+            numpy.ndarray: Sorted indices of the sources in the cone
+        """
+        xyz = radec_to_unit(ra, dec)[0]
+        pixels = hp.query_disc(
+            self.nside, xyz, np.radians(radius / 3600.0), inclusive=True, nest=True
+        )
+        candidates = np.concatenate(
+            [self.order[self.offsets[p] : self.offsets[p + 1]] for p in pixels]
+            + [np.empty(0, dtype=int)]
+        ).astype(int)
+
+        chord = np.linalg.norm(self.xyz[candidates] - xyz, axis=1)
+
+        return np.sort(candidates[chord < arcsec_to_chord(radius)])
+
+    def table(self, rows=None, columns=None):
+        """Rows of the catalogue as an astropy table
+
+        Keyword Args:
+            rows (numpy.ndarray): Row indices or boolean mask to select. If None all rows are returned (default: None)
+            columns (Iterable[str]): Columns to include. If None all columns are included (default: None)
+
+        Returns:
+            astropy.table.Table: The selected rows
+        """
+        columns = self.colnames if columns is None else list(columns)
+        rows = slice(None) if rows is None else rows
+
+        tab = Table([np.array(self.columns[name][rows]) for name in columns], names=columns)
+        for name in columns:
+            if name in self.units:
+                tab[name].unit = self.units[name]
+
+        return tab
+
+
+def is_current(path, catalogue):
+    """Whether the index in a directory was built from the current version of a catalogue"""
+    try:
+        with open(f"{path}/meta.json", "r") as infile:
+            meta = json.load(infile)
+    except (OSError, ValueError):
+        return False
+
+    return meta.get("version") == INDEX_VERSION and meta.get("stamp") == _source_stamp(catalogue)
+
+
+def build_index(catalogue, path=None, ra_col="RAJ2000", dec_col="DEJ2000", nside=DEFAULT_NSIDE):
+    """Build the index of a FITS catalogue and write it to disk
+
+    Args:
+        catalogue (str): Path to the reference catalogue
+
+    Keyword Args:
+        path (str): Directory to write the index to. If None it is placed next to the catalogue (default: None)
+        ra_col (str): Name of the right ascension column (default: 'RAJ2000')
+        dec_col (str): Name of the declination column (default: 'DEJ2000')
+        nside (int): HEALPix resolution of the partition (default: 32)
+
+    Returns:
+        CatalogueIndex: The index of the catalogue
+    """
+    path = default_index_path(catalogue) if path is None else path
+
+    logger.info(f"Building index of {catalogue} in {path}")
+    index = CatalogueIndex.from_table(
+        Table.read(catalogue), ra_col=ra_col, dec_col=dec_col, nside=nside
+    )
+    index.save(path, source=catalogue)
+
+    return index
+
+
+def open_index(catalogue, path=None, ra_col="RAJ2000", dec_col="DEJ2000", mmap=True):
+    """Open the index of a reference catalogue, building it if it does not exist or
+    the catalogue has changed since it was built. If the index can not be written
+    (e.g. the catalogue is in a read-only location) it is built in memory.
+
+    Args:
+        catalogue (str): Path to the reference catalogue
+
+    Keyword Args:
+        path (str): Directory of the index. If None it is placed next to the catalogue (default: None)
+        ra_col (str): Name of the right ascension column (default: 'RAJ2000')
+        dec_col (str): Name of the declination column (default: 'DEJ2000')
+        mmap (bool): Memory-map the index rather than reading it into memory (default: True)
+
+    Returns:
+        CatalogueIndex: The index of the catalogue
+    """
+    path = default_index_path(catalogue) if path is None else path
+
+    if not is_current(path, catalogue):
+        try:
+            build_index(catalogue, path=path, ra_col=ra_col, dec_col=dec_col)
+        except OSError as e:
+            logger.warning(f"Unable to write index to {path}, building in memory: {e}")
+            return CatalogueIndex.from_table(Table.read(catalogue), ra_col=ra_col, dec_col=dec_col)
+
+    return CatalogueIndex.load(path, mmap=mmap)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Build the on-disk spatial index of a reference catalogue"
+    )
+    parser.add_argument("catalogue", type=str, help="Path to the reference catalogue")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Directory to write the index to (default: <catalogue>.idx)",
+    )
+    parser.add_argument(
+        "--ra-col", type=str, default="RAJ2000", help="Right ascension column (default: RAJ2000)"
+    )
+    parser.add_argument(
+        "--dec-col", type=str, default="DEJ2000", help="Declination column (default: DEJ2000)"
+    )
+    parser.add_argument(
+        "--nside", type=int, default=DEFAULT_NSIDE, help="HEALPix resolution of the partition (default: 32)"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_index(
+        args.catalogue,
+        path=args.output,
+        ra_col=args.ra_col,
+        dec_col=args.dec_col,
+        nside=args.nside,
+    )
@@ -0,0 +1,946 @@
+"""Reprojection and weighted co-addition of snapshot images onto a common ZEA
+grid, as an alternative to resampling every snapshot to disk with swarp and
+co-adding the resampled images afterwards. The output grid is divided into
+tiles. For each tile the snapshots overlapping it are interpolated straight
+from their (memory mapped) images and weight maps into running weighted sums,
+so no resampled intermediate is ever written. The PSF planes (bmaj, bmin, bpa)
+that psf_projected.py would describe for each resampled snapshot are formed on
+the same tiles and co-added with the same weights in the same pass.
+
+The weighted sums may also be persisted, with a manifest of the contributing
+snapshots and their checksums, so a mosaic can later be updated by adding or
+removing individual snapshots on just the tiles they cover. The persisted grid
+keeps its centre and projection, and is extended by whole pixels when a new
+snapshot falls outside it.
+"""
+
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from numpy.lib.format import open_memmap
+
+from gleam_x.utils.solid_angle import SolidAngleFactor, allocate_fits
+
+logger = logging.getLogger(__name__)
+
+# Size in pixels of the square output tiles
+DEFAULT_TILE = 1024
+KERNELS = ("nearest", "bilinear", "lanczos3")
+PSF_PLANES = ("bmaj", "bmin", "bpa")
+# Keywords propagated from the first snapshot, as COPY_KEYWORDS of the swarp templates
+COPY_KEYWORDS = ("TELESCOP", "MWAVER", "MWADATE", "BTYPE", "BUNIT", "BMAJ", "BMIN", "BPA", "FREQ")
+# Fraction of its size the footprint of a snapshot is padded by
+FOOTPRINT_PADDING = 0.05
+# Version of the layout of persisted accumulators, and the name of their manifest
+STATE_VERSION = 1
+MANIFEST = "manifest.json"
+CHECKSUM_BLOCK = 2 ** 24
+
+
+def lanczos(t, a=3):
+    """Lanczos kernel of order a"""
+    return np.where(np.abs(t) < a, np.sinc(t) * np.sinc(t / a), 0.0)
+
+
+def _kernel_weights(pos, kernel):
+    """First pixel of the support of a kernel and its weights, along one axis"""
+    if kernel == "nearest":
+        return np.floor(pos + 0.5).astype(np.int64), np.ones((len(pos), 1))
+
+    base = np.floor(pos).astype(np.int64)
+    if kernel == "bilinear":
+        frac = pos - base
+        return base, np.stack((1.0 - frac, frac), axis=-1)
+
+    if kernel == "lanczos3":
+        start = base - 2
+        t = pos[:, np.newaxis] - (start[:, np.newaxis] + np.arange(6))
+        weights = lanczos(t, a=3)
+        return start, weights / weights.sum(axis=1, keepdims=True)
+
+    raise ValueError(f"Unknown kernel {kernel}, expected one of {KERNELS}")
+
+
+def interpolate(data, x, y, kernel="lanczos3"):
+    """Interpolate an image at a set of pixel positions. Positions whose kernel
+    support reaches off the image or includes a non-finite pixel are NaN.
+
+    Args:
+        data (numpy.ndarray): Two dimensional image
+        x (numpy.ndarray): Zero-based pixel position along the second (column) axis
+        y (numpy.ndarray): Zero-based pixel position along the first (row) axis
+
+    Keyword Args:
+        kernel (str): One of 'nearest', 'bilinear' or 'lanczos3' (default: 'lanczos3')
+
+    Returns:
+        numpy.ndarray: Interpolated values
+    """
+    x0, wx = _kernel_weights(np.asarray(x, dtype=np.float64), kernel)
+    y0, wy = _kernel_weights(np.asarray(y, dtype=np.float64), kernel)
+    ny, nx = data.shape
+    k = wx.shape[1]
+
+    bad = (x0 < 0) | (x0 + k > nx) | (y0 < 0) | (y0 + k > ny)
+    cols = np.clip(x0[:, np.newaxis] + np.arange(k), 0, nx - 1)
+
+    out = np.zeros(len(x0))
+    for j in range(k):
+        rows = np.clip(y0 + j, 0, ny - 1)
+        vals = data[rows[:, np.newaxis], cols]
+        finite = np.isfinite(vals)
+        bad |= ~finite.all(axis=1)
+        out += wy[:, j] * np.sum(np.where(finite, vals, 0.0) * wx, axis=1)
+
+    out[bad] = np.nan
+
+    return out
+
+
+def pixel_scale(wcs):
+    """Geometric mean pixel scale of a celestial WCS in degrees"""
+    return math.sqrt(abs(np.linalg.det(wcs.pixel_scale_matrix)))
+
+
+def zea_header(ra, dec, pixscale, shape, crpix=None):
+    """Header of a ZEA image centred on a position
+
+    Args:
+        ra (float): Right ascension of the reference position in degrees
+        dec (float): Declination of the reference position in degrees
+        pixscale (float): Pixel size in degrees
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        crpix (tuple[float,float]): Reference pixel as (CRPIX1, CRPIX2). The centre of the image if None (default: None)
+
+    Returns:
+        astropy.io.fits.Header: The header
+    """
+    ny, nx = shape
+    if crpix is None:
+        crpix = (nx / 2.0 + 1, ny / 2.0 + 1)
+
+    hdr = fits.Header()
+    hdr["NAXIS"] = 2
+    hdr["NAXIS1"] = nx
+    hdr["NAXIS2"] = ny
+    hdr["EQUINOX"] = 2000.0
+    hdr["RADESYS"] = "FK5"
+    hdr["CTYPE1"] = "RA---ZEA"
+    hdr["CUNIT1"] = "deg"
+    hdr["CRVAL1"] = ra
+    hdr["CRPIX1"] = crpix[0]
+    hdr["CDELT1"] = -pixscale
+    hdr["CTYPE2"] = "DEC--ZEA"
+    hdr["CUNIT2"] = "deg"
+    hdr["CRVAL2"] = dec
+    hdr["CRPIX2"] = crpix[1]
+    hdr["CDELT2"] = pixscale
+
+    return hdr
+
+
+class _ThreadWCS:
+    """A celestial WCS per thread, as WCS objects are not safe to share between threads"""
+
+    def __init__(self, header):
+        self.header = header
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, "wcs"):
+            self._local.wcs = WCS(self.header).celestial
+        return self._local.wcs
+
+
+class OutputGrid:
+    """Pixel grid of a mosaic"""
+
+    def __init__(self, header):
+        """
+        Args:
+            header (astropy.io.fits.Header): Header describing the grid
+        """
+        self.header = header
+        self.shape = (header["NAXIS2"], header["NAXIS1"])
+        self._wcs = _ThreadWCS(header)
+
+    @property
+    def wcs(self):
+        return self._wcs.get()
+
+    @classmethod
+    def covering(cls, snapshots, ra, dec, pixscale=None, shape=None):
+        """Grid centred on a position that covers a set of snapshots
+
+        Args:
+            snapshots (list[Snapshot]): Snapshots to cover
+            ra (float): Right ascension of the centre in degrees
+            dec (float): Declination of the centre in degrees
+
+        Keyword Args:
+            pixscale (float): Pixel size in degrees. The median of the snapshots if None (default: None)
+            shape (tuple[int,int]): Fixed shape as (ny, nx), centred on the position. Fitted to the
+            footprints of the snapshots if None (default: None)
+
+        Returns:
+            OutputGrid: The grid
+        """
+        if pixscale is None:
+            pixscale = float(np.median([pixel_scale(s.wcs) for s in snapshots]))
+
+        if shape is not None:
+            return cls(zea_header(ra, dec, pixscale, shape))
+
+        frame = cls(zea_header(ra, dec, pixscale, (1, 1), crpix=(1.0, 1.0)))
+        bounds = np.array([s.footprint(frame, clip=False) for s in snapshots], dtype=float)
+        if len(bounds) == 0 or not np.all(np.isfinite(bounds)):
+            raise ValueError("Unable to determine the footprint of the snapshots")
+
+        y0, x0 = np.floor(bounds[:, 0].min()), np.floor(bounds[:, 2].min())
+        y1, x1 = np.ceil(bounds[:, 1].max()), np.ceil(bounds[:, 3].max())
+        shape = (int(y1 - y0), int(x1 - x0))
+
+        return cls(zea_header(ra, dec, pixscale, shape, crpix=(1.0 - x0, 1.0 - y0)))
+
+    def tiles(self, tile=DEFAULT_TILE):
+        """Rows and columns of each tile of the grid"""
+        ny, nx = self.shape
+        return [
+            (slice(y0, min(y0 + tile, ny)), slice(x0, min(x0 + tile, nx)))
+            for y0 in range(0, ny, tile)
+            for x0 in range(0, nx, tile)
+        ]
+
+    def world(self, region):
+        """Right ascension and declination in degrees of the pixels of a tile"""
+        rows, cols = region
+        x, y = np.meshgrid(np.arange(cols.start, cols.stop), np.arange(rows.start, rows.stop))
+        return self.wcs.all_pix2world(x, y, 0)
+
+
+class Snapshot:
+    """A snapshot image, its weight map and its restoring beam"""
+
+    def __init__(self, image, weight=None, psf=True):
+        """
+        Args:
+            image (str): Snapshot image
+
+        Keyword Args:
+            weight (str): Weight map on the same pixel grid as the image. Uniform weights if None (default: None)
+            psf (bool): Form the bmaj, bmin and bpa planes from the restoring beam in the header (default: True)
+        """
+        self.image = image
+        self.weight = weight
+        self.header = fits.getheader(image)
+        self.shape = (self.header["NAXIS2"], self.header["NAXIS1"])
+        self._wcs = _ThreadWCS(self.header)
+
+        self.beam = None
+        if psf and "BMAJ" in self.header:
+            bmaj = self.header["BMAJ"]
+            self.beam = (bmaj, self.header.get("BMIN", bmaj), self.header.get("BPA", 0.0))
+
+        self._lock = threading.Lock()
+        self._data = {}
+        self._factors = {}
+        self._footprints = {}
+
+    @property
+    def wcs(self):
+        return self._wcs.get()
+
+    def _plane(self, path):
+        """Memory mapped image plane of a file, opened once"""
+        with self._lock:
+            if path not in self._data:
+                hdul = fits.open(path, memmap=True)
+                data = hdul[0].data
+                self._data[path] = (hdul, data.reshape(data.shape[-2:]))
+            return self._data[path][1]
+
+    def close(self):
+        with self._lock:
+            for hdul, _ in self._data.values():
+                hdul.close()
+            self._data = {}
+
+    def footprint(self, grid, clip=True):
+        """Bounding box of the snapshot in the pixels of a grid, padded slightly
+
+        Args:
+            grid (OutputGrid): The grid
+
+        Keyword Args:
+            clip (bool): Clip the box to the grid (default: True)
+
+        Returns:
+            tuple[int,int,int,int]: First and last (exclusive) row and column, None if the snapshot
+            is entirely off the grid
+        """
+        # keyed by the grid itself rather than its id, which may be reused once a grid is freed
+        key = (grid, clip)
+        if key in self._footprints:
+            return self._footprints[key]
+
+        ny, nx = self.shape
+        rows, cols = np.meshgrid(np.linspace(0, ny - 1, 33), np.linspace(0, nx - 1, 33), indexing="ij")
+        ra, dec = self.wcs.all_pix2world(cols, rows, 0)
+        valid = np.isfinite(ra) & np.isfinite(dec)
+        x, y = grid.wcs.all_world2pix(ra[valid], dec[valid], 0)
+        valid = np.isfinite(x) & np.isfinite(y)
+
+        box = None
+        if np.any(valid):
+            x, y = x[valid], y[valid]
+            pad_y = FOOTPRINT_PADDING * (y.max() - y.min()) + 3
+            pad_x = FOOTPRINT_PADDING * (x.max() - x.min()) + 3
+            box = (y.min() - pad_y, y.max() + pad_y + 1, x.min() - pad_x, x.max() + pad_x + 1)
+
+            if clip:
+                gy, gx = grid.shape
+                box = (
+                    int(max(0, math.floor(box[0]))),
+                    int(min(gy, math.ceil(box[1]))),
+                    int(max(0, math.floor(box[2]))),
+                    int(min(gx, math.ceil(box[3]))),
+                )
+                if box[0] >= box[1] or box[2] >= box[3]:
+                    box = None
+
+        self._footprints[key] = box
+
+        return box
+
+    def overlaps(self, grid, region):
+        box = self.footprint(grid)
+        if box is None:
+            return False
+        rows, cols = region
+        return rows.start < box[1] and box[0] < rows.stop and cols.start < box[3] and box[2] < cols.stop
+
+    def _factor(self, grid):
+        with self._lock:
+            if grid not in self._factors:
+                self._factors[grid] = SolidAngleFactor(
+                    grid.header, self.header["CRVAL1"], self.header["CRVAL2"]
+                )
+            return self._factors[grid]
+
+    def contribution(self, grid, region, ra, dec, kernel="lanczos3"):
+        """Values and weights of the snapshot interpolated onto a tile of a grid
+
+        Args:
+            grid (OutputGrid): The grid
+            region (tuple[slice,slice]): Rows and columns of the tile
+            ra (numpy.ndarray): Right ascension of the pixels of the tile in degrees
+            dec (numpy.ndarray): Declination of the pixels of the tile in degrees
+
+        Keyword Args:
+            kernel (str): Interpolation kernel (default: 'lanczos3')
+
+        Returns:
+            tuple[numpy.ndarray,numpy.ndarray,dict]: Flat indices of the tile pixels the snapshot
+            contributes to, their weights, and the values of each plane. None if it contributes nothing.
+        """
+        x, y = self.wcs.all_world2pix(ra.ravel(), dec.ravel(), 0)
+        ny, nx = self.shape
+        with np.errstate(invalid="ignore"):
+            inside = (x > -1) & (x < nx) & (y > -1) & (y < ny)
+        idx = np.flatnonzero(inside)
+        if len(idx) == 0:
+            return None
+        x, y = x[idx], y[idx]
+
+        # Only the block of the snapshot under the tile is read
+        margin = 4
+        by0, by1 = max(0, int(y.min()) - margin), min(ny, int(y.max()) + margin + 1)
+        bx0, bx1 = max(0, int(x.min()) - margin), min(nx, int(x.max()) + margin + 1)
+        block = np.asarray(self._plane(self.image)[by0:by1, bx0:bx1], dtype=np.float64)
+        values = interpolate(block, x - bx0, y - by0, kernel=kernel)
+
+        if self.weight is None:
+            weights = np.ones_like(values)
+        else:
+            wblock = np.asarray(self._plane(self.weight)[by0:by1, bx0:bx1], dtype=np.float64)
+            weights = interpolate(wblock, x - bx0, y - by0, kernel=kernel)
+
+        with np.errstate(invalid="ignore"):
+            good = np.isfinite(values) & np.isfinite(weights) & (weights > 0)
+        if not np.any(good):
+            return None
+        idx, weights = idx[good], weights[good]
+
+        planes = {"image": values[good]}
+        if self.beam is not None:
+            rows, cols = region
+            factor = self._factor(grid).tile(rows.start, rows.stop, cols.start, cols.stop).ravel()[idx]
+            bmaj, bmin, bpa = self.beam
+            planes["bmaj"] = bmaj * factor
+            planes["bmin"] = np.full(len(idx), bmin)
+            planes["bpa"] = np.full(len(idx), bpa)
+
+        return idx, weights, planes
+
+
+def coadd_tile(grid, snapshots, region, kernel="lanczos3", planes=("image",) + PSF_PLANES):
+    """Weighted sums of the snapshots overlapping a tile
+
+    Args:
+        grid (OutputGrid): The grid
+        snapshots (list[Snapshot]): Snapshots to co-add
+        region (tuple[slice,slice]): Rows and columns of the tile
+
+    Keyword Args:
+        kernel (str): Interpolation kernel (default: 'lanczos3')
+        planes (tuple[str]): Planes to accumulate (default: image, bmaj, bmin and bpa)
+
+    Returns:
+        tuple[dict,numpy.ndarray,numpy.ndarray]: Weighted sum of each plane, the sum of the
+        weights and the number of contributing snapshots, each with the shape of the tile
+    """
+    rows, cols = region
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
+    wsum = np.zeros(shape[0] * shape[1])
+    count = np.zeros(wsum.shape, dtype=np.int32)
+    sums = {plane: np.zeros_like(wsum) for plane in planes}
+
+    overlapping = [s for s in snapshots if s.overlaps(grid, region)]
+    if len(overlapping) > 0:
+        ra, dec = grid.world(region)
+        for snapshot in overlapping:
+            contribution = snapshot.contribution(grid, region, ra, dec, kernel=kernel)
+            if contribution is None:
+                continue
+            idx, weights, values = contribution
+            wsum[idx] += weights
+            count[idx] += 1
+            for plane in planes:
+                if plane in values:
+                    sums[plane][idx] += weights * values[plane]
+
+    return {plane: s.reshape(shape) for plane, s in sums.items()}, wsum.reshape(shape), count.reshape(shape)
+
+
+def _map_tiles(task, regions, threads=1):
+    """Results of a task for each tile, in order, evaluated by a pool of threads"""
+    if threads is None or threads < 2:
+        yield from map(task, regions)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        yield from pool.map(task, regions)
+
+
+def _write_means(data, region, sums, wsum, planes):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for plane in planes:
+            data[plane][region] = np.where(wsum > 0, sums[plane] / wsum, np.nan)
+    data["weight"][region] = wsum
+
+
+def output_names(outname, planes=("image",) + PSF_PLANES):
+    """Files a mosaic is written to, following the swarp naming of the pipeline:
+    <outname>.fits, <outname>.weight.fits and <outname>_<plane>.fits"""
+    names = {plane: f"{outname}.fits" if plane == "image" else f"{outname}_{plane}.fits" for plane in planes}
+    names["weight"] = f"{outname}.weight.fits"
+    return names
+
+
+def mosaic_header(grid, snapshots):
+    """Header of the mosaic, with the keywords of COPY_KEYWORDS taken from the first snapshot"""
+    hdr = grid.header.copy()
+    if len(snapshots) > 0:
+        for key in COPY_KEYWORDS:
+            if key in snapshots[0].header:
+                hdr[key] = snapshots[0].header[key]
+    return hdr
+
+
+def coadd(snapshots, grid, outname, kernel="lanczos3", tile=DEFAULT_TILE, threads=1, psf=True):
+    """Co-add snapshots onto a grid, writing the mean of each plane weighted by the
+    weight maps, and the summed weights. Tiles are processed by a pool of threads
+    and written straight into pre-allocated outputs.
+
+    Args:
+        snapshots (list[Snapshot]): Snapshots to co-add
+        grid (OutputGrid): Grid of the mosaic
+        outname (str): Output name, see ``output_names``
+
+    Keyword Args:
+        kernel (str): Interpolation kernel (default: 'lanczos3')
+        tile (int): Size of the square tiles in pixels (default: 1024)
+        threads (int): Number of threads processing tiles (default: 1)
+        psf (bool): Also co-add the bmaj, bmin and bpa planes (default: True)
+
+    Returns:
+        dict[str,str]: The file each plane, and the weights, were written to
+    """
+    planes = ("image",) + (PSF_PLANES if psf else ())
+    names = output_names(outname, planes=planes)
+    hdr = mosaic_header(grid, snapshots)
+
+    outputs = {key: allocate_fits(name, hdr, grid.shape) for key, name in names.items()}
+    try:
+        data = {key: out[0].data for key, out in outputs.items()}
+        regions = grid.tiles(tile=tile)
+        logger.info(f"Co-adding {len(snapshots)} snapshots onto {len(regions)} tiles of a {grid.shape} grid")
+
+        def task(region):
+            return region, coadd_tile(grid, snapshots, region, kernel=kernel, planes=planes)
+
+        for region, (sums, wsum, _) in _map_tiles(task, regions, threads=threads):
+            _write_means(data, region, sums, wsum, planes)
+    finally:
+        for out in outputs.values():
+            out.close()
+        for snapshot in snapshots:
+            snapshot.close()
+
+    return names
+
+
+def snapshot_id(path):
+    """Obsid of a snapshot, the leading ten digits of its file name, otherwise the file name"""
+    name = os.path.basename(path)
+    match = re.match(r"\d{10}", name)
+    return match.group(0) if match else name
+
+
+def file_checksum(path):
+    """MD5 checksum of a file"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(CHECKSUM_BLOCK), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """Path, size, modification time and checksum of a file. The checksum of a previous
+    fingerprint is reused when the path, size and modification time are unchanged.
+
+    Args:
+        path (str): The file, None for no file
+
+    Keyword Args:
+        previous (dict): Previous fingerprint of the file (default: None)
+
+    Returns:
+        dict: The fingerprint, None if path is None or the file does not exist
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    path = os.path.abspath(path)
+    info = os.stat(path)
+    stat = [info.st_size, info.st_mtime_ns]
+    if previous is not None and previous["path"] == path and previous["stat"] == stat:
+        return dict(previous)
+
+    return {"path": path, "stat": stat, "md5": file_checksum(path)}
+
+
+def _same_files(a, b):
+    """Whether two sets of fingerprints describe files with the same content"""
+    for key in ("image", "weight"):
+        if (a[key] is None) != (b[key] is None):
+            return False
+        if a[key] is not None and a[key]["md5"] != b[key]["md5"]:
+            return False
+    return True
+
+
+def _box_overlaps(box, region):
+    rows, cols = region
+    return rows.start < box[1] and box[0] < rows.stop and cols.start < box[3] and box[2] < cols.stop
+
+
+class Accumulator:
+    """Weighted sums of the planes of a mosaic, the sum of the weights and the number of
+    contributing snapshots, persisted as .npy files in a directory together with a
+    manifest of the snapshots they hold. Snapshots are added and removed by updating
+    only the tiles they cover."""
+
+    def __init__(self, path, header, planes, kernel, tile, snapshots, arrays):
+        self.path = path
+        self.header = header
+        self.grid = OutputGrid(header)
+        self.planes = tuple(planes)
+        self.kernel = kernel
+        self.tile = tile
+        self.snapshots = snapshots
+        self.arrays = arrays
+
+    @classmethod
+    def create(cls, path, header, planes, kernel="lanczos3", tile=DEFAULT_TILE):
+        """Empty accumulators for a mosaic
+
+        Args:
+            path (str): Directory to persist the accumulators to, created if needed
+            header (astropy.io.fits.Header): Header of the mosaic, describing its grid
+            planes (tuple[str]): Planes to accumulate
+
+        Keyword Args:
+            kernel (str): Interpolation kernel (default: 'lanczos3')
+            tile (int): Size of the square tiles in pixels (default: 1024)
+
+        Returns:
+            Accumulator: The accumulators
+        """
+        os.makedirs(path, exist_ok=True)
+        shape = (header["NAXIS2"], header["NAXIS1"])
+        # the manifest of any previous accumulators no longer describes the arrays
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            os.remove(os.path.join(path, MANIFEST))
+
+        arrays = {
+            name: open_memmap(os.path.join(path, f"{name}.npy"), mode="w+", dtype=np.float64, shape=shape)
+            for name in tuple(planes) + ("weight",)
+        }
+        arrays["count"] = open_memmap(os.path.join(path, "count.npy"), mode="w+", dtype=np.int32, shape=shape)
+
+        acc = cls(path, header, planes, kernel, tile, {}, arrays)
+        acc.save()
+
+        return acc
+
+    @classmethod
+    def open(cls, path):
+        """Accumulators persisted to a directory"""
+        with open(os.path.join(path, MANIFEST), "r") as infile:
+            manifest = json.load(infile)
+
+        if manifest["version"] != STATE_VERSION:
+            raise ValueError(f"Unsupported version {manifest['version']} of the accumulators in {path}")
+        if manifest["pending"] is not None:
+            raise RuntimeError(
+                f"{path} was interrupted while {manifest['pending']}. Remove it and co-add all snapshots again."
+            )
+
+        planes = manifest["planes"]
+        arrays = {
+            name: open_memmap(os.path.join(path, f"{name}.npy"), mode="r+")
+            for name in tuple(planes) + ("weight", "count")
+        }
+
+        return cls(
+            path,
+            fits.Header.fromstring(manifest["header"], sep="\n"),
+            planes,
+            manifest["kernel"],
+            manifest["tile"],
+            manifest["snapshots"],
+            arrays,
+        )
+
+    def save(self, pending=None):
+        """Flush the accumulators and write the manifest
+
+        Keyword Args:
+            pending (str): Change about to be made to the accumulators. The accumulators are
+            refused by ``open`` until the manifest is saved again without it (default: None)
+        """
+        for array in self.arrays.values():
+            array.flush()
+
+        manifest = {
+            "version": STATE_VERSION,
+            "header": self.header.tostring(sep="\n", endcard=False, padding=False),
+            "planes": list(self.planes),
+            "kernel": self.kernel,
+            "tile": self.tile,
+            "snapshots": self.snapshots,
+            "pending": pending,
+        }
+        # replaced atomically, so an interrupted update never leaves a partial manifest
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w") as outfile:
+            json.dump(manifest, outfile, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    @property
+    def centre(self):
+        """Right ascension and declination in degrees of the centre of the grid"""
+        return self.header["CRVAL1"], self.header["CRVAL2"]
+
+    def incompatible(self, planes, kernel, ra=None, dec=None, pixscale=None, shape=None):
+        """Reason the accumulators can not be updated as requested, None if they can. The
+        centre, pixel scale and shape are only compared when given."""
+        if tuple(planes) != self.planes:
+            return f"planes {self.planes} were accumulated, {tuple(planes)} requested"
+        if kernel != self.kernel:
+            return f"kernel {self.kernel} was used, {kernel} requested"
+        if ra is not None and not np.isclose(self.centre[0], ra):
+            return f"right ascension {self.centre[0]} was used, {ra} requested"
+        if dec is not None and not np.isclose(self.centre[1], dec):
+            return f"declination {self.centre[1]} was used, {dec} requested"
+        if pixscale is not None and not np.isclose(pixel_scale(self.grid.wcs), pixscale):
+            return f"pixel scale {pixel_scale(self.grid.wcs)} was used, {pixscale} requested"
+        if shape is not None and tuple(shape) != self.grid.shape:
+            return f"grid shape {self.grid.shape} was used, {tuple(shape)} requested"
+
+        return None
+
+    def grow(self, snapshots):
+        """Extend the grid to cover a set of snapshots, keeping what has been accumulated.
+        Only whole pixels are added to the edges of the grid and its projection is unchanged,
+        so the accumulated pixels stay valid.
+
+        Args:
+            snapshots (list[Snapshot]): Snapshots the grid should cover
+
+        Returns:
+            bool: Whether the grid was extended
+        """
+        ny, nx = self.grid.shape
+        bounds = [(0, ny, 0, nx)]
+        for snapshot in snapshots:
+            box = snapshot.footprint(self.grid, clip=False)
+            if box is None or not np.all(np.isfinite(box)):
+                raise ValueError(f"Unable to determine the footprint of {snapshot.image}")
+            bounds.append(box)
+
+        bounds = np.array(bounds, dtype=float)
+        y0, x0 = int(np.floor(bounds[:, 0].min())), int(np.floor(bounds[:, 2].min()))
+        y1, x1 = int(np.ceil(bounds[:, 1].max())), int(np.ceil(bounds[:, 3].max()))
+        if (y0, y1, x0, x1) == (0, ny, 0, nx):
+            return False
+
+        shape = (y1 - y0, x1 - x0)
+        logger.info(f"Extending the grid in {self.path} from {self.grid.shape} to {shape}")
+        self.save(pending="extending the grid")
+
+        header = self.header.copy()
+        header["NAXIS1"] = shape[1]
+        header["NAXIS2"] = shape[0]
+        header["CRPIX1"] -= x0
+        header["CRPIX2"] -= y0
+
+        for name, array in self.arrays.items():
+            final = os.path.join(self.path, f"{name}.npy")
+            tmp = os.path.join(self.path, f"{name}.tmp.npy")
+            grown = open_memmap(tmp, mode="w+", dtype=array.dtype, shape=shape)
+            for start in range(0, ny, self.tile):
+                stop = min(start + self.tile, ny)
+                grown[start - y0 : stop - y0, -x0 : nx - x0] = array[start:stop]
+            grown.flush()
+            os.replace(tmp, final)
+            self.arrays[name] = grown
+
+        for entry in self.snapshots.values():
+            box = entry["footprint"]
+            if box is not None:
+                entry["footprint"] = [box[0] - y0, box[1] - y0, box[2] - x0, box[3] - x0]
+
+        self.header = header
+        self.grid = OutputGrid(header)
+        self.save()
+
+        return True
+
+    def changes(self, snapshots):
+        """Snapshots added, removed or changed since the accumulators were last updated
+
+        Args:
+            snapshots (list[Snapshot]): Snapshots the mosaic should hold
+
+        Returns:
+            tuple[dict,list,list,list]: Fingerprints of each snapshot by obsid, and the obsids added,
+            removed and changed
+        """
+        current = {}
+        for snapshot in snapshots:
+            key = snapshot_id(snapshot.image)
+            if key in current:
+                raise ValueError(f"{key} is listed more than once")
+            previous = self.snapshots.get(key, {})
+            current[key] = {
+                "image": fingerprint(snapshot.image, previous.get("image")),
+                "weight": fingerprint(snapshot.weight, previous.get("weight")),
+            }
+
+        added = [key for key in current if key not in self.snapshots]
+        removed = [key for key in self.snapshots if key not in current]
+        changed = [
+            key for key in current if key in self.snapshots and not _same_files(current[key], self.snapshots[key])
+        ]
+
+        return current, added, removed, changed
+
+    def _apply(self, snapshots, regions, threads=1, sign=1, replace=False):
+        """Add (sign=1), subtract (sign=-1) or replace the accumulators of tiles with
+        the contributions of snapshots"""
+        planes = self.planes
+        arrays = self.arrays
+
+        def task(region):
+            return region, coadd_tile(self.grid, snapshots, region, kernel=self.kernel, planes=planes)
+
+        for region, (sums, wsum, count) in _map_tiles(task, regions, threads=threads):
+            if replace:
+                for plane in planes:
+                    arrays[plane][region] = sums[plane]
+                arrays["weight"][region] = wsum
+                arrays["count"][region] = count
+                continue
+
+            for plane in planes:
+                arrays[plane][region] += sign * sums[plane]
+            arrays["weight"][region] += sign * wsum
+            arrays["count"][region] += sign * count
+
+            # pixels left without contributors are reset exactly, rather than holding rounding errors
+            empty = arrays["count"][region] <= 0
+            if np.any(empty):
+                for name in planes + ("weight",):
+                    arrays[name][region][empty] = 0.0
+                arrays["count"][region][empty] = 0
+
+    def update(self, snapshots, threads=1):
+        """Bring the accumulators up to date with a set of snapshots. Added snapshots are
+        accumulated, and removed snapshots whose files are unchanged are subtracted, on
+        the tiles they cover. The tiles covered by snapshots that were re-processed, or
+        removed and no longer readable, are recomputed from the current snapshots.
+
+        Args:
+            snapshots (list[Snapshot]): Snapshots the mosaic should hold
+
+        Keyword Args:
+            threads (int): Number of threads processing tiles (default: 1)
+
+        Returns:
+            tuple[list,list,list]: The obsids added, removed and changed
+        """
+        current, added, removed, changed = self.changes(snapshots)
+        by_key = {snapshot_id(s.image): s for s in snapshots}
+        psf = "bmaj" in self.planes
+
+        subtract = []
+        dirty_boxes = []
+        for key in removed:
+            entry = self.snapshots[key]
+            now = {name: fingerprint(entry[name]["path"]) if entry[name] else None for name in ("image", "weight")}
+            if now["image"] is not None and _same_files(now, entry):
+                subtract.append(Snapshot(entry["image"]["path"], weight=entry["weight"] and entry["weight"]["path"], psf=psf))
+            else:
+                dirty_boxes.append(entry["footprint"])
+
+        for key in changed:
+            dirty_boxes.append(self.snapshots[key]["footprint"])
+            dirty_boxes.append(by_key[key].footprint(self.grid))
+
+        regions = self.grid.tiles(tile=self.tile)
+        dirty = [r for r in regions if any(box is not None and _box_overlaps(box, r) for box in dirty_boxes)]
+        clean = [r for r in regions if not any(box is not None and _box_overlaps(box, r) for box in dirty_boxes)]
+
+        logger.info(
+            f"{len(added)} snapshots added, {len(removed)} removed and {len(changed)} changed, "
+            f"{len(dirty)} of {len(regions)} tiles recomputed"
+        )
+
+        if len(added) + len(removed) + len(changed) > 0:
+            self.save(pending=f"updating {', '.join(sorted(added + removed + changed))}")
+
+        try:
+            if len(subtract) > 0:
+                self._apply(subtract, clean, threads=threads, sign=-1)
+            if len(added) > 0:
+                self._apply([by_key[key] for key in added], clean, threads=threads, sign=1)
+            if len(dirty) > 0:
+                self._apply(snapshots, dirty, threads=threads, replace=True)
+        finally:
+            for snapshot in subtract:
+                snapshot.close()
+
+        self.snapshots = {
+            key: dict(current[key], footprint=by_key[key].footprint(self.grid)) for key in current
+        }
+        self.save()
+
+        return added, removed, changed
+
+    def write(self, outname, threads=1):
+        """Write the mosaic held by the accumulators, see ``output_names``"""
+        names = output_names(outname, planes=self.planes)
+        outputs = {key: allocate_fits(name, self.header, self.grid.shape) for key, name in names.items()}
+        try:
+            data = {key: out[0].data for key, out in outputs.items()}
+
+            def task(region):
+                return region, {plane: np.asarray(self.arrays[plane][region]) for plane in self.planes}
+
+            for region, sums in _map_tiles(task, self.grid.tiles(tile=self.tile), threads=threads):
+                _write_means(data, region, sums, np.asarray(self.arrays["weight"][region]), self.planes)
+        finally:
+            for out in outputs.values():
+                out.close()
+
+        return names
+
+
+def update(path, snapshots, ra=None, dec=None, pixscale=None, shape=None, kernel="lanczos3", tile=DEFAULT_TILE,
+           threads=1, psf=True, rebuild=False):
+    """Accumulators of a mosaic persisted to a directory, updated with a set of snapshots.
+    Accumulators that do not exist, were made with a different centre, pixel scale, shape,
+    kernel or planes, or when rebuild is set, are created afresh on a grid covering the
+    snapshots. Otherwise a grid without a fixed shape is extended to cover new snapshots.
+
+    Args:
+        path (str): Directory of the accumulators
+        snapshots (list[Snapshot]): Snapshots the mosaic should hold
+
+    Keyword Args:
+        ra (float): Right ascension of the centre of the grid in degrees. The centre of
+        existing accumulators is kept if None (default: None)
+        dec (float): Declination of the centre of the grid in degrees. The centre of
+        existing accumulators is kept if None (default: None)
+        pixscale (float): Pixel size in degrees, see ``OutputGrid.covering`` (default: None)
+        shape (tuple[int,int]): Fixed shape of the grid, see ``OutputGrid.covering`` (default: None)
+        kernel (str): Interpolation kernel (default: 'lanczos3')
+        tile (int): Size of the square tiles of a new grid in pixels (default: 1024)
+        threads (int): Number of threads processing tiles (default: 1)
+        psf (bool): Also accumulate the bmaj, bmin and bpa planes (default: True)
+        rebuild (bool): Discard existing accumulators (default: False)
+
+    Returns:
+        Accumulator: The updated accumulators
+    """
+    planes = ("image",) + (PSF_PLANES if psf else ())
+
+    acc = None
+    if not rebuild and os.path.exists(os.path.join(path, MANIFEST)):
+        acc = Accumulator.open(path)
+        reason = acc.incompatible(planes, kernel, ra=ra, dec=dec, pixscale=pixscale, shape=shape)
+        if reason is not None:
+            logger.warning(f"Rebuilding the accumulators in {path}, {reason}")
+            ra = acc.centre[0] if ra is None else ra
+            dec = acc.centre[1] if dec is None else dec
+            acc = None
+
+    if acc is None:
+        if ra is None or dec is None:
+            raise ValueError(f"No accumulators in {path}, the centre of the mosaic is required")
+        grid = OutputGrid.covering(snapshots, ra, dec, pixscale=pixscale, shape=shape)
+        acc = Accumulator.create(path, mosaic_header(grid, snapshots), planes, kernel=kernel, tile=tile)
+
+    try:
+        if shape is None:
+            acc.grow(snapshots)
+        acc.update(snapshots, threads=threads)
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+
+    return acc
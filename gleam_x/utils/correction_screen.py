@@ -0,0 +1,239 @@
+"""Evaluate pixel-wise correction screens over images and mosaics. Sky coordinates
+are computed on a decimated pixel grid and bilinearly interpolated to full
+resolution, and the screen is produced in blocks of rows so that arbitrarily
+large images can be processed without holding full sized coordinate arrays.
+"""
+
+import numpy as np
+
+# Spacing, in pixels, of the grid on which the WCS is evaluated exactly
+DEFAULT_DECIMATE = 16
+# Number of pixels in a block of rows processed at a time
+DEFAULT_TILE_PIXELS = 4000000
+
+
+def row_tiles(shape, tile_pixels=DEFAULT_TILE_PIXELS):
+    """Divide an image into blocks of whole rows
+
+    Args:
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        tile_pixels (int): Approximate number of pixels in each block (default: 4000000)
+
+    Yields:
+        slice: Rows of each block
+    """
+    ny, nx = shape
+    nrows = max(1, tile_pixels // max(nx, 1))
+    for start in range(0, ny, nrows):
+        yield slice(start, min(start + nrows, ny))
+
+
+def _coarse_axis(n, decimate):
+    """Exactly evaluated sample positions along an axis, always including both ends"""
+    return np.unique(np.append(np.arange(0, n, decimate), n - 1))
+
+
+def _interp_weights(samples, positions):
+    """Lower sample index and fractional weight for linear interpolation"""
+    lower = np.clip(np.searchsorted(samples, positions, side="right") - 1, 0, max(len(samples) - 2, 0))
+    if len(samples) < 2:
+        return lower, np.zeros(len(positions))
+
+    upper = lower + 1
+    frac = (positions - samples[lower]) / (samples[upper] - samples[lower])
+
+    return lower, frac
+
+
+def _pix2world(w, x, y, origin):
+    ra, dec = w.all_pix2world(x, y, origin)
+    return np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+
+
+class _CoarseGrid:
+    """Exactly evaluated sky coordinates on a decimated pixel grid covering a block
+    of rows, with the weights needed to bilinearly interpolate to every pixel.
+    """
+
+    def __init__(self, w, shape, rows, decimate, origin):
+        ny, nx = shape
+        self.w = w
+        self.origin = origin
+        self.y = np.arange(ny)[rows]
+        self.x = np.arange(nx)
+
+        xs = _coarse_axis(nx, decimate)
+        ys = _coarse_axis(ny, decimate)
+
+        # Only the coarse rows bracketing the requested rows are evaluated
+        ylow, self.yfrac = _interp_weights(ys, self.y)
+        yup = np.minimum(ylow + 1, len(ys) - 1)
+        needed = np.unique(np.concatenate((ylow, yup)))
+        self.ylow = np.searchsorted(needed, ylow)
+        self.yup = np.searchsorted(needed, yup)
+
+        self.xlow, self.xfrac = _interp_weights(xs, self.x)
+        self.xup = np.minimum(self.xlow + 1, len(xs) - 1)
+
+        cxx, cyy = np.meshgrid(xs, ys[needed])
+        self.ra, self.dec = _pix2world(w, cxx, cyy, origin)
+
+    def interpolate(self, values):
+        """Bilinearly interpolate values on the coarse grid to every pixel"""
+        along_x = values[:, self.xlow] * (1 - self.xfrac) + values[:, self.xup] * self.xfrac
+        yfrac = self.yfrac[:, None]
+
+        return along_x[self.ylow] * (1 - yfrac) + along_x[self.yup] * yfrac
+
+    def exact(self, mask):
+        """Exact sky coordinates of the pixels selected by a mask over the block"""
+        iy, ix = np.nonzero(mask)
+        return _pix2world(self.w, self.x[ix], self.y[iy], self.origin)
+
+
+def pixel_world_coordinates(w, shape, rows=None, decimate=DEFAULT_DECIMATE, origin=0):
+    """Sky coordinates of every pixel in a block of rows of an image. The WCS is
+    evaluated on a grid decimated by ``decimate`` pixels and interpolated to each
+    pixel. The interpolation is done on cartesian unit vectors, so the 0/360
+    degree wrap in right ascension and the celestial poles are handled. Pixels
+    whose interpolation touches an invalid (e.g. off-sky) sample are evaluated exactly.
+
+    Args:
+        w (astropy.wcs.WCS): Celestial (two axis) WCS of the image
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        rows (slice): Rows to evaluate. If None the whole image is evaluated (default: None)
+        decimate (int): Spacing of the exactly evaluated grid. Values below 2 evaluate every pixel exactly (default: 16)
+        origin (int): Pixel origin passed to the WCS, 0 or 1 (default: 0)
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray]: Right ascension and declination in degrees, each with shape (nrows, nx)
+    """
+    ny, nx = shape
+    rows = slice(0, ny) if rows is None else rows
+
+    if decimate is None or decimate < 2:
+        xx, yy = np.meshgrid(np.arange(nx), np.arange(ny)[rows])
+        return _pix2world(w, xx, yy, origin)
+
+    grid = _CoarseGrid(w, shape, rows, decimate, origin)
+    cra, cdec = np.radians(grid.ra), np.radians(grid.dec)
+
+    ux = grid.interpolate(np.cos(cdec) * np.cos(cra))
+    uy = grid.interpolate(np.cos(cdec) * np.sin(cra))
+    uz = grid.interpolate(np.sin(cdec))
+
+    norm = np.sqrt(ux ** 2 + uy ** 2 + uz ** 2)
+    ra = np.degrees(np.arctan2(uy, ux)) % 360
+    dec = np.degrees(np.arcsin(np.clip(uz / norm, -1, 1)))
+
+    invalid = ~(np.isfinite(ra) & np.isfinite(dec))
+    if np.any(invalid):
+        ra[invalid], dec[invalid] = grid.exact(invalid)
+
+    return ra, dec
+
+
+def iter_screen(
+    func,
+    w,
+    shape,
+    decimate=DEFAULT_DECIMATE,
+    origin=0,
+    tile_pixels=DEFAULT_TILE_PIXELS,
+    smooth=False,
+):
+    """Evaluate a correction screen in blocks of rows
+
+    Args:
+        func (Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray]): Given the right ascension
+        and declination of a block of pixels in degrees, return the correction for those pixels
+        w (astropy.wcs.WCS): Celestial (two axis) WCS of the image
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        decimate (int): Spacing of the exactly evaluated WCS grid (default: 16)
+        origin (int): Pixel origin passed to the WCS, 0 or 1 (default: 0)
+        tile_pixels (int): Approximate number of pixels in each block (default: 4000000)
+        smooth (bool): The correction varies smoothly over the decimated grid, so ``func`` is evaluated on
+        that grid and the correction itself interpolated. Otherwise the sky coordinates are interpolated
+        and ``func`` is evaluated at every pixel (default: False)
+
+    Yields:
+        tuple[slice, numpy.ndarray]: Rows of the block and the correction for those rows
+    """
+    for rows in row_tiles(shape, tile_pixels=tile_pixels):
+        if smooth and decimate is not None and decimate >= 2:
+            grid = _CoarseGrid(w, shape, rows, decimate, origin)
+            values = grid.interpolate(np.asarray(func(grid.ra, grid.dec), dtype=np.float64))
+
+            invalid = ~np.isfinite(values)
+            if np.any(invalid):
+                values[invalid] = func(*grid.exact(invalid))
+        else:
+            ra, dec = pixel_world_coordinates(
+                w, shape, rows=rows, decimate=decimate, origin=origin
+            )
+            values = func(ra, dec)
+
+        yield rows, values
+
+
+def evaluate_screen(func, w, shape, dtype=np.float32, out=None, **kwargs):
+    """Evaluate a full correction screen. See ``iter_screen`` for the keyword arguments.
+
+    Args:
+        func (Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray]): Correction as a function of right ascension and declination
+        w (astropy.wcs.WCS): Celestial (two axis) WCS of the image
+        shape (tuple[int,int]): Shape of the image as (ny, nx)
+
+    Keyword Args:
+        dtype (numpy.dtype): Data type of the screen (default: numpy.float32)
+        out (numpy.ndarray): Pre-allocated array to write the screen into (default: None)
+
+    Returns:
+        numpy.ndarray: The correction screen with shape (ny, nx)
+    """
+    screen = np.empty(shape, dtype=dtype) if out is None else out
+    for rows, values in iter_screen(func, w, shape, **kwargs):
+        screen[rows] = values
+
+    return screen
+
+
+def apply_screen(data, func, w, **kwargs):
+    """Multiply an image in place by a correction screen, one block of rows at a
+    time, so the full screen is never held in memory. See ``iter_screen`` for the
+    keyword arguments.
+
+    Args:
+        data (numpy.ndarray): Image data. Leading axes of length one (e.g. stokes and frequency) are allowed.
+        func (Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray]): Correction as a function of right ascension and declination
+        w (astropy.wcs.WCS): Celestial (two axis) WCS of the image
+
+    Returns:
+        numpy.ndarray: The corrected data
+    """
+    plane = data[(0,) * (data.ndim - 2)]
+    for rows, values in iter_screen(func, w, plane.shape, **kwargs):
+        plane[rows] *= values
+
+    return data
+
+
+def polynomial_correction(coefficients, x):
+    """Multiplicative correction from a polynomial fitted to log10 ratios, i.e.
+    10 ** p(x), evaluated over a whole array with Horner's scheme.
+
+    Args:
+        coefficients (numpy.ndarray): Polynomial coefficients, highest order first as produced by numpy.polyfit
+        x (numpy.ndarray): Values to evaluate the polynomial at
+
+    Returns:
+        numpy.ndarray: The correction factor
+    """
+    coefficients = np.atleast_1d(coefficients)
+    return 10 ** np.polynomial.polynomial.polyval(x, coefficients[::-1])
@@ -0,0 +1,317 @@
+"""In-process positional crossmatching of catalogues, replacing calls out to
+stilts. A KD-tree is built over unit vectors of a reference catalogue once, and
+reused for any number of catalogues matched against it.
+"""
+
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, hstack
+from scipy.spatial import cKDTree
+
+# Header keywords used to record what a matched catalogue was derived from
+CACHE_KEYS = {"catalogue": "XMCATMT", "reference": "XMREFMT", "radius": "XMRADIUS"}
+
+
+def radec_to_unit(ra, dec):
+    """Convert sky positions to cartesian unit vectors
+
+    Args:
+        ra (numpy.ndarray): Right ascension in degrees
+        dec (numpy.ndarray): Declination in degrees
+
+    Returns:
+        numpy.ndarray: Unit vectors with shape (N, 3)
+    """
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+
+    return np.stack(
+        (cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)), axis=-1
+    ).reshape(-1, 3)
+
+
+def arcsec_to_chord(sep):
+    """Angular separation in arcseconds to the chord length between unit vectors"""
+    return 2 * np.sin(np.radians(np.asarray(sep) / 3600.0) / 2)
+
+
+def chord_to_arcsec(chord):
+    """Chord length between unit vectors to the angular separation in arcseconds"""
+    return np.degrees(2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))) * 3600.0
+
+
+class SkyIndex:
+    """Spatial index over the positions of a reference catalogue"""
+
+    def __init__(self, ra, dec):
+        """
+        Args:
+            ra (numpy.ndarray): Right ascension of the reference sources in degrees
+            dec (numpy.ndarray): Declination of the reference sources in degrees
+        """
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.xyz = radec_to_unit(self.ra, self.dec)
+        self.tree = cKDTree(self.xyz)
+
+    def __len__(self):
+        return len(self.ra)
+
+    @classmethod
+    def from_table(cls, table, ra_col="ra", dec_col="dec"):
+        """Build an index from the position columns of a table
+
+        Args:
+            table (astropy.table.Table): Table of reference sources
+
+        Keyword Args:
+            ra_col (str): Name of the right ascension column (default: 'ra')
+            dec_col (str): Name of the declination column (default: 'dec')
+        """
+        return cls(table[ra_col], table[dec_col])
+
+    def nearest(self, ra, dec, radius=None):
+        """Nearest reference source to each of the supplied positions
+
+        Args:
+            ra (numpy.ndarray): Right ascension in degrees
+            dec (numpy.ndarray): Declination in degrees
+
+        Keyword Args:
+            radius (float): Only consider reference sources within this many arcseconds (default: None)
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray]: Index of the nearest reference source and its
+            separation in arcseconds. Positions without a match have an index of -1 and an infinite separation.
+        """
+        bound = np.inf if radius is None else arcsec_to_chord(radius)
+        chord, idx = self.tree.query(radec_to_unit(ra, dec), k=1, distance_upper_bound=bound)
+
+        missing = ~np.isfinite(chord)
+        idx = np.where(missing, -1, idx)
+        sep = np.where(missing, np.inf, chord_to_arcsec(np.where(missing, 0, chord)))
+
+        return idx, sep
+
+    def cone(self, ra, dec, radius):
+        """Indices of all reference sources within a radius of a single position
+
+        Args:
+            ra (float): Right ascension in degrees
+            dec (float): Declination in degrees
+            radius (float): Search radius in arcseconds
+
+        Returns:
+            numpy.ndarray: Indices of the reference sources in the cone
+        """
+        xyz = radec_to_unit(ra, dec)[0]
+        return np.array(
+            sorted(self.tree.query_ball_point(xyz, arcsec_to_chord(radius))), dtype=int
+        )
+
+    def search_around(self, ra, dec, radius):
+        """All pairs of positions and reference sources within a radius, equivalent to
+        astropy's search_around_sky
+
+        Args:
+            ra (numpy.ndarray): Right ascension in degrees
+            dec (numpy.ndarray): Declination in degrees
+            radius (float): Maximum separation in arcseconds
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: Index into the supplied positions, index
+            into the reference catalogue and separation in arcseconds of each pair, ordered by the
+            index into the supplied positions
+        """
+        xyz = radec_to_unit(ra, dec)
+        valid = np.all(np.isfinite(xyz), axis=1)
+
+        matches = [[] for _ in range(len(xyz))]
+        if len(self) > 0 and np.any(valid):
+            found = self.tree.query_ball_point(xyz[valid], arcsec_to_chord(radius))
+            for i, refs in zip(np.flatnonzero(valid), found):
+                matches[i] = sorted(refs)
+
+        cat_idx = np.repeat(np.arange(len(xyz)), [len(m) for m in matches]).astype(int)
+        ref_idx = np.array([r for m in matches for r in m], dtype=int)
+        chord = np.linalg.norm(xyz[cat_idx] - self.xyz[ref_idx], axis=1)
+
+        return cat_idx, ref_idx, chord_to_arcsec(chord)
+
+    def isolated(self, radius):
+        """Reference sources without a neighbouring reference source within a radius
+
+        Args:
+            radius (float): Isolation radius in arcseconds
+
+        Returns:
+            numpy.ndarray: Boolean mask of the isolated reference sources
+        """
+        if len(self) < 2:
+            return np.ones(len(self), dtype=bool)
+
+        chord, _ = self.tree.query(self.xyz, k=2)
+
+        return chord[:, 1] > arcsec_to_chord(radius)
+
+    def best_match(self, ra, dec, radius, k=4):
+        """One-to-one matching of positions to the reference sources, equivalent to the
+        'best' mode of stilts tmatch2. Candidate pairs within the radius are accepted in
+        order of increasing separation, so each position and each reference source
+        appears in at most one pair.
+
+        Args:
+            ra (numpy.ndarray): Right ascension in degrees
+            dec (numpy.ndarray): Declination in degrees
+            radius (float): Maximum separation in arcseconds
+
+        Keyword Args:
+            k (int): Number of candidate reference sources considered per position (default: 4)
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: Index into the supplied positions, index
+            into the reference catalogue and separation in arcseconds of each matched pair
+        """
+        empty = (np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0))
+        if len(self) == 0:
+            return empty
+
+        xyz = radec_to_unit(ra, dec)
+        if len(xyz) == 0:
+            return empty
+
+        k = min(k, len(self))
+        chord, ref_idx = self.tree.query(
+            xyz, k=k, distance_upper_bound=arcsec_to_chord(radius)
+        )
+        chord = chord.reshape(len(xyz), k)
+        ref_idx = ref_idx.reshape(len(xyz), k)
+
+        cat_idx = np.repeat(np.arange(len(xyz)), k).reshape(len(xyz), k)
+        found = np.isfinite(chord)
+        chord, cat_idx, ref_idx = chord[found], cat_idx[found], ref_idx[found]
+
+        order = np.argsort(chord, kind="stable")
+        used_cat = np.zeros(len(xyz), dtype=bool)
+        used_ref = np.zeros(len(self), dtype=bool)
+        keep = np.zeros(len(order), dtype=bool)
+        for i in order:
+            c, r = cat_idx[i], ref_idx[i]
+            if not (used_cat[c] or used_ref[r]):
+                used_cat[c] = used_ref[r] = keep[i] = True
+
+        keep_order = order[keep[order]]
+
+        return (
+            cat_idx[keep_order],
+            ref_idx[keep_order],
+            chord_to_arcsec(chord[keep_order]),
+        )
+
+
+def join_matches(ref_table, cat_table, cat_idx, ref_idx, sep):
+    """Join the matched rows of two tables side by side, in the same layout as the
+    stilts tmatch2 output: reference columns first, duplicated column names suffixed
+    with _1 and _2, and a Separation column in arcseconds.
+
+    Args:
+        ref_table (astropy.table.Table): Reference catalogue (in1 for stilts)
+        cat_table (astropy.table.Table): Catalogue that was matched (in2 for stilts)
+        cat_idx (numpy.ndarray): Matched row indices of cat_table
+        ref_idx (numpy.ndarray): Matched row indices of ref_table
+        sep (numpy.ndarray): Separation of each pair in arcseconds
+
+    Returns:
+        astropy.table.Table: The joined table
+    """
+    joined = hstack(
+        [ref_table[ref_idx], cat_table[cat_idx]],
+        table_names=["1", "2"],
+        uniq_col_name="{col_name}_{table_name}",
+        join_type="exact",
+        metadata_conflicts="silent",
+    )
+    joined["Separation"] = np.asarray(sep, dtype=np.float64)
+    joined["Separation"].unit = "arcsec"
+
+    return joined
+
+
+def _mtime(path):
+    return float(os.path.getmtime(path))
+
+
+def is_cached(out_path, cat_path, ref_path=None, radius=None):
+    """Whether a matched catalogue on disk was made from the current versions of its
+    inputs, based on the modification times recorded in its header.
+
+    Args:
+        out_path (str): Matched catalogue
+        cat_path (str): Catalogue that was matched
+
+    Keyword Args:
+        ref_path (str): Reference catalogue that was matched against (default: None)
+        radius (float): Match radius in arcseconds (default: None)
+
+    Returns:
+        bool: True if the matched catalogue can be reused
+    """
+    if not os.path.exists(out_path):
+        return False
+
+    try:
+        hdr = fits.getheader(out_path, 1)
+    except (OSError, IndexError):
+        return False
+
+    checks = [(CACHE_KEYS["catalogue"], _mtime(cat_path))]
+    if ref_path is not None:
+        checks.append((CACHE_KEYS["reference"], _mtime(ref_path)))
+    if radius is not None:
+        checks.append((CACHE_KEYS["radius"], float(radius)))
+
+    return all(
+        key in hdr and np.isclose(hdr[key], value, rtol=0, atol=1e-3)
+        for key, value in checks
+    )
+
+
+def crossmatch_to_file(
+    cat_path, out_path, index, ref_table, radius, ref_path=None, overwrite=False
+):
+    """Match a catalogue on disk against an indexed reference catalogue and write the
+    joined table. The modification times of the inputs are recorded in the output
+    header, and an existing output made from the same inputs is reused.
+
+    Args:
+        cat_path (str): Catalogue to match, with 'ra' and 'dec' columns
+        out_path (str): Output matched catalogue
+        index (SkyIndex): Index over the positions of ref_table
+        ref_table (astropy.table.Table): Reference catalogue
+        radius (float): Maximum separation in arcseconds
+
+    Keyword Args:
+        ref_path (str): File the reference catalogue was read from, recorded for caching (default: None)
+        overwrite (bool): Recompute even if a cached output is valid (default: False)
+
+    Returns:
+        int: Number of matched sources, or -1 if the cached output was reused
+    """
+    if not overwrite and is_cached(out_path, cat_path, ref_path=ref_path, radius=radius):
+        return -1
+
+    cat = Table.read(cat_path)
+    cat_idx, ref_idx, sep = index.best_match(cat["ra"], cat["dec"], radius)
+    joined = join_matches(ref_table, cat, cat_idx, ref_idx, sep)
+
+    joined.meta[CACHE_KEYS["catalogue"]] = _mtime(cat_path)
+    joined.meta[CACHE_KEYS["radius"]] = float(radius)
+    if ref_path is not None:
+        joined.meta[CACHE_KEYS["reference"]] = _mtime(ref_path)
+
+    joined.write(out_path, overwrite=True)
+
+    return len(joined)
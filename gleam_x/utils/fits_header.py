@@ -0,0 +1,206 @@
+"""Minimal reader of FITS headers that does not import astropy.io.fits. Only the
+header blocks of the requested HDU are read, which makes looking up a few
+keywords in a metafits or image file far cheaper than opening it with astropy,
+mostly because of the time astropy takes to import. Values are converted to the
+same python types astropy would return for them.
+"""
+
+import gzip
+import math
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Keywords whose cards have no value, only free text
+COMMENTARY = ("COMMENT", "HISTORY", "")
+
+
+class FastHeader:
+    """Read-only, ordered set of header cards supporting the lookups pyhead needs"""
+
+    def __init__(self, cards):
+        """
+        Args:
+            cards (list[tuple[str,object]]): Keyword and value of each card, in header order
+        """
+        self.cards = cards
+        self._values = {}
+        for key, value in cards:
+            if key in COMMENTARY:
+                self._values[key] = f"{self._values[key]}\n{value}" if key in self._values else value
+            else:
+                self._values.setdefault(key, value)
+
+    def __contains__(self, key):
+        return key.upper() in self._values
+
+    def __getitem__(self, key):
+        return self._values[key.upper()]
+
+    def __len__(self):
+        return len(self.cards)
+
+    def get(self, key, default=None):
+        return self._values.get(key.upper(), default)
+
+    def keys(self):
+        return [key for key, _ in self.cards]
+
+    def items(self):
+        return list(self.cards)
+
+
+def _parse_string(field):
+    """Split a quoted string value from the remainder of the card"""
+    chars = []
+    i = 1
+    while i < len(field):
+        if field[i] == "'":
+            if field[i + 1 : i + 2] == "'":
+                chars.append("'")
+                i += 2
+                continue
+            return "".join(chars).rstrip(), field[i + 1 :]
+        chars.append(field[i])
+        i += 1
+
+    raise ValueError(f"Unterminated string in card value {field!r}")
+
+
+def _parse_number(text):
+    text = text.replace("D", "E").replace("d", "e")
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_value(field):
+    """Convert the value field of a card (the text after '= ') to a python value
+
+    Args:
+        field (str): Value field, including any trailing comment
+
+    Returns:
+        object: The value as a str, bool, int, float or complex. None if the value is undefined.
+    """
+    field = field.lstrip()
+    if field.startswith("'"):
+        return _parse_string(field)[0]
+
+    text = field.split("/", 1)[0].strip()
+    if text == "":
+        return None
+    if text == "T":
+        return True
+    if text == "F":
+        return False
+    if text.startswith("(") and text.endswith(")"):
+        real, imag = text[1:-1].split(",")
+        return complex(_parse_number(real.strip()), _parse_number(imag.strip()))
+
+    return _parse_number(text)
+
+
+def parse_card(card):
+    """Keyword and value of a single 80 character card
+
+    Args:
+        card (str): The card image
+
+    Returns:
+        tuple[str,object]: Keyword and value of the card
+    """
+    if card.startswith("HIERARCH ") and "=" in card:
+        key, field = card[9:].split("=", 1)
+        return key.strip().upper(), parse_value(field)
+
+    key = card[:8].strip().upper()
+    if key in COMMENTARY or key == "CONTINUE" or card[8:10] != "= ":
+        return key, card[8:].rstrip()
+
+    return key, parse_value(card[10:])
+
+
+def _read_block_cards(infile):
+    """Cards of the next header in a file, stopping at its END card"""
+    cards = []
+    while True:
+        block = infile.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError("File ended before the END card of a header")
+        text = block.decode("ascii")
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = text[i : i + CARD_SIZE]
+            if card[:8].rstrip() == "END":
+                return cards
+            cards.append(card)
+
+
+def _join_continue(cards):
+    """Parse cards, joining long strings split over CONTINUE cards"""
+    parsed = []
+    for card in cards:
+        key, value = parse_card(card)
+        if key == "CONTINUE":
+            prev_key, prev_value = parsed[-1] if parsed else (None, None)
+            if not (isinstance(prev_value, str) and prev_value.endswith("&")):
+                raise ValueError("CONTINUE card without a preceding long string")
+            text = value.lstrip()
+            more = _parse_string(text)[0] if text.startswith("'") else ""
+            parsed[-1] = (prev_key, prev_value[:-1] + more)
+            continue
+        parsed.append((key, value))
+
+    return parsed
+
+
+def _data_size(header):
+    """Size in bytes of the (padded) data following a header"""
+    naxis = header.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+
+    axes = [header.get(f"NAXIS{i}", 0) for i in range(1, naxis + 1)]
+    if header.get("GROUPS", False) and axes[0] == 0:
+        axes = axes[1:]
+    size = (
+        abs(header.get("BITPIX")) // 8
+        * header.get("GCOUNT", 1)
+        * (header.get("PCOUNT", 0) + math.prod(axes))
+    )
+
+    return BLOCK_SIZE * math.ceil(size / BLOCK_SIZE)
+
+
+def read_header(path, ext=0):
+    """Read the header of an HDU of a FITS file, skipping the data of any HDU before it
+
+    Args:
+        path (str): FITS file, optionally gzip compressed
+
+    Keyword Args:
+        ext (int): Index of the HDU (default: 0)
+
+    Raises:
+        ValueError: The file is not a FITS file this reader can parse, or the HDU does not exist
+
+    Returns:
+        FastHeader: The header
+    """
+    ext = int(ext)
+    with open(path, "rb") as infile:
+        compressed = infile.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+
+    with opener(path, "rb") as infile:
+        if infile.read(6) != b"SIMPLE":
+            raise ValueError(f"{path} is not a FITS file")
+        infile.seek(0)
+
+        for i in range(ext + 1):
+            header = FastHeader(_join_continue(_read_block_cards(infile)))
+            if i < ext:
+                infile.seek(_data_size(header), 1)
+
+    return header
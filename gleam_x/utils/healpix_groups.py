@@ -0,0 +1,129 @@
+"""Grouped aggregation of table columns over HEALPix pixels and their
+neighbourhoods. Per-pixel sums and counts are accumulated in a single
+``np.bincount`` pass over the sources, and the sum over a neighbourhood of
+pixels is a lookup of a precomputed neighbour-index matrix, so the cost no
+longer scales as the number of pixels times the number of sources.
+"""
+
+import healpy as hp
+import numpy as np
+
+# Fill value of neighbour-index matrices for missing neighbours
+NO_PIXEL = -1
+
+
+def _unique_rows(matrix):
+    """Sort each row of an index matrix and replace repeated entries with NO_PIXEL"""
+    matrix = np.sort(matrix, axis=1)
+    repeated = np.zeros(matrix.shape, dtype=bool)
+    repeated[:, 1:] = matrix[:, 1:] == matrix[:, :-1]
+    matrix[repeated] = NO_PIXEL
+
+    return matrix
+
+
+def neighbour_matrix(pixels, order=4, max_dphi=None):
+    """Each pixel together with its immediate neighbours
+
+    Args:
+        pixels (numpy.ndarray): HEALPix pixel indices (NESTED=False)
+
+    Keyword Args:
+        order (int): HEALPix order of the pixels (default: 4)
+        max_dphi (float): Only keep neighbours whose longitude, in radians, is within this of the
+        pixel, as in a horizontal neighbourhood (default: None)
+
+    Returns:
+        numpy.ndarray: Index matrix with shape (N, 9), NO_PIXEL where a neighbour is missing
+    """
+    nside = 2 ** order
+    pixels = np.asarray(pixels, dtype=np.int64)
+    neighbours = hp.get_all_neighbours(nside, pixels).T.astype(np.int64)
+
+    if max_dphi is not None:
+        _, phi = hp.pix2ang(nside, pixels)
+        _, nb_phi = hp.pix2ang(nside, np.where(neighbours == NO_PIXEL, 0, neighbours))
+        neighbours[np.abs(nb_phi - phi[:, np.newaxis]) >= max_dphi] = NO_PIXEL
+
+    return _unique_rows(np.column_stack((pixels, neighbours)))
+
+
+def neighbourhoods(pixels, order=4, nn=1, max_dphi=None):
+    """Pixels within ``nn`` steps of each of a set of pixels, equivalent to
+    repeatedly adding the neighbours of every pixel already in the neighbourhood
+
+    Args:
+        pixels (numpy.ndarray): HEALPix pixel indices
+
+    Keyword Args:
+        order (int): HEALPix order of the pixels (default: 4)
+        nn (int): Number of steps (default: 1)
+        max_dphi (float): Restrict each step to neighbours within this longitude, in radians (default: None)
+
+    Returns:
+        numpy.ndarray: Index matrix with one row per pixel, NO_PIXEL padded
+    """
+    pixels = np.asarray(pixels, dtype=np.int64)
+    matrix = pixels[:, np.newaxis]
+
+    for _ in range(nn):
+        members = np.unique(matrix[matrix != NO_PIXEL])
+        steps = neighbour_matrix(members, order=order, max_dphi=max_dphi)
+
+        # neighbours of every member of every neighbourhood, missing members contribute nothing
+        rows = np.searchsorted(members, np.where(matrix == NO_PIXEL, members[0], matrix))
+        expanded = np.where((matrix == NO_PIXEL)[..., np.newaxis], NO_PIXEL, steps[rows])
+        matrix = _unique_rows(expanded.reshape(len(pixels), -1))
+
+        # drop the columns that are entirely padding
+        keep = (matrix != NO_PIXEL).any(axis=0)
+        matrix = matrix[:, keep]
+
+    return matrix
+
+
+class HealpixGroups:
+    """Sums of table columns over the sources in each HEALPix pixel"""
+
+    def __init__(self, hpx, columns, order=4):
+        """
+        Args:
+            hpx (numpy.ndarray): HEALPix pixel of each source
+            columns (dict[str,numpy.ndarray]): Values of each source to accumulate
+
+        Keyword Args:
+            order (int): HEALPix order of the pixels (default: 4)
+        """
+        self.order = order
+        npix = hp.nside2npix(2 ** order)
+        hpx = np.asarray(hpx, dtype=np.int64)
+
+        # The trailing element is the sum over the NO_PIXEL padding, always zero
+        self.counts = np.append(np.bincount(hpx, minlength=npix), 0)
+        self.sums = {
+            name: np.append(
+                np.bincount(hpx, weights=np.asarray(values, dtype=np.float64), minlength=npix), 0.0
+            )
+            for name, values in columns.items()
+        }
+
+    def pixels(self):
+        """Pixels containing at least one source"""
+        return np.flatnonzero(self.counts[:-1])
+
+    def _gather(self, values, matrix):
+        return values[np.where(matrix == NO_PIXEL, len(values) - 1, matrix)].sum(axis=1)
+
+    def count(self, matrix):
+        """Number of sources in each neighbourhood of an index matrix"""
+        return self._gather(self.counts, matrix)
+
+    def sum(self, name, matrix):
+        """Sum of a column over the sources in each neighbourhood of an index matrix"""
+        return self._gather(self.sums[name], matrix)
+
+    def mean(self, name, matrix):
+        """Mean of a column over the sources in each neighbourhood of an index matrix.
+        Empty neighbourhoods are NaN."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sum(name, matrix) / self.count(matrix)
@@ -0,0 +1,171 @@
+"""Batched operations on calibration solutions in the format of the mwareduce /
+calplots ``aocal`` files. Solutions are complex arrays of shape
+(interval, antenna, channel, 4), where the last axis holds the XX, XY, YX and YY
+elements of a 2x2 Jones matrix. Every function works on the whole array at once
+rather than looping over intervals, antennas and channels, and returns an array
+of the same class as its input so the result can still be written with
+``aocal.tofile``.
+"""
+
+import numpy as np
+
+# Index of the XX and YY elements along the last axis of a solutions array
+XX, XY, YX, YY = 0, 1, 2, 3
+DIAGONAL = (XX, YY)
+
+
+def invert(ao):
+    """Invert the Jones matrix of every interval, antenna and channel. Singular
+    and flagged (NaN) matrices become NaN.
+
+    Args:
+        ao (numpy.ndarray): Solutions with shape (..., 4)
+
+    Returns:
+        numpy.ndarray: The inverted solutions, with the same shape and class as ao
+    """
+    a, b, c, d = (ao[..., i] for i in (XX, XY, YX, YY))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = a * d - b * c
+        inv_det = np.where(det != 0, 1.0 / det, np.nan)
+
+    out = ao.copy()
+    out[..., XX] = d * inv_det
+    out[..., XY] = -b * inv_det
+    out[..., YX] = -c * inv_det
+    out[..., YY] = a * inv_det
+
+    return out
+
+
+def ratio(numerator, denominator):
+    """Element-wise ratio of two sets of solutions, with non-finite results set to NaN
+
+    Args:
+        numerator (numpy.ndarray): Solutions acting as the numerator
+        denominator (numpy.ndarray): Solutions acting as the denominator
+
+    Returns:
+        numpy.ndarray: The ratio of the solutions
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = numerator / denominator
+    out[~np.isfinite(out)] = np.nan
+
+    return out
+
+
+def divide_refant(ao, refant):
+    """Divide the solutions of every antenna by those of a reference antenna, in
+    the same interval and channel
+
+    Args:
+        ao (numpy.ndarray): Solutions with shape (interval, antenna, channel, 4)
+        refant (int): Index of the reference antenna
+
+    Returns:
+        numpy.ndarray: The referenced solutions
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ao / ao[:, refant, np.newaxis, :, :]
+
+
+def reference_phasor(ao, refant, interval=0):
+    """Unit phasors of a reference antenna in a single interval, shaped to
+    broadcast against the full set of solutions"""
+    ref = np.asarray(ao[interval, refant, ...])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (ref / np.abs(ref))[np.newaxis, np.newaxis, ...]
+
+
+def phase_reference(ao, refant, interval=0, incremental=False):
+    """Remove the phase of a reference antenna from all solutions
+
+    Args:
+        ao (numpy.ndarray): Solutions with shape (interval, antenna, channel, 4)
+        refant (int): Index of the reference antenna
+
+    Keyword Args:
+        interval (int): Interval of the reference antenna the phases are taken from (default: 0)
+        incremental (bool): Form an incremental solution, ``ao / (ao * phasor)`` (default: False)
+
+    Returns:
+        numpy.ndarray: The phase referenced solutions
+    """
+    phasor = reference_phasor(ao, refant, interval=interval)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ao / (ao * phasor) if incremental else ao / phasor
+
+
+def zero_crossterms(ao):
+    """Set the XY and YX elements of all solutions to zero, in place"""
+    ao[..., XY] = 0
+    ao[..., YX] = 0
+
+    return ao
+
+
+def apply_xy_phase(ao, xy=0.0, dxy=0.0, freqs=None):
+    """Add a phase, and a phase slope with frequency, to the YY solutions, in place
+
+    Args:
+        ao (numpy.ndarray): Solutions with shape (interval, antenna, channel, 4)
+
+    Keyword Args:
+        xy (float): Phase to add in degrees (default: 0.0)
+        dxy (float): Slope of the phase to add in degrees per Hz (default: 0.0)
+        freqs (numpy.ndarray): Frequency of each channel in Hz, required if dxy is not zero (default: None)
+
+    Returns:
+        numpy.ndarray: The solutions
+    """
+    phase = np.full(ao.shape[2], xy, dtype=np.float64)
+    if dxy != 0.0:
+        phase = phase + dxy * np.asarray(freqs, dtype=np.float64)
+    ao[..., YY] *= np.exp(1j * np.radians(phase))
+
+    return ao
+
+
+def valid_intervals(ao, refant):
+    """Indices of the intervals in which the reference antenna has any unflagged XX solution"""
+    return np.flatnonzero(~np.isnan(ao[:, refant, :, XX]).all(axis=-1))
+
+
+def phase_diff(start, end, pols=DIAGONAL):
+    """Phase change in degrees between two sets of solutions for a single interval
+
+    Args:
+        start (numpy.ndarray): Solutions with shape (antenna, channel, 4)
+        end (numpy.ndarray): Solutions with shape (antenna, channel, 4)
+
+    Keyword Args:
+        pols (tuple[int]): Polarisations to difference (default: XX and YY)
+
+    Returns:
+        numpy.ndarray: Phase changes with shape (antenna, polarisation, channel)
+    """
+    pols = list(pols)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.asarray(end)[..., pols] / np.asarray(start)[..., pols]
+
+    return np.moveaxis(np.angle(change, deg=True), -1, 1)
+
+
+def phase_rms(ao, pols=DIAGONAL):
+    """Standard deviation over intervals of the phase in degrees of each antenna,
+    polarisation and channel
+
+    Args:
+        ao (numpy.ndarray): Solutions with shape (interval, antenna, channel, 4)
+
+    Keyword Args:
+        pols (tuple[int]): Polarisations to include (default: XX and YY)
+
+    Returns:
+        numpy.ndarray: Phase RMS with shape (antenna, polarisation, channel)
+    """
+    angles = np.angle(np.asarray(ao)[..., list(pols)], deg=True)
+
+    return np.moveaxis(np.std(angles, axis=0), -1, 1)
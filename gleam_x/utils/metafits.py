@@ -0,0 +1,295 @@
+"""Shared reader of MWA metafits files. The parts of a metafits file the pipeline
+uses (pointing, timing, dipole delays, coarse channels and the tile table) are
+returned as a typed observation record, with the tile table read only when it
+is first used. Records are kept in a small JSON cache
+in the directory of each metafits file, keyed by the path, modification time
+and size of the file, so that repeated lookups by the many scripts of the
+pipeline do not each reopen and parse the FITS file.
+"""
+
+import os
+import json
+import logging
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from gleam_x.utils.fits_header import FastHeader, read_header
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+CACHE_NAME = ".metafits_cache.json"
+
+# Dipole delay used in the tile table to mark a dead dipole
+DEAD_DIPOLE_DELAY = 32
+
+
+def _int_list(value):
+    if value is None:
+        return None
+    return [int(v) for v in str(value).split(",") if v.strip() != ""]
+
+
+@dataclass
+class Observation:
+    """Contents of a metafits file used throughout the pipeline"""
+
+    path: str
+    obsid: int
+    date_obs: str
+    exposure: float
+    ra: float
+    dec: float
+    altitude: Optional[float]
+    azimuth: Optional[float]
+    delays: Optional[List[int]]
+    channels: Optional[List[int]]
+    centchan: Optional[int]
+    freqcent: Optional[float]
+    bandwidth: Optional[float]
+    gridnum: Optional[int]
+    cards: list = field(default_factory=list, repr=False)
+    _tiles: Optional[Dict[str, np.ndarray]] = field(default=None, repr=False)
+
+    @classmethod
+    def from_header(cls, path, header, tiles=None):
+        """Create a record from the primary header and tile table of a metafits file
+
+        Args:
+            path (str): The metafits file
+            header (gleam_x.utils.fits_header.FastHeader): Its primary header
+
+        Keyword Args:
+            tiles (dict[str,numpy.ndarray]): Columns of the tile table. If None they are read from
+            the file when first used (default: None)
+        """
+        return cls(
+            path=path,
+            obsid=int(header["GPSTIME"]),
+            date_obs=header["DATE-OBS"],
+            exposure=float(header.get("EXPOSURE", 0.0)),
+            ra=float(header["RA"]),
+            dec=float(header["DEC"]),
+            altitude=header.get("ALTITUDE"),
+            azimuth=header.get("AZIMUTH"),
+            delays=_int_list(header.get("DELAYS")),
+            channels=_int_list(header.get("CHANNELS")),
+            centchan=header.get("CENTCHAN"),
+            freqcent=header.get("FREQCENT"),
+            bandwidth=header.get("BANDWDTH"),
+            gridnum=header.get("GRIDNUM"),
+            cards=header.items(),
+            _tiles=tiles,
+        )
+
+    @property
+    def tiles(self):
+        """Columns of the tile table, read from the metafits file when first used"""
+        if self._tiles is None:
+            self._tiles = read_tile_table(self.path)
+        return self._tiles
+
+    @property
+    def header(self):
+        """Primary header of the metafits file"""
+        return FastHeader(self.cards)
+
+    def get(self, key, default=None):
+        """Value of a keyword of the primary header"""
+        return self.header.get(key, default)
+
+    @property
+    def freq(self):
+        """Central frequency in Hz"""
+        return None if self.freqcent is None else self.freqcent * 1.0e6
+
+    @property
+    def start_time(self):
+        """Start of the observation as an astropy Time"""
+        from astropy.time import Time
+
+        return Time(self.date_obs, format="isot", scale="utc")
+
+    @property
+    def mid_time(self):
+        """Mid-point of the observation as an astropy Time"""
+        import astropy.units as u
+
+        return self.start_time + 0.5 * self.exposure * u.s
+
+    @property
+    def pointing(self):
+        """Phase centre of the observation as an astropy SkyCoord"""
+        import astropy.units as u
+        from astropy.coordinates import SkyCoord
+
+        return SkyCoord(ra=self.ra, dec=self.dec, unit=(u.deg, u.deg))
+
+    @property
+    def dipole_flags(self):
+        """Boolean array marking the dead dipoles of each input of the tile table"""
+        return np.asarray(self.tiles["Delays"]) == DEAD_DIPOLE_DELAY
+
+    def tile_order(self, pol="X"):
+        """Rows of the tile table describing each tile, ordered by tile number
+
+        Keyword Args:
+            pol (str): Polarisation of the inputs to describe the tiles with (default: 'X')
+
+        Returns:
+            numpy.ndarray: Indices into the columns of the tile table
+        """
+        rows = np.flatnonzero(np.char.strip(self.tiles["Pol"].astype(str)) == pol)
+
+        return rows[np.argsort(self.tiles["Tile"][rows], kind="stable")]
+
+    def tile_positions(self, pol="X"):
+        """Names and positions of the tiles, ordered by tile number
+
+        Keyword Args:
+            pol (str): Polarisation of the inputs to describe the tiles with (default: 'X')
+
+        Returns:
+            tuple[numpy.ndarray,numpy.ndarray,numpy.ndarray]: Tile names, and their north and east positions in metres
+        """
+        order = self.tile_order(pol=pol)
+
+        return tuple(self.tiles[col][order] for col in ("TileName", "North", "East"))
+
+    def to_dict(self):
+        record = {k: getattr(self, k) for k in self.__dataclass_fields__ if k != "_tiles"}
+        # the tile table is only kept if it has been read
+        record["tiles"] = None if self._tiles is None else {
+            name: np.asarray(col).tolist() for name, col in self._tiles.items()
+        }
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        record = dict(record)
+        record["cards"] = [tuple(card) for card in record["cards"]]
+        tiles = record.pop("tiles", None)
+        record["_tiles"] = None if tiles is None else {name: np.array(col) for name, col in tiles.items()}
+        return cls(**record)
+
+
+def read_tile_table(path):
+    """Columns of the tile table in the first extension of a metafits file
+
+    Args:
+        path (str): The metafits file
+
+    Returns:
+        dict[str,numpy.ndarray]: Column name to values. Empty if the file has no tile table.
+    """
+    from astropy.io import fits
+
+    with fits.open(path) as hdus:
+        if len(hdus) < 2 or hdus[1].data is None:
+            return {}
+        data = hdus[1].data
+        return {name: np.array(data[name]) for name in data.columns.names}
+
+
+def read_metafits(path, tiles=False):
+    """Read the primary header of a metafits file, bypassing the cache
+
+    Args:
+        path (str): The metafits file
+
+    Keyword Args:
+        tiles (bool): Also read the tile table, rather than when it is first used (default: False)
+
+    Returns:
+        Observation: The observation it describes
+    """
+    return Observation.from_header(path, read_header(path), tiles=read_tile_table(path) if tiles else None)
+
+
+def default_cache_path(path):
+    """Cache file used for a metafits file, kept in the same directory"""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_NAME)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def _read_cache(cache):
+    try:
+        with open(cache, "r") as infile:
+            entries = json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+    return entries if entries.get("version") == CACHE_VERSION else {}
+
+
+def _write_cache(cache, key, entry):
+    """Add an entry to a cache file, replacing it atomically. The file is re-read
+    first so entries added by other processes are kept."""
+    entries = _read_cache(cache)
+    entries["version"] = CACHE_VERSION
+    entries.setdefault("records", {})[key] = entry
+
+    parent = os.path.dirname(os.path.abspath(cache))
+    fd, tmp = tempfile.mkstemp(prefix=".metafits_", dir=parent)
+    try:
+        with os.fdopen(fd, "w") as out:
+            json.dump(entries, out)
+        # mkstemp creates the file readable only by its owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, cache)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_metafits(path, cache=None, tiles=False):
+    """Observation record of a metafits file, from the cache when the file has not
+    changed since it was cached. Records are added to the cache on a miss, which is
+    silently skipped if the cache can not be written.
+
+    Args:
+        path (str): The metafits file
+
+    Keyword Args:
+        cache (str,bool): Cache file to use. If None the cache in the directory of the metafits
+        file is used, and if False no cache is used (default: None)
+        tiles (bool): Also read the tile table, and cache it with the record, rather than
+        reading it when first used (default: False)
+
+    Returns:
+        Observation: The observation the metafits file describes
+    """
+    if cache is False:
+        return read_metafits(path, tiles=tiles)
+
+    cache = default_cache_path(path) if cache is None else cache
+    key = os.path.abspath(path)
+    stamp = _stamp(path)
+
+    entry = _read_cache(cache).get("records", {}).get(key)
+    if entry is not None and entry["stamp"] == stamp:
+        obs = Observation.from_dict(entry["record"])
+        obs.path = path
+        if not tiles or obs._tiles is not None:
+            return obs
+        # cached without its tile table, which is added to the record
+        obs._tiles = read_tile_table(path)
+    else:
+        obs = read_metafits(path, tiles=tiles)
+
+    try:
+        _write_cache(cache, key, {"stamp": stamp, "record": obs.to_dict()})
+    except OSError as e:
+        logger.debug(f"Unable to cache {path} in {cache}: {e}")
+
+    return obs
@@ -0,0 +1,123 @@
+"""Run a per-measurement set task across many measurement sets at once, fanning
+the work out over a pool of processes and collecting a summary of each.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import traceback
+from glob import glob, has_magic
+from functools import partial
+from multiprocessing import Pool
+
+from gleam_x.utils.obsid_ops import read_obsids_file
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_measurement_sets(spec, suffix=".ms"):
+    """Expand a measurement set specification into a list of paths. The specification
+    may be a single measurement set, a glob pattern, or a new-line delimited file of
+    obsids. Measurement sets are directories, so a regular file is always treated as
+    a list of obsids.
+
+    Args:
+        spec (str): Measurement set, glob pattern or obsid file
+
+    Keyword Args:
+        suffix (str): Appended to each obsid to form the measurement set name (default: '.ms')
+
+    Returns:
+        list[str]: Paths to the measurement sets to process
+    """
+    if os.path.isfile(spec):
+        return [f"{obsid}{suffix}" for obsid in read_obsids_file(spec)]
+
+    if has_magic(spec):
+        paths = sorted(glob(spec))
+        if len(paths) == 0:
+            raise ValueError(f"No measurement sets match {spec}")
+        return paths
+
+    return [spec]
+
+
+def _timed_call(func, ms, **kwargs):
+    """Run ``func`` against a single measurement set, recording the wall-clock time
+    and any failure rather than letting it propagate out of a worker.
+    """
+    start = time.time()
+    record = {"ms": str(ms)}
+    try:
+        result = func(ms, **kwargs)
+        record["status"] = "ok"
+        if isinstance(result, dict):
+            record.update(result)
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+        logger.error(f"{ms} failed: {record['error']}")
+        logger.debug(traceback.format_exc())
+    except SystemExit as e:
+        record["status"] = "failed"
+        record["error"] = f"SystemExit: {e.code}"
+        logger.error(f"{ms} failed: {record['error']}")
+
+    record["seconds"] = round(time.time() - start, 3)
+
+    return record
+
+
+def run_batch(func, ms_paths, workers=1, **kwargs):
+    """Apply ``func(ms, **kwargs)`` to each measurement set. Tasks run in a process
+    pool when more than one worker is requested. ``func`` must be importable at the
+    module level so that it can be sent to the workers. If it returns a dictionary,
+    its items are merged into the record for that measurement set.
+
+    Args:
+        func (Callable): Task to run against each measurement set
+        ms_paths (Iterable[str]): Measurement sets to process
+
+    Keyword Args:
+        workers (int): Number of processes to use (default: 1)
+
+    Returns:
+        list[dict]: One record per measurement set, in the order supplied, with its
+        status and the time taken in seconds
+    """
+    ms_paths = list(ms_paths)
+    task = partial(_timed_call, func, **kwargs)
+
+    if workers is None or workers < 2 or len(ms_paths) < 2:
+        return [task(ms) for ms in ms_paths]
+
+    with Pool(processes=min(workers, len(ms_paths))) as pool:
+        return pool.map(task, ms_paths, chunksize=1)
+
+
+def write_summary(records, path=None):
+    """Report the records of a batch as JSON
+
+    Args:
+        records (list[dict]): Per measurement set records produced by ``run_batch``
+
+    Keyword Args:
+        path (str): File to write the summary to. If None it is written to stdout (default: None)
+    """
+    summary = {
+        "total": len(records),
+        "failed": sum(r["status"] != "ok" for r in records),
+        "seconds": round(sum(r["seconds"] for r in records), 3),
+        "measurement_sets": records,
+    }
+
+    if path is None:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, "w") as out:
+            json.dump(summary, out, indent=2)
+
+    return summary
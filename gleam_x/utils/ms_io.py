@@ -0,0 +1,171 @@
+"""Block-wise access to the columns of a measurement set, so that tools operating
+over the visibilities hold at most one block of rows in memory at a time.
+"""
+
+import numpy as np
+from casacore.tables import table
+
+DEFAULT_BLOCK_SIZE = 50000
+
+
+def row_blocks(nrows, block_size=DEFAULT_BLOCK_SIZE):
+    """Generate the (startrow, nrow) pairs that tile a table
+
+    Args:
+        nrows (int): Number of rows in the table
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Yields:
+        tuple[int, int]: The first row and the number of rows of each block
+    """
+    if block_size < 1:
+        raise ValueError(f"block_size must be positive, received {block_size}")
+
+    for startrow in range(0, nrows, block_size):
+        yield startrow, min(block_size, nrows - startrow)
+
+
+def iter_row_blocks(tab, columns, block_size=DEFAULT_BLOCK_SIZE):
+    """Stream a set of columns from a casacore table in blocks of rows
+
+    Args:
+        tab (casacore.tables.table): Table (or taql selection) to read from
+        columns (Iterable[str]): Names of the columns to read
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Yields:
+        tuple[int, dict]: The first row of the block and a dictionary of the column name
+        to the values read for that block
+    """
+    for startrow, nrow in row_blocks(tab.nrows(), block_size=block_size):
+        yield startrow, {
+            col: tab.getcol(col, startrow=startrow, nrow=nrow) for col in columns
+        }
+
+
+def iter_masked_data(tab, data_column, block_size=DEFAULT_BLOCK_SIZE, extra_columns=()):
+    """Stream a visibility column with flagged visibilities set to NaN
+
+    Args:
+        tab (casacore.tables.table): Table (or taql selection) to read from
+        data_column (str): Name of the visibility column, e.g. DATA or CORRECTED_DATA
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+        extra_columns (Iterable[str]): Additional columns to read alongside the data (default: ())
+
+    Yields:
+        tuple[int, numpy.ndarray, dict]: The first row of the block, the visibilities of the block and the
+        extra columns requested
+    """
+    columns = ("FLAG", data_column, *extra_columns)
+    for startrow, cols in iter_row_blocks(tab, columns, block_size=block_size):
+        data = cols.pop(data_column)
+        data[cols.pop("FLAG")] = np.nan
+
+        yield startrow, data, cols
+
+
+def flag_rows(ms, selector, block_size=DEFAULT_BLOCK_SIZE):
+    """Flag the rows of a measurement set chosen by ``selector`` in a single pass,
+    writing FLAG and FLAG_ROW block by block. The number of visibilities flagged
+    and left unflagged are accumulated during the same pass.
+
+    Args:
+        ms (Union[str,Path]): Path to the measurement set to modify
+        selector (Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray]): Given the ANTENNA1 and
+        ANTENNA2 columns of a block, return a boolean mask of the rows to flag
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Returns:
+        tuple[int, int]: Number of visibilities newly flagged, and the number remaining unflagged
+    """
+    tab = table(str(ms), readonly=False, ack=False)
+
+    flagged = 0
+    unflagged = 0
+    columns = ("ANTENNA1", "ANTENNA2", "FLAG", "FLAG_ROW")
+    try:
+        for startrow, cols in iter_row_blocks(tab, columns, block_size=block_size):
+            flags = cols["FLAG"]
+            rows = selector(cols["ANTENNA1"], cols["ANTENNA2"])
+
+            if np.any(rows):
+                flagged += int(np.count_nonzero(~flags[rows]))
+                flags[rows] = True
+                cols["FLAG_ROW"][rows] = True
+
+                nrow = len(rows)
+                tab.putcol("FLAG", flags, startrow=startrow, nrow=nrow)
+                tab.putcol("FLAG_ROW", cols["FLAG_ROW"], startrow=startrow, nrow=nrow)
+
+            unflagged += int(np.count_nonzero(~flags))
+    finally:
+        tab.close()
+
+    return flagged, unflagged
+
+
+def _antenna_count(ms):
+    """Number of rows in the ANTENNA table of a measurement set"""
+    ant_tab = table(f"{ms}/ANTENNA", readonly=True, ack=False)
+    nant = ant_tab.nrows()
+    ant_tab.close()
+
+    return nant
+
+
+def flag_antennas(ms, antennas, block_size=DEFAULT_BLOCK_SIZE):
+    """Flag every baseline that includes any of the supplied antennas
+
+    Args:
+        ms (Union[str,Path]): Path to the measurement set to modify
+        antennas (Iterable[int]): Antenna indices, following the row order of the ANTENNA table
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Returns:
+        tuple[int, int]: Number of visibilities newly flagged, and the number remaining unflagged
+    """
+    antennas = np.atleast_1d(np.asarray(antennas, dtype=int))
+    nant = max(_antenna_count(ms), antennas.max(initial=-1) + 1)
+
+    member = np.zeros(nant, dtype=bool)
+    member[antennas] = True
+
+    def selector(ant1, ant2):
+        return member[ant1] | member[ant2]
+
+    return flag_rows(ms, selector, block_size=block_size)
+
+
+def flag_baselines(ms, baselines, block_size=DEFAULT_BLOCK_SIZE):
+    """Flag the supplied baselines, matched exactly on (ANTENNA1, ANTENNA2)
+
+    Args:
+        ms (Union[str,Path]): Path to the measurement set to modify
+        baselines (Iterable[tuple[int,int]]): (ANTENNA1, ANTENNA2) pairs to flag
+
+    Keyword Args:
+        block_size (int): Maximum number of rows in a block (default: 50000)
+
+    Returns:
+        tuple[int, int]: Number of visibilities newly flagged, and the number remaining unflagged
+    """
+    baselines = np.asarray(list(baselines), dtype=int).reshape(-1, 2)
+    nant = max(_antenna_count(ms), baselines.max(initial=-1) + 1)
+
+    member = np.zeros((nant, nant), dtype=bool)
+    member[baselines[:, 0], baselines[:, 1]] = True
+
+    def selector(ant1, ant2):
+        return member[ant1, ant2]
+
+    return flag_rows(ms, selector, block_size=block_size)
@@ -0,0 +1,208 @@
+"""Solid angle (dOmega) of the pixels of SIN and ZEA images with respect to a
+reference direction, as used to describe how the PSF of a snapshot changes when
+it is reprojected. The factors are evaluated on tiles, optionally by a pool of
+threads, and separable WCS are evaluated without a per-pixel world coordinate
+transform.
+"""
+
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+logger = logging.getLogger(__name__)
+
+# Size in pixels of the square tiles the factors are evaluated on
+DEFAULT_TILE = 2048
+FITS_BLOCK = 2880
+
+
+def radec_to_lm(ra, dec, ra0, dec0):
+    """Convert RA,DEC to l,m."""
+
+    l = np.cos(dec)*np.sin(ra-ra0)
+    m = np.sin(dec)*np.cos(dec0) - np.cos(dec)*np.sin(dec0)*np.cos(ra-ra0)
+
+    return l, m
+
+
+def dOmega(ra, dec, ra0, dec0):
+    """Calculate dOmega from RA,DEC.
+
+    dOmega = dldm / (1-l^2-m^2)^1/2
+    """
+
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    ra0 = np.radians(ra0)
+    dec0 = np.radians(dec0)
+
+    l, m = radec_to_lm(ra, dec, ra0, dec0)
+    n = np.sqrt(1 - l**2 - m**2)
+
+    return 1. / n
+
+
+def check_projection(hdr, projections=["SIN", "ZEA"]):
+    """Check that projection == 'SIN'."""
+
+    projection = hdr["CTYPE1"].split("-")[-1]
+
+    if  projection not in projections:
+        raise ValueError("projection is not {}: projection={}".format(
+            projections, projection))
+    else:
+        return projection
+
+
+def radec_to_unit(ra, dec):
+    """Cartesian unit vectors of RA,DEC in radians."""
+
+    cos_dec = np.cos(dec)
+
+    return np.stack((cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)), axis=-1)
+
+
+class SolidAngleFactor(object):
+    """dOmega of every pixel of an image with respect to a reference direction,
+    evaluated on tiles.
+
+    For SIN and ZEA images with a linear WCS the intermediate world coordinates
+    of a pixel are sums of a term depending only on its column and a term
+    depending only on its row, and the celestial coordinates are a fixed rotation
+    of the native spherical coordinates. n = cos(separation) is then the dot
+    product of the native unit vector of each pixel with the reference direction
+    rotated into the native frame, which is formed from the separable terms by
+    broadcasting. Other images fall back to all_pix2world on each tile.
+    """
+
+    def __init__(self, header, ra0, dec0):
+        self.projection = check_projection(header)
+        self.wcs = WCS(header).celestial
+        self.shape = (header["NAXIS2"], header["NAXIS1"])
+        self.ra0 = ra0
+        self.dec0 = dec0
+
+        self.separable = self._setup_separable()
+        if not self.separable:
+            logger.info("WCS is not separable, evaluating every pixel with all_pix2world.")
+
+    def _intermediate(self, rows, cols):
+        """Intermediate world coordinates in radians of pixels, broadcast from
+        1D arrays of rows and columns."""
+
+        x = self._x_col[cols][np.newaxis, :] + self._x_row[rows][:, np.newaxis]
+        y = self._y_col[cols][np.newaxis, :] + self._y_row[rows][:, np.newaxis]
+
+        return x, y
+
+    def _native_unit(self, x, y):
+        """Unit vectors in the native spherical frame of intermediate world
+        coordinates in radians, with shape (..., 3)."""
+
+        r2 = x**2 + y**2
+        with np.errstate(invalid="ignore"):
+            if self.projection == "SIN":
+                return np.stack((-y, x, np.sqrt(1. - r2)), axis=-1)
+
+            # ZEA: R = 2 sin((90 - theta) / 2)
+            scale = np.sqrt(1. - r2/4.)
+            return np.stack((-y*scale, x*scale, 1. - r2/2.), axis=-1)
+
+    def _setup_separable(self):
+        w = self.wcs
+        if w.has_distortion or len(w.wcs.get_pv()) > 0 or w.wcs.lng != 0 or w.wcs.lat != 1:
+            return False
+
+        ny, nx = self.shape
+        scale = np.radians(w.pixel_scale_matrix)
+        cols = np.arange(nx) + 1. - w.wcs.crpix[0]
+        rows = np.arange(ny) + 1. - w.wcs.crpix[1]
+        self._x_col, self._x_row = scale[0, 0]*cols, scale[0, 1]*rows
+        self._y_col, self._y_row = scale[1, 0]*cols, scale[1, 1]*rows
+
+        # Rotation from the native to the celestial frame, from a grid of pixels
+        rows = np.unique(np.linspace(0, ny - 1, 7).astype(int))
+        cols = np.unique(np.linspace(0, nx - 1, 7).astype(int))
+        native = self._native_unit(*self._intermediate(rows, cols)).reshape(-1, 3)
+        r, d = w.all_pix2world(*np.meshgrid(cols, rows), 0)
+        celestial = radec_to_unit(np.radians(r), np.radians(d)).reshape(-1, 3)
+
+        valid = np.all(np.isfinite(native), axis=1) & np.all(np.isfinite(celestial), axis=1)
+        if np.sum(valid) < 3:
+            return False
+        rotation = np.linalg.lstsq(native[valid], celestial[valid], rcond=None)[0]
+        if np.max(np.abs(native[valid] @ rotation - celestial[valid])) > 1e-9:
+            return False
+
+        ref = radec_to_unit(np.radians(self.ra0), np.radians(self.dec0))
+        self._ref_native = rotation @ ref
+
+        return True
+
+    def tile(self, y0, y1, x0, x1):
+        """dOmega of the pixels in rows y0:y1 and columns x0:x1."""
+
+        if not self.separable:
+            x, y = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+            r, d = self.wcs.all_pix2world(x, y, 0)
+            return dOmega(r, d, self.ra0, self.dec0)
+
+        native = self._native_unit(*self._intermediate(np.arange(y0, y1), np.arange(x0, x1)))
+        n = np.abs(native @ self._ref_native)
+
+        with np.errstate(divide="ignore"):
+            return 1. / n
+
+    def tiles(self, tile=DEFAULT_TILE, threads=1):
+        """Evaluate dOmega over the whole image, one tile per task of a pool of threads.
+
+        Yields:
+            tuple[tuple[slice,slice],numpy.ndarray]: Position of each tile in the image and its values
+        """
+
+        ny, nx = self.shape
+        bounds = [(y0, min(y0 + tile, ny), x0, min(x0 + tile, nx))
+                  for y0 in range(0, ny, tile) for x0 in range(0, nx, tile)]
+
+        def evaluate(b):
+            return (slice(b[0], b[1]), slice(b[2], b[3])), self.tile(*b)
+
+        if threads is None or threads < 2 or len(bounds) < 2:
+            for b in bounds:
+                yield evaluate(b)
+            return
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for result in pool.map(evaluate, bounds):
+                yield result
+
+
+def allocate_fits(outname, header, shape, dtype=np.float32):
+    """Create a FITS image of the given shape on disk without holding its data in
+    memory, and open it for tiles to be written straight into it.
+
+    Returns:
+        astropy.io.fits.HDUList: The new file, memory mapped in update mode
+    """
+
+    header = header.copy()
+    for key in ("BSCALE", "BZERO", "BLANK"):
+        if key in header:
+            del header[key]
+
+    hdr = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype), header=header).header
+    hdr["NAXIS1"] = shape[1]
+    hdr["NAXIS2"] = shape[0]
+    hdr.tofile(outname, overwrite=True)
+
+    nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    size = len(hdr.tostring()) + FITS_BLOCK * math.ceil(nbytes / FITS_BLOCK)
+    with open(outname, "rb+") as f:
+        f.seek(size - 1)
+        f.write(b"\0")
+
+    return fits.open(outname, mode="update", memmap=True)
@@ -31,12 +31,9 @@ def read_table(inputfile):
     return Table(hdu[1].data)
 
 
-@np.vectorize
 def unwrap(ang):
     r = ang - 2*np.pi*(ang//(2*np.pi))
-    if r>np.pi:
-        r -= 2*np.pi
-    return r
+    return np.where(r>np.pi, r-2*np.pi, r)
 
 
 # add a HEALPix pixel column to the table
@@ -183,17 +180,17 @@ if __name__== "__main__":
     mywcs = wcs.WCS(header)
     print "projecting hpx->car"
     # for each pixel in the cartesian grid, seek the value from the hpix grid
-    for j in range(ny):
-        for i in range(nx):
-            ra, dec = mywcs.all_pix2world(i,j,0)
-            if np.all(np.isfinite([ra ,dec])):
-                p = radec2hpix(ra,dec,order=options.order)
-            else:
-                p=-1
-            if pix_dict.has_key(p):
-                car[:,j,i]=pix_dict[p][:4]
-            else:
-                car[:,j,i]=[np.nan,np.nan,np.nan,np.nan]
+    lookup = np.empty((hp.nside2npix(2**options.order)+1,4),dtype=np.float32)*np.nan
+    for p in pix_dict.keys():
+        lookup[p] = pix_dict[p][:4]
+    xx, yy = np.meshgrid(np.arange(nx), np.arange(ny))
+    ra, dec = mywcs.all_pix2world(xx,yy,0)
+    valid = np.isfinite(ra) & np.isfinite(dec)
+    # pixels without valid coordinates index the trailing row of nans
+    p = np.empty((ny,nx),dtype=np.int64)
+    p[:] = len(lookup)-1
+    p[valid] = radec2hpix(ra[valid],dec[valid],order=options.order)
+    car = np.rollaxis(lookup[p],2)
     header['CTYPE3']=('Beam',"0=a,1=b,2=pa (degrees),3=blur")
     if options.output is None:
 # Try some common extensions
@@ -42,6 +42,7 @@ scripts = [
     "gleam_x/bin/make_time_cube.py",
     "gleam_x/bin/mask_image.py",
     "gleam_x/bin/match_idg_obsid_pairs.py",
+    "gleam_x/bin/mosaic_coadd.py",
     "gleam_x/bin/mosaic_global_rescale.py",
     "gleam_x/bin/ms_flag_by_direction.py",
     "gleam_x/bin/ms_flag_by_uvdist.py",